@@ -0,0 +1,43 @@
+"""Bulk-import students from a CSV file.
+
+Usage: python import_students.py students.csv [--report errors.json]
+
+Expected columns: email, password, first_name, last_name, phone, student_number,
+department_id, academic_year, date_of_birth, address, emergency_contact.
+"""
+import argparse
+import asyncio
+import json
+import sys
+
+from server import close_client, import_students_csv, shutdown_hash_pool
+
+
+async def run(path: str, report_path: str = None) -> int:
+    try:
+        with open(path, encoding='utf-8-sig', newline='') as f:
+            report = await import_students_csv(f)
+    finally:
+        close_client()
+        shutdown_hash_pool()
+    
+    print(f"Imported {report['imported']}/{report['total']} rows, {report['failed']} failed")
+    if report_path:
+        with open(report_path, 'w', encoding='utf-8') as f:
+            json.dump(report['errors'], f, ensure_ascii=False, indent=2)
+    else:
+        for error in report['errors']:
+            print(f"  row {error['row']} ({error['email']}): {'; '.join(error['errors'])}")
+    return 0 if report['failed'] == 0 else 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk-import students from a CSV file")
+    parser.add_argument('csv_file')
+    parser.add_argument('--report', help="Write the per-row error report to this JSON file")
+    args = parser.parse_args()
+    return asyncio.run(run(args.csv_file, args.report))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1053 @@
+"""In-memory storage engine exposing the part of Motor's API the routes use.
+
+Selected with STORAGE_ENGINE=memory. Each collection keeps its documents in
+insertion order and maintains hash indexes on the first field of every
+create_index() call (multikey for arrays), so equality, $in and $all filters on
+indexed fields, and $lookups on them, don't scan. Meant for tests and
+benchmarks: nothing is persisted, there are no transactions, and only the query,
+update and aggregation operators the server uses are implemented.
+"""
+import copy
+import itertools
+import math
+import re
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from bson import ObjectId
+from pymongo import DeleteMany, DeleteOne, InsertOne, ReplaceOne, UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+
+# Value of a path that doesn't exist; distinct from an explicit None
+MISSING = object()
+
+
+# Paths
+def split_path(path: str) -> List[str]:
+    return path.split('.')
+
+def field_values(value: Any, parts: List[str]) -> List[Any]:
+    """Every value a query path reaches, descending through arrays of subdocuments."""
+    if not parts:
+        return [value]
+    head, rest = parts[0], parts[1:]
+    if isinstance(value, dict):
+        return field_values(value[head], rest) if head in value else [MISSING]
+    if isinstance(value, list):
+        if head.isdigit():
+            index = int(head)
+            return field_values(value[index], rest) if index < len(value) else [MISSING]
+        found = [v for item in value if isinstance(item, dict) for v in field_values(item, parts)]
+        return found or [MISSING]
+    return [MISSING]
+
+def expression_path(value: Any, parts: List[str]) -> Any:
+    """Aggregation field path: "$a.b" over an array of subdocuments yields an array."""
+    for index, part in enumerate(parts):
+        if isinstance(value, dict):
+            value = value.get(part, MISSING)
+        elif isinstance(value, list):
+            values = [expression_path(item, parts[index:]) for item in value if isinstance(item, dict)]
+            return [v for v in values if v is not MISSING]
+        else:
+            return MISSING
+        if value is MISSING:
+            return MISSING
+    return value
+
+def get_path(doc: Dict[str, Any], path: str) -> Any:
+    value: Any = doc
+    for part in split_path(path):
+        if isinstance(value, dict) and part in value:
+            value = value[part]
+        elif isinstance(value, list) and part.isdigit() and int(part) < len(value):
+            value = value[int(part)]
+        else:
+            return MISSING
+    return value
+
+def set_path(doc: Dict[str, Any], path: str, value: Any):
+    parts = split_path(path)
+    target = doc
+    for part in parts[:-1]:
+        if not isinstance(target.get(part), dict):
+            target[part] = {}
+        target = target[part]
+    target[parts[-1]] = value
+
+def unset_path(doc: Dict[str, Any], path: str):
+    parts = split_path(path)
+    target: Any = doc
+    for part in parts[:-1]:
+        target = target.get(part) if isinstance(target, dict) else None
+        if target is None:
+            return
+    if isinstance(target, dict):
+        target.pop(parts[-1], None)
+
+
+# Ordering and equality
+def type_rank(value: Any) -> int:
+    if value is None or value is MISSING:
+        return 1
+    if isinstance(value, bool):
+        return 8
+    if isinstance(value, (int, float)):
+        return 2
+    if isinstance(value, str):
+        return 3
+    if isinstance(value, dict):
+        return 4
+    if isinstance(value, list):
+        return 5
+    if isinstance(value, ObjectId):
+        return 7
+    if isinstance(value, datetime):
+        return 9
+    return 10
+
+def sort_key(value: Any) -> Tuple:
+    rank = type_rank(value)
+    if rank == 1:
+        return (rank, 0)
+    if rank in (4, 5, 10):
+        return (rank, repr(value))
+    if rank == 7:
+        return (rank, str(value))
+    return (rank, value)
+
+def compare(a: Any, b: Any) -> int:
+    ka, kb = sort_key(a), sort_key(b)
+    return (ka > kb) - (ka < kb)
+
+def freeze(value: Any) -> Any:
+    """Hashable form of a value, for index keys and $group keys."""
+    if value is MISSING:
+        return None
+    if isinstance(value, dict):
+        return ('__doc__', tuple((k, freeze(v)) for k, v in value.items()))
+    if isinstance(value, list):
+        return ('__array__', tuple(freeze(v) for v in value))
+    return value
+
+def values_equal(value: Any, target: Any) -> bool:
+    """Query equality: null matches missing, scalars match array elements."""
+    if isinstance(target, re.Pattern):
+        candidates = value if isinstance(value, list) else [value]
+        return any(isinstance(c, str) and target.search(c) for c in candidates)
+    if value is MISSING:
+        return target is None
+    if type_rank(value) == type_rank(target) and value == target:
+        return True
+    if isinstance(value, list) and not isinstance(target, list):
+        return any(type_rank(v) == type_rank(target) and v == target for v in value)
+    return False
+
+
+# Query matching
+def is_operator_document(value: Any) -> bool:
+    return isinstance(value, dict) and bool(value) and all(k.startswith('$') for k in value)
+
+def scalars(values: List[Any]) -> Iterable[Any]:
+    for value in values:
+        if isinstance(value, list):
+            yield from value
+        elif value is not MISSING:
+            yield value
+
+def ordered_match(values: List[Any], target: Any, accept: Callable[[int], bool]) -> bool:
+    # Range operators only compare values of the same type bracket
+    return any(type_rank(v) == type_rank(target) and accept(compare(v, target)) for v in scalars(values))
+
+def apply_operator(op: str, arg: Any, values: List[Any], cond: Dict[str, Any], variables: Dict[str, Any]) -> bool:
+    if op == '$eq':
+        return any(values_equal(v, arg) for v in values)
+    if op == '$ne':
+        return not any(values_equal(v, arg) for v in values)
+    if op == '$gt':
+        return ordered_match(values, arg, lambda c: c > 0)
+    if op == '$gte':
+        return ordered_match(values, arg, lambda c: c >= 0)
+    if op == '$lt':
+        return ordered_match(values, arg, lambda c: c < 0)
+    if op == '$lte':
+        return ordered_match(values, arg, lambda c: c <= 0)
+    if op == '$in':
+        return any(values_equal(v, a) for a in arg for v in values)
+    if op == '$nin':
+        return not any(values_equal(v, a) for a in arg for v in values)
+    if op == '$all':
+        return bool(arg) and all(any(values_equal(v, a) for v in values) for a in arg)
+    if op == '$exists':
+        return any(v is not MISSING for v in values) == bool(arg)
+    if op == '$size':
+        return any(isinstance(v, list) and len(v) == arg for v in values)
+    if op == '$regex':
+        flags = re.IGNORECASE if 'i' in cond.get('$options', '') else 0
+        pattern = arg if isinstance(arg, re.Pattern) else re.compile(arg, flags)
+        return any(values_equal(v, pattern) for v in values)
+    if op == '$options':
+        return True
+    if op == '$not':
+        return not all(apply_operator(o, a, values, arg, variables) for o, a in arg.items())
+    if op == '$elemMatch':
+        for value in values:
+            for element in value if isinstance(value, list) else []:
+                if is_operator_document(arg) and not isinstance(element, dict):
+                    if all(apply_operator(o, a, [element], arg, variables) for o, a in arg.items()):
+                        return True
+                elif isinstance(element, dict) and matches(element, arg, variables):
+                    return True
+        return False
+    raise OperationFailure(f"Unsupported query operator {op}")
+
+def matches(doc: Dict[str, Any], query: Optional[Dict[str, Any]], variables: Optional[Dict[str, Any]] = None) -> bool:
+    variables = variables or {}
+    for key, cond in (query or {}).items():
+        if key == '$and':
+            if not all(matches(doc, q, variables) for q in cond):
+                return False
+        elif key == '$or':
+            if not any(matches(doc, q, variables) for q in cond):
+                return False
+        elif key == '$nor':
+            if any(matches(doc, q, variables) for q in cond):
+                return False
+        elif key == '$expr':
+            if not truthy(evaluate(cond, doc, variables)):
+                return False
+        else:
+            values = field_values(doc, split_path(key))
+            if is_operator_document(cond):
+                if not all(apply_operator(op, arg, values, cond, variables) for op, arg in cond.items()):
+                    return False
+            elif not any(values_equal(v, cond) for v in values):
+                return False
+    return True
+
+
+# Aggregation expressions
+def truthy(value: Any) -> bool:
+    return value not in (None, False, 0, MISSING)
+
+def nullish(value: Any) -> bool:
+    return value is None or value is MISSING
+
+def numeric(values: List[Any]) -> List[Any]:
+    return [v for v in values if isinstance(v, (int, float)) and not isinstance(v, bool)]
+
+def evaluate(expr: Any, doc: Any, variables: Dict[str, Any]) -> Any:
+    if isinstance(expr, str) and expr.startswith('$$'):
+        name, _, rest = expr[2:].partition('.')
+        base = doc if name in ('ROOT', 'CURRENT') else variables.get(name, MISSING)
+        return expression_path(base, split_path(rest)) if rest else base
+    if isinstance(expr, str) and expr.startswith('$'):
+        return expression_path(doc, split_path(expr[1:]))
+    if isinstance(expr, list):
+        return [v for v in (evaluate(e, doc, variables) for e in expr)]
+    if isinstance(expr, dict):
+        if len(expr) == 1 and next(iter(expr)).startswith('$'):
+            op, arg = next(iter(expr.items()))
+            return evaluate_operator(op, arg, doc, variables)
+        result = {}
+        for key, value in expr.items():
+            value = evaluate(value, doc, variables)
+            if value is not MISSING:
+                result[key] = value
+        return result
+    return expr
+
+def evaluate_operator(op: str, arg: Any, doc: Any, variables: Dict[str, Any]) -> Any:
+    if op == '$literal':
+        return arg
+    if op == '$cond':
+        if isinstance(arg, dict):
+            arg = [arg['if'], arg['then'], arg['else']]
+        branch = arg[1] if truthy(evaluate(arg[0], doc, variables)) else arg[2]
+        return evaluate(branch, doc, variables)
+    if op == '$ifNull':
+        for candidate in arg:
+            value = evaluate(candidate, doc, variables)
+            if not nullish(value):
+                return value
+        return None
+
+    args = evaluate(arg, doc, variables) if isinstance(arg, list) else [evaluate(arg, doc, variables)]
+    if op in ('$add', '$multiply'):
+        if any(nullish(a) for a in args):
+            return None
+        total = 0 if op == '$add' else 1
+        for a in args:
+            total = total + a if op == '$add' else total * a
+        return total
+    if op in ('$subtract', '$divide', '$mod'):
+        a, b = args
+        if nullish(a) or nullish(b):
+            return None
+        if op == '$subtract':
+            return a - b
+        if b == 0:
+            raise OperationFailure(f"{op} by zero")
+        return a / b if op == '$divide' else a % b
+    if op in ('$min', '$max', '$sum', '$avg'):
+        values = args[0] if len(args) == 1 and isinstance(args[0], list) else args
+        values = [v for v in values if not nullish(v)]
+        if op in ('$sum', '$avg'):
+            values = numeric(values)
+            if op == '$sum':
+                return sum(values)
+            return sum(values) / len(values) if values else None
+        if not values:
+            return None
+        key = lambda v: sort_key(v)
+        return min(values, key=key) if op == '$min' else max(values, key=key)
+    if op in ('$abs', '$floor', '$ceil'):
+        value = args[0]
+        if nullish(value):
+            return None
+        return {'$abs': abs, '$floor': math.floor, '$ceil': math.ceil}[op](value)
+    if op == '$round':
+        value, places = args[0], args[1] if len(args) > 1 else 0
+        return None if nullish(value) else round(value, places)
+    if op == '$concat':
+        if any(nullish(a) for a in args):
+            return None
+        return ''.join(args)
+    if op == '$substrBytes':
+        value, start, length = args
+        data = ('' if nullish(value) else str(value)).encode('utf-8')
+        return data[start:start + length if length >= 0 else None].decode('utf-8', errors='ignore')
+    if op in ('$toLower', '$toUpper', '$toString'):
+        value = args[0]
+        if nullish(value):
+            return '' if op != '$toString' else None
+        return {'$toLower': str.lower, '$toUpper': str.upper, '$toString': str}[op](str(value))
+    if op == '$strLenCP':
+        return len(args[0])
+    if op == '$size':
+        value = args[0]
+        if not isinstance(value, list):
+            raise OperationFailure("$size requires an array")
+        return len(value)
+    if op == '$isArray':
+        return isinstance(args[0], list)
+    if op in ('$setIntersection', '$setUnion'):
+        if any(nullish(a) for a in args):
+            return None
+        frozen = [{freeze(v): v for v in a} for a in args]
+        if op == '$setUnion':
+            merged: Dict[Any, Any] = {}
+            for f in frozen:
+                merged.update(f)
+            return list(merged.values())
+        keys = set(frozen[0]).intersection(*frozen[1:]) if frozen else set()
+        return [v for k, v in frozen[0].items() if k in keys] if frozen else []
+    if op == '$in':
+        value, array = args
+        return any(freeze(value) == freeze(v) for v in array or [])
+    if op == '$arrayToObject':
+        pairs = args[0]
+        if nullish(pairs):
+            return None
+        return dict((p['k'], p['v']) if isinstance(p, dict) else tuple(p) for p in pairs)
+    if op == '$objectToArray':
+        return [{"k": k, "v": v} for k, v in (args[0] or {}).items()]
+    if op in ('$eq', '$ne', '$gt', '$gte', '$lt', '$lte', '$cmp'):
+        a, b = (None if v is MISSING else v for v in args)
+        c = compare(a, b)
+        return {'$eq': c == 0, '$ne': c != 0, '$gt': c > 0, '$gte': c >= 0,
+                '$lt': c < 0, '$lte': c <= 0, '$cmp': c}[op]
+    if op == '$and':
+        return all(truthy(a) for a in args)
+    if op == '$or':
+        return any(truthy(a) for a in args)
+    if op == '$not':
+        return not truthy(args[0])
+    raise OperationFailure(f"Unsupported expression operator {op}")
+
+
+# Projection
+def is_flag(value: Any) -> bool:
+    return isinstance(value, bool) or (isinstance(value, (int, float)) and value in (0, 1))
+
+def project(doc: Dict[str, Any], projection: Optional[Dict[str, Any]], variables: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    if not projection:
+        return copy.deepcopy(doc)
+    variables = variables or {}
+    id_spec = projection.get('_id', 1)
+    fields = {k: v for k, v in projection.items() if k != '_id'}
+    inclusive = any(not is_flag(v) or v for v in fields.values()) or (not fields and not is_flag(id_spec))
+
+    if not inclusive:
+        result = copy.deepcopy(doc)
+        for key in fields:
+            unset_path(result, key)
+        if is_flag(id_spec) and not id_spec:
+            result.pop('_id', None)
+        return result
+
+    result: Dict[str, Any] = {}
+    if not is_flag(id_spec):
+        value = evaluate(id_spec, doc, variables)
+        if value is not MISSING:
+            result['_id'] = value
+    elif id_spec and '_id' in doc:
+        result['_id'] = copy.deepcopy(doc['_id'])
+    for key, spec in fields.items():
+        if is_flag(spec):
+            value = get_path(doc, key)
+            if value is not MISSING:
+                set_path(result, key, copy.deepcopy(value))
+        else:
+            value = evaluate(spec, doc, variables)
+            if value is not MISSING:
+                set_path(result, key, copy.deepcopy(value))
+    return result
+
+
+# Updates
+def apply_update(doc: Dict[str, Any], update: Any, inserting: bool = False):
+    if isinstance(update, list):
+        # Pipeline-style update
+        updated = run_stages([doc], update, None, {})[0]
+        doc.clear()
+        doc.update(updated)
+        return
+    for op, fields in update.items():
+        if op == '$setOnInsert' and not inserting:
+            continue
+        for path, value in fields.items():
+            current = get_path(doc, path)
+            if op in ('$set', '$setOnInsert'):
+                set_path(doc, path, copy.deepcopy(value))
+            elif op == '$unset':
+                unset_path(doc, path)
+            elif op == '$inc':
+                set_path(doc, path, (0 if current is MISSING or current is None else current) + value)
+            elif op == '$mul':
+                set_path(doc, path, (0 if current is MISSING or current is None else current) * value)
+            elif op in ('$min', '$max'):
+                if current is MISSING or (compare(value, current) < 0 if op == '$min' else compare(value, current) > 0):
+                    set_path(doc, path, copy.deepcopy(value))
+            elif op in ('$push', '$addToSet'):
+                items = value['$each'] if isinstance(value, dict) and '$each' in value else [value]
+                array = [] if current is MISSING or current is None else current
+                for item in items:
+                    if op == '$push' or all(freeze(item) != freeze(existing) for existing in array):
+                        array.append(copy.deepcopy(item))
+                set_path(doc, path, array)
+            elif op == '$pull':
+                if isinstance(current, list):
+                    set_path(doc, path, [
+                        item for item in current
+                        if not (matches(item, value) if isinstance(item, dict) and isinstance(value, dict)
+                                else values_equal(item, value) if not is_operator_document(value)
+                                else all(apply_operator(o, a, [item], value, {}) for o, a in value.items()))
+                    ])
+            elif op == '$currentDate':
+                set_path(doc, path, datetime.now(timezone.utc))
+            else:
+                raise OperationFailure(f"Unsupported update operator {op}")
+
+def upsert_seed(query: Dict[str, Any]) -> Dict[str, Any]:
+    """The equality parts of a filter, which an upsert copies into the new document."""
+    seed: Dict[str, Any] = {}
+    for key, cond in query.items():
+        if key.startswith('$'):
+            if key == '$and':
+                for part in cond:
+                    seed.update(upsert_seed(part))
+            continue
+        if is_operator_document(cond):
+            if '$eq' in cond:
+                set_path(seed, key, copy.deepcopy(cond['$eq']))
+        else:
+            set_path(seed, key, copy.deepcopy(cond))
+    return seed
+
+
+# Aggregation stages
+def group_documents(docs: List[Dict[str, Any]], spec: Dict[str, Any], variables: Dict[str, Any]) -> List[Dict[str, Any]]:
+    groups: Dict[Any, Dict[str, Any]] = {}
+    members: Dict[Any, List[Dict[str, Any]]] = {}
+    for doc in docs:
+        key_value = evaluate(spec['_id'], doc, variables)
+        key_value = None if key_value is MISSING else key_value
+        key = freeze(key_value)
+        if key not in groups:
+            groups[key] = {"_id": key_value}
+            members[key] = []
+        members[key].append(doc)
+
+    results = []
+    for key, group in groups.items():
+        rows = members[key]
+        for field, accumulator in spec.items():
+            if field == '_id':
+                continue
+            (op, arg), = accumulator.items()
+            values = [evaluate(arg, row, variables) for row in rows]
+            present = [v for v in values if v is not MISSING]
+            if op == '$sum':
+                group[field] = sum(numeric(present))
+            elif op == '$avg':
+                nums = numeric(present)
+                group[field] = sum(nums) / len(nums) if nums else None
+            elif op in ('$min', '$max'):
+                candidates = [v for v in present if v is not None]
+                pick = min if op == '$min' else max
+                group[field] = pick(candidates, key=sort_key) if candidates else None
+            elif op == '$push':
+                group[field] = present
+            elif op == '$addToSet':
+                group[field] = list({freeze(v): v for v in present}.values())
+            elif op == '$first':
+                group[field] = None if values[0] is MISSING else values[0]
+            elif op == '$last':
+                group[field] = None if values[-1] is MISSING else values[-1]
+            elif op == '$count':
+                group[field] = len(rows)
+            else:
+                raise OperationFailure(f"Unsupported accumulator {op}")
+        results.append(group)
+    return results
+
+def sort_documents(docs: List[Dict[str, Any]], spec: Iterable[Tuple[str, int]]) -> List[Dict[str, Any]]:
+    docs = list(docs)
+    # Stable sorts applied from the least to the most significant key
+    for key, direction in reversed(list(spec)):
+        docs.sort(key=lambda d: sort_key(get_path(d, key)), reverse=direction < 0)
+    return docs
+
+def unwind(docs: List[Dict[str, Any]], spec: Any) -> List[Dict[str, Any]]:
+    if isinstance(spec, str):
+        spec = {"path": spec}
+    path = spec['path'][1:]
+    keep_empty = spec.get('preserveNullAndEmptyArrays', False)
+    results = []
+    for doc in docs:
+        value = get_path(doc, path)
+        if isinstance(value, list) and value:
+            for item in value:
+                copy_doc = copy.deepcopy(doc)
+                set_path(copy_doc, path, item)
+                results.append(copy_doc)
+        elif isinstance(value, list) or nullish(value):
+            if keep_empty:
+                copy_doc = copy.deepcopy(doc)
+                if isinstance(value, list):
+                    unset_path(copy_doc, path)
+                results.append(copy_doc)
+        else:
+            results.append(doc)
+    return results
+
+def lookup(docs: List[Dict[str, Any]], spec: Dict[str, Any], database: 'MemoryDatabase', variables: Dict[str, Any]) -> List[Dict[str, Any]]:
+    foreign = database[spec['from']]
+    sub_pipeline = spec.get('pipeline', [])
+    results = []
+    for doc in docs:
+        let = {name: evaluate(expr, doc, variables) for name, expr in spec.get('let', {}).items()}
+        scope = {**variables, **let}
+        if 'localField' in spec:
+            local = expression_path(doc, split_path(spec['localField']))
+            keys = local if isinstance(local, list) else [None if local is MISSING else local]
+            joined = foreign.equal_to(spec['foreignField'], keys)
+        else:
+            joined = [copy.deepcopy(d) for d in foreign.documents()]
+        if sub_pipeline:
+            joined = run_stages(joined, sub_pipeline, database, scope)
+        row = copy.copy(doc)
+        set_path(row, spec['as'], joined)
+        results.append(row)
+    return results
+
+def merge_into(docs: List[Dict[str, Any]], spec: Any, database: 'MemoryDatabase'):
+    if isinstance(spec, str):
+        spec = {"into": spec}
+    into = spec['into'] if isinstance(spec['into'], str) else spec['into']['coll']
+    on = spec.get('on', '_id')
+    on = [on] if isinstance(on, str) else list(on)
+    target = database[into]
+    for doc in docs:
+        query = {field: get_path(doc, field) for field in on}
+        existing = target.first(query)
+        if existing is not None:
+            when_matched = spec.get('whenMatched', 'merge')
+            if when_matched == 'fail':
+                raise DuplicateKeyError(f"$merge found a match in {into}")
+            if when_matched == 'keepExisting':
+                continue
+            replacement = copy.deepcopy(doc)
+            if when_matched == 'merge':
+                replacement = {**target.docs[existing], **replacement}
+            replacement['_id'] = target.docs[existing]['_id']
+            target.replace_key(existing, replacement)
+        elif spec.get('whenNotMatched', 'insert') == 'insert':
+            target.insert(copy.deepcopy(doc))
+
+def run_stages(docs: List[Dict[str, Any]], pipeline: List[Dict[str, Any]], database: Optional['MemoryDatabase'], variables: Dict[str, Any]) -> List[Dict[str, Any]]:
+    for stage in pipeline:
+        (name, spec), = stage.items()
+        if name == '$match':
+            docs = [d for d in docs if matches(d, spec, variables)]
+        elif name == '$project':
+            docs = [project(d, spec, variables) for d in docs]
+        elif name in ('$set', '$addFields'):
+            updated = []
+            for doc in docs:
+                values = {key: evaluate(expr, doc, variables) for key, expr in spec.items()}
+                row = copy.deepcopy(doc)
+                for key, value in values.items():
+                    if value is not MISSING:
+                        set_path(row, key, value)
+                updated.append(row)
+            docs = updated
+        elif name == '$unset':
+            fields = [spec] if isinstance(spec, str) else spec
+            docs = [project(d, {f: 0 for f in fields}) for d in docs]
+        elif name in ('$replaceRoot', '$replaceWith'):
+            expr = spec['newRoot'] if name == '$replaceRoot' else spec
+            docs = [evaluate(expr, d, variables) for d in docs]
+        elif name == '$sort':
+            docs = sort_documents(docs, spec.items())
+        elif name == '$skip':
+            docs = docs[spec:]
+        elif name == '$limit':
+            docs = docs[:spec]
+        elif name == '$count':
+            docs = [{spec: len(docs)}] if docs else []
+        elif name == '$group':
+            docs = group_documents(docs, spec, variables)
+        elif name == '$unwind':
+            docs = unwind(docs, spec)
+        elif name == '$lookup':
+            docs = lookup(docs, spec, database, variables)
+        elif name == '$unionWith':
+            spec = {"coll": spec} if isinstance(spec, str) else spec
+            other = [copy.deepcopy(d) for d in database[spec['coll']].documents()]
+            docs = docs + run_stages(other, spec.get('pipeline', []), database, variables)
+        elif name == '$out':
+            target = spec if isinstance(spec, str) else spec['coll']
+            database[target].replace_all(docs)
+            docs = []
+        elif name == '$merge':
+            merge_into(docs, spec, database)
+            docs = []
+        else:
+            raise OperationFailure(f"Unsupported aggregation stage {name}")
+    return docs
+
+
+# Cursors
+class MemoryCursor:
+    """find() cursor; sort/skip/limit apply to the raw documents before projection."""
+    def __init__(self, collection: 'MemoryCollection', query: Optional[Dict[str, Any]], projection: Optional[Dict[str, Any]]):
+        self.collection = collection
+        self.query = query or {}
+        self.projection = projection
+        self.sort_spec: List[Tuple[str, int]] = []
+        self.skip_count = 0
+        self.limit_count = 0
+
+    def sort(self, key: Any, direction: Optional[int] = None) -> 'MemoryCursor':
+        if isinstance(key, str):
+            self.sort_spec = [(key, direction or 1)]
+        elif isinstance(key, dict):
+            self.sort_spec = list(key.items())
+        else:
+            self.sort_spec = list(key)
+        return self
+
+    def skip(self, count: int) -> 'MemoryCursor':
+        self.skip_count = count
+        return self
+
+    def limit(self, count: int) -> 'MemoryCursor':
+        self.limit_count = count
+        return self
+
+    def batch_size(self, size: int) -> 'MemoryCursor':
+        return self
+
+    def results(self) -> List[Dict[str, Any]]:
+        docs = self.collection.select(self.query)
+        if self.sort_spec:
+            docs = sort_documents(docs, self.sort_spec)
+        docs = docs[self.skip_count:]
+        if self.limit_count:
+            docs = docs[:self.limit_count]
+        return [project(d, self.projection) for d in docs]
+
+    async def to_list(self, length: Optional[int] = None) -> List[Dict[str, Any]]:
+        docs = self.results()
+        return docs[:length] if length else docs
+
+    def __aiter__(self):
+        return self.iterate()
+
+    async def iterate(self):
+        for doc in self.results():
+            yield doc
+
+class MemoryAggregationCursor:
+    """Runs the pipeline when first read, as Motor does."""
+    def __init__(self, run: Callable[[], List[Dict[str, Any]]]):
+        self.run = run
+
+    async def to_list(self, length: Optional[int] = None) -> List[Dict[str, Any]]:
+        docs = self.run()
+        return docs[:length] if length else docs
+
+    def __aiter__(self):
+        return self.iterate()
+
+    async def iterate(self):
+        for doc in self.run():
+            yield doc
+
+
+# Collections
+class MemoryCollection:
+    def __init__(self, database: 'MemoryDatabase', name: str):
+        self.database = database
+        self.name = name
+        self.docs: Dict[int, Dict[str, Any]] = {}
+        self.serial = itertools.count()
+        # field path -> index key -> document serials; "_id" is always indexed and unique
+        self.indexes: Dict[str, Dict[Any, Set[int]]] = {"_id": {}}
+        self.unique: Set[str] = {"_id"}
+
+    # Indexes
+    def index_keys(self, doc: Dict[str, Any], field: str) -> Set[Any]:
+        keys = set()
+        for value in field_values(doc, split_path(field)):
+            if isinstance(value, list):
+                keys.update(freeze(v) for v in value)
+                if not value:
+                    keys.add(None)
+            else:
+                keys.add(freeze(value))
+        return keys
+
+    def add_to_indexes(self, key: int, doc: Dict[str, Any]):
+        for field in self.unique:
+            for index_key in self.index_keys(doc, field):
+                if field != "_id" and index_key is None:
+                    continue
+                holders = self.indexes[field].get(index_key, set()) - {key}
+                if holders:
+                    raise DuplicateKeyError(
+                        f"E11000 duplicate key error collection: {self.name} index: {field}_1 dup key: {index_key!r}"
+                    )
+        for field, index in self.indexes.items():
+            for index_key in self.index_keys(doc, field):
+                index.setdefault(index_key, set()).add(key)
+
+    def remove_from_indexes(self, key: int, doc: Dict[str, Any]):
+        for field, index in self.indexes.items():
+            for index_key in self.index_keys(doc, field):
+                holders = index.get(index_key)
+                if holders:
+                    holders.discard(key)
+                    if not holders:
+                        del index[index_key]
+
+    def candidates(self, query: Dict[str, Any]) -> Optional[Set[int]]:
+        """Serials that can match, from the most selective indexed equality; None means scan."""
+        best: Optional[Set[int]] = None
+        for field, cond in query.items():
+            index = self.indexes.get(field)
+            if index is None:
+                continue
+            if is_operator_document(cond):
+                if '$eq' in cond:
+                    targets = [cond['$eq']]
+                elif '$in' in cond:
+                    targets = list(cond['$in'])
+                elif '$all' in cond and cond['$all']:
+                    targets = [cond['$all'][0]]
+                else:
+                    continue
+            elif isinstance(cond, dict):
+                continue
+            else:
+                targets = [cond]
+            if any(isinstance(t, (list, dict, re.Pattern)) for t in targets):
+                continue
+            found: Set[int] = set()
+            for target in targets:
+                found |= index.get(freeze(target), set())
+            if best is None or len(found) < len(best):
+                best = found
+        return best
+
+    # Internal access
+    def documents(self) -> List[Dict[str, Any]]:
+        return list(self.docs.values())
+
+    def select_keys(self, query: Optional[Dict[str, Any]]) -> List[int]:
+        query = query or {}
+        keys = self.candidates(query)
+        pool = sorted(keys) if keys is not None else list(self.docs)
+        return [k for k in pool if matches(self.docs[k], query)]
+
+    def select(self, query: Optional[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        return [self.docs[k] for k in self.select_keys(query)]
+
+    def first(self, query: Dict[str, Any]) -> Optional[int]:
+        keys = self.select_keys(query)
+        return keys[0] if keys else None
+
+    def equal_to(self, field: str, values: List[Any]) -> List[Dict[str, Any]]:
+        """Copies of the documents whose field equals any of the values ($lookup)."""
+        if not values:
+            return []
+        query = {field: {"$in": [v for v in values if not isinstance(v, (list, dict))]}}
+        return [copy.deepcopy(d) for d in self.select(query)]
+
+    def insert(self, doc: Dict[str, Any]) -> Any:
+        if '_id' not in doc:
+            doc['_id'] = ObjectId()
+        stored = copy.deepcopy(doc)
+        key = next(self.serial)
+        self.add_to_indexes(key, stored)
+        self.docs[key] = stored
+        return doc['_id']
+
+    def replace_key(self, key: int, replacement: Dict[str, Any]):
+        previous = self.docs[key]
+        self.remove_from_indexes(key, previous)
+        try:
+            self.add_to_indexes(key, replacement)
+        except DuplicateKeyError:
+            self.add_to_indexes(key, previous)
+            raise
+        self.docs[key] = replacement
+
+    def replace_all(self, docs: List[Dict[str, Any]]):
+        self.docs.clear()
+        for index in self.indexes.values():
+            index.clear()
+        for doc in docs:
+            self.insert(copy.deepcopy(doc))
+
+    def update_keys(self, keys: List[int], update: Any) -> int:
+        modified = 0
+        for key in keys:
+            updated = copy.deepcopy(self.docs[key])
+            apply_update(updated, update)
+            if updated != self.docs[key]:
+                self.replace_key(key, updated)
+                modified += 1
+        return modified
+
+    def upsert(self, query: Dict[str, Any], update: Any = None, replacement: Optional[Dict[str, Any]] = None) -> Any:
+        doc = upsert_seed(query) if replacement is None else copy.deepcopy(replacement)
+        if replacement is None:
+            apply_update(doc, update, inserting=True)
+        elif '_id' in query and '_id' not in doc:
+            doc['_id'] = query['_id']
+        return self.insert(doc)
+
+    # Motor API
+    def find(self, filter: Optional[Dict[str, Any]] = None, projection: Optional[Dict[str, Any]] = None,
+             sort: Any = None, skip: int = 0, limit: int = 0, **kwargs) -> MemoryCursor:
+        cursor = MemoryCursor(self, filter, projection).skip(skip).limit(limit)
+        return cursor.sort(sort) if sort else cursor
+
+    async def find_one(self, filter: Optional[Dict[str, Any]] = None, projection: Optional[Dict[str, Any]] = None,
+                       sort: Any = None, **kwargs) -> Optional[Dict[str, Any]]:
+        docs = await self.find(filter, projection, sort=sort, limit=1).to_list(1)
+        return docs[0] if docs else None
+
+    async def count_documents(self, filter: Dict[str, Any], skip: int = 0, limit: int = 0, **kwargs) -> int:
+        count = max(len(self.select_keys(filter)) - skip, 0)
+        return min(count, limit) if limit else count
+
+    async def estimated_document_count(self, **kwargs) -> int:
+        return len(self.docs)
+
+    async def distinct(self, key: str, filter: Optional[Dict[str, Any]] = None, **kwargs) -> List[Any]:
+        values = {freeze(v): v for d in self.select(filter) for v in scalars(field_values(d, split_path(key)))}
+        return [copy.deepcopy(v) for v in values.values()]
+
+    async def insert_one(self, document: Dict[str, Any], **kwargs):
+        return SimpleNamespace(inserted_id=self.insert(document), acknowledged=True)
+
+    async def insert_many(self, documents: List[Dict[str, Any]], ordered: bool = True, **kwargs):
+        inserted, errors = [], []
+        for index, document in enumerate(documents):
+            try:
+                inserted.append(self.insert(document))
+            except DuplicateKeyError as e:
+                errors.append({"index": index, "code": 11000, "errmsg": str(e), "op": document})
+                if ordered:
+                    break
+        if errors:
+            raise BulkWriteError({"writeErrors": errors, "nInserted": len(inserted), "writeConcernErrors": [],
+                                  "nUpserted": 0, "nMatched": 0, "nModified": 0, "nRemoved": 0, "upserted": []})
+        return SimpleNamespace(inserted_ids=inserted, acknowledged=True)
+
+    async def update_one(self, filter: Dict[str, Any], update: Any, upsert: bool = False, **kwargs):
+        return self.update(filter, update, upsert, many=False)
+
+    async def update_many(self, filter: Dict[str, Any], update: Any, upsert: bool = False, **kwargs):
+        return self.update(filter, update, upsert, many=True)
+
+    def update(self, filter: Dict[str, Any], update: Any, upsert: bool, many: bool):
+        keys = self.select_keys(filter)
+        if not many:
+            keys = keys[:1]
+        if not keys and upsert:
+            return SimpleNamespace(matched_count=0, modified_count=0, upserted_id=self.upsert(filter, update), acknowledged=True)
+        return SimpleNamespace(matched_count=len(keys), modified_count=self.update_keys(keys, update), upserted_id=None, acknowledged=True)
+
+    async def replace_one(self, filter: Dict[str, Any], replacement: Dict[str, Any], upsert: bool = False, **kwargs):
+        return self.replace(filter, replacement, upsert)
+
+    def replace(self, filter: Dict[str, Any], replacement: Dict[str, Any], upsert: bool):
+        key = self.first(filter)
+        if key is None:
+            upserted = self.upsert(filter, replacement=replacement) if upsert else None
+            return SimpleNamespace(matched_count=0, modified_count=0, upserted_id=upserted, acknowledged=True)
+        document = copy.deepcopy(replacement)
+        document['_id'] = self.docs[key]['_id']
+        modified = document != self.docs[key]
+        self.replace_key(key, document)
+        return SimpleNamespace(matched_count=1, modified_count=int(modified), upserted_id=None, acknowledged=True)
+
+    async def find_one_and_update(self, filter: Dict[str, Any], update: Any, projection: Optional[Dict[str, Any]] = None,
+                                  sort: Any = None, upsert: bool = False, return_document: bool = False, **kwargs):
+        keys = self.select_keys(filter)
+        if sort:
+            spec = [(sort, 1)] if isinstance(sort, str) else list(sort.items() if isinstance(sort, dict) else sort)
+            ordered = sort_documents([{**self.docs[k], '__key': k} for k in keys], spec)
+            keys = [d['__key'] for d in ordered]
+        if not keys:
+            if not upsert:
+                return None
+            upserted = self.upsert(filter, update)
+            # ReturnDocument.AFTER is True
+            return project(self.docs[self.first({"_id": upserted})], projection) if return_document else None
+        key = keys[0]
+        before = project(self.docs[key], projection)
+        self.update_keys([key], update)
+        return project(self.docs[key], projection) if return_document else before
+
+    async def delete_one(self, filter: Dict[str, Any], **kwargs):
+        return self.delete(self.select_keys(filter)[:1])
+
+    async def delete_many(self, filter: Dict[str, Any], **kwargs):
+        return self.delete(self.select_keys(filter))
+
+    def delete(self, keys: List[int]):
+        for key in keys:
+            self.remove_from_indexes(key, self.docs.pop(key))
+        return SimpleNamespace(deleted_count=len(keys), acknowledged=True)
+
+    async def bulk_write(self, requests: List[Any], ordered: bool = True, **kwargs):
+        counts = {"inserted_count": 0, "matched_count": 0, "modified_count": 0, "deleted_count": 0, "upserted_count": 0}
+        for request in requests:
+            if isinstance(request, InsertOne):
+                self.insert(request._doc)
+                counts['inserted_count'] += 1
+                continue
+            if isinstance(request, ReplaceOne):
+                result = self.replace(request._filter, request._doc, request._upsert)
+            elif isinstance(request, (UpdateOne, UpdateMany)):
+                result = self.update(request._filter, request._doc, request._upsert, many=isinstance(request, UpdateMany))
+            elif isinstance(request, (DeleteOne, DeleteMany)):
+                keys = self.select_keys(request._filter)
+                result = self.delete(keys if isinstance(request, DeleteMany) else keys[:1])
+                counts['deleted_count'] += result.deleted_count
+                continue
+            else:
+                raise OperationFailure(f"Unsupported bulk operation {type(request).__name__}")
+            counts['matched_count'] += result.matched_count
+            counts['modified_count'] += result.modified_count
+            counts['upserted_count'] += int(result.upserted_id is not None)
+        return SimpleNamespace(**counts, acknowledged=True)
+
+    def aggregate(self, pipeline: List[Dict[str, Any]], **kwargs) -> MemoryAggregationCursor:
+        def run():
+            # Lead with $match so the indexes narrow the input
+            docs = self.select(pipeline[0]['$match']) if pipeline and '$match' in pipeline[0] else self.documents()
+            stages = pipeline[1:] if pipeline and '$match' in pipeline[0] else pipeline
+            return run_stages([copy.deepcopy(d) for d in docs], stages, self.database, {})
+        return MemoryAggregationCursor(run)
+
+    async def create_index(self, keys: Any, unique: bool = False, **kwargs) -> str:
+        fields = [(keys, 1)] if isinstance(keys, str) else list(keys)
+        field = fields[0][0]
+        if field not in self.indexes:
+            self.indexes[field] = {}
+            for key, doc in self.docs.items():
+                for index_key in self.index_keys(doc, field):
+                    self.indexes[field].setdefault(index_key, set()).add(key)
+        if unique and len(fields) == 1:
+            self.unique.add(field)
+        return kwargs.get('name') or '_'.join(f"{f}_{d}" for f, d in fields)
+
+    async def drop(self):
+        self.database.collections.pop(self.name, None)
+
+
+# Databases
+class MemoryDatabase:
+    def __init__(self, client: 'MemoryClient', name: str):
+        self.client = client
+        self.name = name
+        self.collections: Dict[str, MemoryCollection] = {}
+
+    def __getitem__(self, name: str) -> MemoryCollection:
+        if name not in self.collections:
+            self.collections[name] = MemoryCollection(self, name)
+        return self.collections[name]
+
+    def __getattr__(self, name: str) -> MemoryCollection:
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def get_collection(self, name: str, **options) -> MemoryCollection:
+        # Read preferences, read concerns and write concerns don't apply in memory
+        return self[name]
+
+    async def list_collection_names(self, filter: Optional[Dict[str, Any]] = None, **kwargs) -> List[str]:
+        return [name for name in self.collections if matches({"name": name}, filter)]
+
+    async def create_collection(self, name: str, **options) -> MemoryCollection:
+        if name in self.collections:
+            raise OperationFailure(f"Collection {name} already exists")
+        return self[name]
+
+    async def drop_collection(self, name: str):
+        self.collections.pop(name, None)
+
+    async def command(self, command: Any, **kwargs) -> Dict[str, Any]:
+        name = command if isinstance(command, str) else next(iter(command))
+        if name == 'ping':
+            return {"ok": 1.0}
+        raise OperationFailure(f"Unsupported command {name}")
+
+class MemoryClient:
+    """Stands in for AsyncIOMotorClient."""
+    def __init__(self):
+        self.databases: Dict[str, MemoryDatabase] = {}
+
+    def __getitem__(self, name: str) -> MemoryDatabase:
+        if name not in self.databases:
+            self.databases[name] = MemoryDatabase(self, name)
+        return self.databases[name]
+
+    def get_database(self, name: str, **options) -> MemoryDatabase:
+        return self[name]
+
+    @property
+    def admin(self) -> MemoryDatabase:
+        return self['admin']
+
+    def close(self):
+        pass
@@ -0,0 +1,39 @@
+"""Rebuild precomputed rollups and the search index from the raw collections.
+
+Usage: python rebuild_rollups.py attendance academic search
+
+Run after bulk corrections or to backfill rollups for existing data.
+"""
+import argparse
+import asyncio
+import sys
+
+from server import close_client, rebuild_academic_summaries, rebuild_attendance_rollups, rebuild_search_index
+
+REBUILDERS = {
+    'academic': rebuild_academic_summaries,
+    'attendance': rebuild_attendance_rollups,
+    'search': rebuild_search_index,
+}
+
+
+async def run(targets) -> int:
+    try:
+        for target in targets:
+            print(f"Rebuilding {target}...")
+            await REBUILDERS[target]()
+    finally:
+        close_client()
+    print("Done")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild precomputed rollups")
+    parser.add_argument('targets', nargs='+', choices=sorted(REBUILDERS))
+    args = parser.parse_args()
+    return asyncio.run(run(args.targets))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
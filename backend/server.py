@@ -1,38 +1,320 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Query, Request, UploadFile, File, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from memory_store import MemoryClient
+from pymongo import ReturnDocument, ReplaceOne, UpdateOne
+from pymongo.errors import DuplicateKeyError, ExecutionTimeout, PyMongoError
+from pymongo import monitoring
+from pymongo.read_concern import ReadConcern
+from pymongo.read_preferences import Primary, PrimaryPreferred, Secondary, SecondaryPreferred, Nearest
+from pymongo.write_concern import WriteConcern
+import pymongo
 import os
 import logging
+import logging.handlers
+import queue
+import random
 from pathlib import Path
-from pydantic import BaseModel, Field, ConfigDict, EmailStr
-from typing import List, Optional, Dict, Any
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field, ConfigDict, EmailStr, TypeAdapter, ValidationError, create_model
+from typing import List, Optional, Dict, Any, Set, Tuple, Type, Iterable, AsyncIterator
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import asyncio
+import heapq
+import itertools
+import csv
+import io
+import json
+import hashlib
+import html
+import importlib.util
+import shutil
+import zlib
 import uuid
+import math
+import contextvars
+from contextlib import asynccontextmanager
+import re
+import unicodedata
+from urllib.parse import urlsplit
+import time
 from datetime import datetime, timezone, timedelta
 import bcrypt
 import jwt
+import numpy as np
 from enum import Enum
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+# Request logging: records go through a queue to a listener thread that formats and
+# writes them; access logs for fast successful requests are sampled
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+ACCESS_LOG_SAMPLE_RATE = float(os.environ.get('ACCESS_LOG_SAMPLE_RATE', '0.1'))
+ACCESS_LOG_SLOW_MS = float(os.environ.get('ACCESS_LOG_SLOW_MS', '1000'))
+MONGO_SLOW_COMMAND_MS = float(os.environ.get('MONGO_SLOW_COMMAND_MS', '200'))
+
+# Per-request log context: request id, principal and Mongo command totals. Motor runs
+# commands with a copy of the caller's context, so the command listener sees it too.
+request_log: contextvars.ContextVar[Optional[Dict[str, Any]]] = contextvars.ContextVar('request_log', default=None)
+
+class MongoCommandLogger(monitoring.CommandListener):
+    def started(self, event):
+        pass
+    
+    def succeeded(self, event):
+        self.record(event, "succeeded")
+    
+    def failed(self, event):
+        self.record(event, "failed")
+    
+    def record(self, event, outcome: str):
+        duration_ms = event.duration_micros / 1000
+        entry = request_log.get()
+        if entry is not None:
+            entry['mongo_calls'] += 1
+            entry['mongo_ms'] += duration_ms
+        if duration_ms >= MONGO_SLOW_COMMAND_MS or outcome == "failed":
+            logging.getLogger("mongo").warning("Slow or failed Mongo command", extra={"fields": {
+                "command": event.command_name,
+                "database": event.database_name,
+                "outcome": outcome,
+                "duration_ms": round(duration_ms, 1)
+            }})
+
+# MongoDB connection pool
+MONGO_MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE', '100'))
+MONGO_MIN_POOL_SIZE = int(os.environ.get('MONGO_MIN_POOL_SIZE', '0'))
+MONGO_MAX_IDLE_TIME_MS = int(os.environ.get('MONGO_MAX_IDLE_TIME_MS', '300000'))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', '2000'))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', '5000'))
+# Comma-separated, in order of preference: zstd needs the zstandard package, snappy python-snappy
+MONGO_COMPRESSORS = os.environ.get('MONGO_COMPRESSORS', '')
+# Connections opened during warm-up, before the worker reports ready
+MONGO_WARM_CONNECTIONS = int(os.environ.get('MONGO_WARM_CONNECTIONS', '10'))
+READINESS_PING_TIMEOUT_SECONDS = float(os.environ.get('READINESS_PING_TIMEOUT_SECONDS', '1'))
+
+# Read/write routing: which routes may read from secondaries, and how stale they may be
+LIST_READ_PREFERENCE = os.environ.get('LIST_READ_PREFERENCE', 'primary')
+LIST_READ_CONCERN = os.environ.get('LIST_READ_CONCERN', 'local')
+ANALYTICS_READ_PREFERENCE = os.environ.get('ANALYTICS_READ_PREFERENCE', 'secondaryPreferred')
+ANALYTICS_READ_CONCERN = os.environ.get('ANALYTICS_READ_CONCERN', 'local')
+READ_MAX_STALENESS_SECONDS = int(os.environ.get('READ_MAX_STALENESS_SECONDS', '-1'))
+NOTIFICATION_WRITE_CONCERN = os.environ.get('NOTIFICATION_WRITE_CONCERN', '1')
+
+def read_preference(mode: str):
+    modes = {
+        "primaryPreferred": PrimaryPreferred,
+        "secondary": Secondary,
+        "secondaryPreferred": SecondaryPreferred,
+        "nearest": Nearest
+    }
+    if mode == "primary":
+        return Primary()
+    return modes[mode](max_staleness=READ_MAX_STALENESS_SECONDS)
+
+def write_concern(w: str) -> WriteConcern:
+    return WriteConcern(w=int(w) if w.isdigit() else w)
+
+# Collection options per profile. Routes not listed in ROUTE_DB_PROFILES use "primary",
+# which keeps the client defaults: auth, enrollment and every write stay on the primary.
+DB_PROFILES: Dict[str, Dict[str, Any]] = {
+    "primary": {},
+    "lists": {"read_preference": read_preference(LIST_READ_PREFERENCE), "read_concern": ReadConcern(LIST_READ_CONCERN)},
+    "analytics": {"read_preference": read_preference(ANALYTICS_READ_PREFERENCE), "read_concern": ReadConcern(ANALYTICS_READ_CONCERN)}
+}
+ROUTE_DB_PROFILES: Dict[str, str] = {
+    "GET /api/users": "lists",
+    "GET /api/departments": "lists",
+    "GET /api/students": "lists",
+    "GET /api/teachers": "lists",
+    "GET /api/courses": "lists",
+    "GET /api/courses/{course_id}": "lists",
+    "GET /api/courses/{course_id}/roster": "lists",
+    "GET /api/exams": "lists",
+    "GET /api/grades": "lists",
+    "GET /api/attendance": "lists",
+    "GET /api/schedules": "lists",
+    "GET /api/search": "lists",
+    "GET /api/analytics/courses/{course_id}/grades": "analytics",
+    "GET /api/analytics/departments/{department_id}/grades": "analytics",
+    "GET /api/analytics/courses/{course_id}/attendance": "analytics",
+    "GET /api/analytics/departments/{department_id}/attendance": "analytics",
+    "GET /api/attendance/rollups/courses/{course_id}": "analytics",
+    "GET /api/attendance/rollups/students/{student_id}": "analytics",
+    "GET /api/export/{collection}": "analytics"
+}
+# Write concerns that apply to a collection whichever route writes to it
+COLLECTION_WRITE_CONCERNS: Dict[str, WriteConcern] = {
+    "notifications": write_concern(NOTIFICATION_WRITE_CONCERN)
+}
+
+db_profile: contextvars.ContextVar[str] = contextvars.ContextVar('db_profile', default="primary")
+
+class RoutedDatabase:
+    """Hands out collections configured for the current route's profile.
+    
+    The underlying database handle is opened on first use, not at import.
+    """
+    def __init__(self, connect):
+        self.connect = connect
+        self.handle = None
+        self.collections: Dict[Tuple[str, str], Any] = {}
+    
+    @property
+    def database(self):
+        if self.handle is None:
+            self.handle = self.connect()
+        return self.handle
+    
+    def reset(self):
+        self.handle = None
+        self.collections.clear()
+    
+    def __getitem__(self, name: str):
+        profile = db_profile.get()
+        collection = self.collections.get((name, profile))
+        if collection is None:
+            options = dict(DB_PROFILES[profile])
+            if name in COLLECTION_WRITE_CONCERNS:
+                options['write_concern'] = COLLECTION_WRITE_CONCERNS[name]
+            collection = self.collections[(name, profile)] = self.database.get_collection(name, **options)
+        return collection
+    
+    def __getattr__(self, name: str):
+        # Database methods (list_collection_names, create_collection, ...) pass through
+        if hasattr(type(self.database), name):
+            return getattr(self.database, name)
+        return self[name]
+
+async def select_db_profile(request: Request):
+    route = request.scope.get("route")
+    if route is not None:
+        db_profile.set(ROUTE_DB_PROFILES.get(f"{request.method} {route.path}", "primary"))
+
+# MongoDB connection, created on first use. STORAGE_ENGINE=memory swaps in the
+# in-process engine from memory_store for tests and benchmarks.
+STORAGE_ENGINE = os.environ.get('STORAGE_ENGINE', 'motor')
+client: Optional[AsyncIOMotorClient] = None
+
+def get_client() -> AsyncIOMotorClient:
+    global client
+    if client is None and STORAGE_ENGINE == 'memory':
+        client = MemoryClient()
+    elif client is None:
+        client = AsyncIOMotorClient(
+            os.environ['MONGO_URL'],
+            maxPoolSize=MONGO_MAX_POOL_SIZE,
+            minPoolSize=MONGO_MIN_POOL_SIZE,
+            maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+            waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+            serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+            compressors=[c.strip() for c in MONGO_COMPRESSORS.split(',') if c.strip()],
+            event_listeners=[MongoCommandLogger()]
+        )
+    return client
+
+def close_client():
+    global client
+    if client is not None:
+        client.close()
+        client = None
+    db.reset()
+
+db = RoutedDatabase(lambda: get_client()[os.environ['DB_NAME']])
 
 # JWT Configuration
 JWT_SECRET = os.environ.get('JWT_SECRET', 'your-secret-key-change-in-production')
 JWT_ALGORITHM = 'HS256'
 JWT_EXPIRATION_HOURS = 24
 
+# Stateless auth: short-lived access tokens carry the principal, refresh tokens rotate them
+AUTH_STATELESS = os.environ.get('AUTH_STATELESS', 'false').lower() == 'true'
+ACCESS_TOKEN_EXPIRATION_MINUTES = int(os.environ.get('ACCESS_TOKEN_EXPIRATION_MINUTES', '15'))
+REFRESH_TOKEN_EXPIRATION_DAYS = int(os.environ.get('REFRESH_TOKEN_EXPIRATION_DAYS', '7'))
+
+# Login throttling: token buckets per IP and per email, exponential backoff per email
+LOGIN_THROTTLE_BACKEND = os.environ.get('LOGIN_THROTTLE_BACKEND', 'memory')
+LOGIN_IP_BURST = int(os.environ.get('LOGIN_IP_BURST', '20'))
+LOGIN_IP_PER_MINUTE = float(os.environ.get('LOGIN_IP_PER_MINUTE', '10'))
+LOGIN_EMAIL_BURST = int(os.environ.get('LOGIN_EMAIL_BURST', '5'))
+LOGIN_EMAIL_PER_MINUTE = float(os.environ.get('LOGIN_EMAIL_PER_MINUTE', '5'))
+LOGIN_BACKOFF_AFTER_FAILURES = int(os.environ.get('LOGIN_BACKOFF_AFTER_FAILURES', '3'))
+LOGIN_BACKOFF_BASE_SECONDS = float(os.environ.get('LOGIN_BACKOFF_BASE_SECONDS', '1'))
+LOGIN_BACKOFF_MAX_SECONDS = float(os.environ.get('LOGIN_BACKOFF_MAX_SECONDS', '900'))
+# Behind the bundled nginx the peer address is the proxy and X-Real-IP carries the client.
+# Only enable it when the backend can't be reached except through nginx: a direct
+# client could otherwise rotate the header to dodge the per-IP bucket.
+TRUST_PROXY_HEADERS = os.environ.get('TRUST_PROXY_HEADERS', 'false').lower() == 'true'
+
+# Bulk import
+IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', '1000'))
+IMPORT_HASH_WORKERS = int(os.environ.get('IMPORT_HASH_WORKERS', str(os.cpu_count() or 2)))
+
+# Report card jobs: rendered on a process pool, archived under REPORT_ARTIFACT_DIR
+REPORT_ARTIFACT_DIR = Path(os.environ.get('REPORT_ARTIFACT_DIR', str(ROOT_DIR / 'artifacts')))
+REPORT_WORKERS = int(os.environ.get('REPORT_WORKERS', str(os.cpu_count() or 2)))
+REPORT_CHUNK_SIZE = int(os.environ.get('REPORT_CHUNK_SIZE', '100'))
+
+# Incremental sync
+SYNC_PAGE_SIZE = int(os.environ.get('SYNC_PAGE_SIZE', '1000'))
+# Sequence numbers are reserved before the write lands, so cursors only move past
+# changes stamped at least this long ago. Keep it above the longest request deadline.
+SYNC_SETTLE_SECONDS = float(os.environ.get('SYNC_SETTLE_SECONDS', '60'))
+SYNCED_COLLECTIONS = ("users", "departments", "students", "teachers", "courses", "enrollments",
+                      "exams", "grades", "attendance", "notifications", "schedules")
+
+# A course counts towards credits earned once its average reaches this percentage
+COURSE_PASS_MARK = float(os.environ.get('COURSE_PASS_MARK', '50'))
+
+# Academic-year archival
+ACADEMIC_YEAR_START_MONTH = int(os.environ.get('ACADEMIC_YEAR_START_MONTH', '9'))
+ARCHIVE_COMPRESSOR = os.environ.get('ARCHIVE_COMPRESSOR', 'zstd')
+ARCHIVE_DELETE_BATCH_SIZE = int(os.environ.get('ARCHIVE_DELETE_BATCH_SIZE', '1000'))
+
+# Search
+SEARCH_MAX_PREFIX = 15
+SEARCH_MIN_SIMILARITY = float(os.environ.get('SEARCH_MIN_SIMILARITY', '0.4'))
+
+# Grade analytics: cached per process, bounded because pass_mark is free-form
+GRADE_ANALYTICS_CACHE_SIZE = int(os.environ.get('GRADE_ANALYTICS_CACHE_SIZE', '1000'))
+
+# Personal timetables: cached per user, served with ETags
+TIMETABLE_CACHE_SIZE = int(os.environ.get('TIMETABLE_CACHE_SIZE', '10000'))
+
+# Batch requests
+BATCH_MAX_REQUESTS = int(os.environ.get('BATCH_MAX_REQUESTS', '20'))
+
+# Streaming export
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', '5000'))
+EXPORT_CHUNK_BYTES = int(os.environ.get('EXPORT_CHUNK_BYTES', '65536'))
+
+# Admission control: per-worker concurrency limit, queue budget and request deadlines
+ADMISSION_MAX_CONCURRENCY = int(os.environ.get('ADMISSION_MAX_CONCURRENCY', '64'))
+ADMISSION_MAX_QUEUE = int(os.environ.get('ADMISSION_MAX_QUEUE', '256'))
+ADMISSION_QUEUE_BUDGET_SECONDS = float(os.environ.get('ADMISSION_QUEUE_BUDGET_SECONDS', '1'))
+ADMISSION_RETRY_AFTER_SECONDS = int(os.environ.get('ADMISSION_RETRY_AFTER_SECONDS', '2'))
+REQUEST_DEADLINE_SECONDS = float(os.environ.get('REQUEST_DEADLINE_SECONDS', '10'))
+BULK_REQUEST_DEADLINE_SECONDS = float(os.environ.get('BULK_REQUEST_DEADLINE_SECONDS', '60'))
+
+# At-risk attendance thresholds (overridable per request)
+ATTENDANCE_MIN_RATE = float(os.environ.get('ATTENDANCE_MIN_RATE', '75'))
+ATTENDANCE_MAX_ABSENCE_STREAK = int(os.environ.get('ATTENDANCE_MAX_ABSENCE_STREAK', '3'))
+ATTENDANCE_MAX_LATE_RATIO = float(os.environ.get('ATTENDANCE_MAX_LATE_RATIO', '0.3'))
+
 security = HTTPBearer()
 
-# Create the main app
-app = FastAPI(title="Campus Manager API")
+# Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
+DATE_PATTERN = r'^\d{4}-\d{2}-\d{2}$'
+ACADEMIC_YEAR_PATTERN = r'^\d{4}-\d{4}$'
+
 # Enums
 class UserRole(str, Enum):
     ADMIN = "admin"
@@ -50,6 +332,19 @@ class AttendanceStatus(str, Enum):
     LATE = "late"
     EXCUSED = "excused"
 
+class ExportCollection(str, Enum):
+    GRADES = "grades"
+    ATTENDANCE = "attendance"
+
+class ExportFormat(str, Enum):
+    CSV = "csv"
+    NDJSON = "ndjson"
+
+class ReportFormat(str, Enum):
+    HTML = "html"
+    CSV = "csv"
+    PDF = "pdf"
+
 # Pydantic Models
 class UserCreate(BaseModel):
     email: EmailStr
@@ -78,6 +373,10 @@ class User(BaseModel):
 class TokenResponse(BaseModel):
     token: str
     user: User
+    refresh_token: Optional[str] = None
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
 
 class DepartmentCreate(BaseModel):
     name: str
@@ -166,6 +465,18 @@ class Enrollment(BaseModel):
     status: EnrollmentStatus = EnrollmentStatus.PENDING
     enrolled_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+class RosterEntry(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    enrollment_id: str
+    student_id: str
+    student_number: Optional[str] = None
+    user_id: Optional[str] = None
+    first_name: Optional[str] = None
+    last_name: Optional[str] = None
+    email: Optional[str] = None
+    status: EnrollmentStatus
+    enrolled_at: datetime
+
 class ExamCreate(BaseModel):
     course_id: str
     name: str
@@ -228,6 +539,33 @@ class Attendance(BaseModel):
     marked_by: Optional[str] = None
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+class StudentImportRow(BaseModel):
+    email: EmailStr
+    password: str
+    first_name: str
+    last_name: str
+    phone: Optional[str] = None
+    student_number: str
+    department_id: str
+    academic_year: str
+    date_of_birth: str
+    address: Optional[str] = None
+    emergency_contact: Optional[str] = None
+
+class BatchItem(BaseModel):
+    id: Optional[str] = None
+    method: str = "GET"
+    path: str
+
+class BatchRequest(BaseModel):
+    requests: List[BatchItem] = Field(min_length=1, max_length=BATCH_MAX_REQUESTS)
+
+class ReportJobCreate(BaseModel):
+    department_id: str
+    semester: int
+    academic_year: Optional[str] = Field(None, pattern=ACADEMIC_YEAR_PATTERN)
+    formats: List[ReportFormat] = Field(default_factory=lambda: [ReportFormat.HTML], min_length=1)
+
 class NotificationCreate(BaseModel):
     user_id: str
     title: str
@@ -285,12 +623,110 @@ def decode_token(token: str) -> Dict[str, Any]:
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
+def create_access_token(user: Dict[str, Any]) -> str:
+    expiration = datetime.now(timezone.utc) + timedelta(minutes=ACCESS_TOKEN_EXPIRATION_MINUTES)
+    payload = {
+        'type': 'access',
+        'user_id': user['id'],
+        'role': user['role'],
+        'email': user['email'],
+        'first_name': user['first_name'],
+        'last_name': user['last_name'],
+        'is_active': user.get('is_active', True),
+        'ver': user.get('token_version', 0),
+        'exp': expiration
+    }
+    return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
+
+def create_calendar_token(user: Dict[str, Any]) -> str:
+    # Long-lived and read-only: calendar apps can't refresh, so there is no exp. The feed
+    # checks token_version and is_active in db.users on every fetch instead.
+    payload = {
+        'type': 'calendar',
+        'user_id': user['id'],
+        'role': user['role'],
+        'ver': user.get('token_version', 0)
+    }
+    return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
+
+def create_refresh_token(user: Dict[str, Any]) -> str:
+    expiration = datetime.now(timezone.utc) + timedelta(days=REFRESH_TOKEN_EXPIRATION_DAYS)
+    payload = {
+        'type': 'refresh',
+        'user_id': user['id'],
+        'ver': user.get('token_version', 0),
+        'jti': str(uuid.uuid4()),
+        'exp': expiration
+    }
+    return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
+
+async def consume_refresh_token(payload: Dict[str, Any]) -> bool:
+    # Each refresh token rotates exactly once. The jti is recorded until the token
+    # itself would expire (TTL index on expires_at); False means it was already used.
+    try:
+        result = await db.used_refresh_tokens.update_one(
+            {"jti": payload['jti']},
+            {"$setOnInsert": {
+                "jti": payload['jti'],
+                "user_id": payload['user_id'],
+                "expires_at": datetime.fromtimestamp(payload['exp'], timezone.utc)
+            }},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        return False
+    return result.upserted_id is not None
+
+# user_id -> (minimum valid token_version, revoked at). Entries only need to outlive
+# the access tokens they reject; refresh always re-checks token_version in the database.
+revoked_token_versions: Dict[str, Tuple[int, datetime]] = {}
+
+def revoke_tokens(user_id: str, token_version: int):
+    now = datetime.now(timezone.utc)
+    cutoff = now - timedelta(minutes=ACCESS_TOKEN_EXPIRATION_MINUTES)
+    for stale in [uid for uid, (_, revoked_at) in revoked_token_versions.items() if revoked_at < cutoff]:
+        del revoked_token_versions[stale]
+    revoked_token_versions[user_id] = (token_version, now)
+
+def is_revoked(user_id: str, token_version: int) -> bool:
+    revoked = revoked_token_versions.get(user_id)
+    return revoked is not None and token_version < revoked[0]
+
+# Principal already authenticated by POST /api/batch for the sub-requests it dispatches
+batch_principal: contextvars.ContextVar[Optional[Dict[str, Any]]] = contextvars.ContextVar('batch_principal', default=None)
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> Dict[str, Any]:
+    principal = batch_principal.get()
+    if principal is not None:
+        return principal
     token = credentials.credentials
     payload = decode_token(token)
-    user = await db.users.find_one({"id": payload['user_id']}, {"_id": 0})
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
+    token_type = payload.get('type')
+    if token_type in ('refresh', 'calendar'):
+        raise HTTPException(status_code=401, detail="Invalid token")
+    
+    if token_type == 'access':
+        if is_revoked(payload['user_id'], payload.get('ver', 0)):
+            raise HTTPException(status_code=401, detail="Token revoked")
+        if not payload.get('is_active', True):
+            raise HTTPException(status_code=401, detail="Account is inactive")
+        user = {
+            "id": payload['user_id'],
+            "role": payload['role'],
+            "email": payload['email'],
+            "first_name": payload['first_name'],
+            "last_name": payload['last_name'],
+            "is_active": payload.get('is_active', True)
+        }
+    else:
+        user = await db.users.find_one({"id": payload['user_id']}, {"_id": 0})
+        if not user:
+            raise HTTPException(status_code=404, detail="User not found")
+    
+    entry = request_log.get()
+    if entry is not None:
+        entry['user_id'] = user['id']
+        entry['role'] = user['role']
     return user
 
 def require_role(roles: List[UserRole]):
@@ -300,6 +736,421 @@ def require_role(roles: List[UserRole]):
         return current_user
     return role_checker
 
+# Login Throttling
+def login_backoff_seconds(failures: int) -> float:
+    if failures < LOGIN_BACKOFF_AFTER_FAILURES:
+        return 0.0
+    return min(LOGIN_BACKOFF_MAX_SECONDS, LOGIN_BACKOFF_BASE_SECONDS * 2 ** (failures - LOGIN_BACKOFF_AFTER_FAILURES))
+
+class MemoryThrottleStore:
+    """Token buckets and failure counters local to this worker.
+    
+    Each limiter (capacity, rate) gets its own bucket map so pruning uses that
+    limiter's refill rate. Failure counters expire LOGIN_BACKOFF_MAX_SECONDS after
+    the last failure, like the TTL on the Mongo store.
+    """
+    max_keys = 100_000
+    
+    def __init__(self):
+        self.buckets: Dict[Tuple[int, float], Dict[str, Tuple[float, float]]] = {}
+        # key -> (failures, blocked_until, expires_at)
+        self.failures: Dict[str, Tuple[int, float, float]] = {}
+    
+    async def take(self, key: str, capacity: int, per_second: float) -> float:
+        """Consume one token; return 0 when allowed, else seconds until a token is available."""
+        now = time.time()
+        buckets = self.buckets.setdefault((capacity, per_second), {})
+        tokens, updated_at = buckets.pop(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated_at) * per_second)
+        # Re-inserted on every use so the map stays ordered by last use
+        if tokens < 1:
+            buckets[key] = (tokens, now)
+            return (1 - tokens) / per_second
+        buckets[key] = (tokens - 1, now)
+        if len(buckets) > self.max_keys:
+            self.prune_buckets(buckets, now, capacity, per_second)
+        return 0.0
+    
+    def failure_entry(self, key: str) -> Optional[Tuple[int, float, float]]:
+        entry = self.failures.get(key)
+        if entry is not None and entry[2] <= time.time():
+            del self.failures[key]
+            return None
+        return entry
+    
+    async def blocked_for(self, key: str) -> float:
+        entry = self.failure_entry(key)
+        return max(0.0, entry[1] - time.time()) if entry else 0.0
+    
+    async def record_failure(self, key: str) -> int:
+        now = time.time()
+        entry = self.failure_entry(key)
+        failures = (entry[0] if entry else 0) + 1
+        self.failures.pop(key, None)
+        self.failures[key] = (failures, now + login_backoff_seconds(failures), now + LOGIN_BACKOFF_MAX_SECONDS)
+        if len(self.failures) > self.max_keys:
+            self.prune_failures(now)
+        return failures
+    
+    async def reset(self, key: str):
+        self.failures.pop(key, None)
+    
+    def prune_buckets(self, buckets: Dict[str, Tuple[float, float]], now: float, capacity: int, per_second: float):
+        # Buckets that have refilled completely carry no state worth keeping
+        for key in [k for k, (tokens, updated_at) in buckets.items()
+                    if tokens + (now - updated_at) * per_second >= capacity]:
+            del buckets[key]
+        # Still full: drop the least recently used
+        for key in list(itertools.islice(buckets, max(0, len(buckets) - self.max_keys))):
+            del buckets[key]
+    
+    def prune_failures(self, now: float):
+        for key in [k for k, (_, _, expires_at) in self.failures.items() if expires_at <= now]:
+            del self.failures[key]
+        for key in list(itertools.islice(self.failures, max(0, len(self.failures) - self.max_keys))):
+            del self.failures[key]
+
+class MongoThrottleStore:
+    """Token buckets and failure counters shared by every worker through MongoDB."""
+    
+    def __init__(self, collection_name: str):
+        self.collection_name = collection_name
+    
+    @property
+    def collection(self):
+        # Looked up per call: holding the handle would open a client at import and
+        # keep using it after close_client()
+        return db[self.collection_name]
+    
+    def expires_at(self) -> datetime:
+        return datetime.now(timezone.utc) + timedelta(seconds=LOGIN_BACKOFF_MAX_SECONDS)
+    
+    async def take(self, key: str, capacity: int, per_second: float) -> float:
+        now = time.time()
+        refilled = {"$min": [capacity, {"$add": [
+            {"$ifNull": ["$tokens", capacity]},
+            {"$multiply": [{"$subtract": [now, {"$ifNull": ["$updated_at", now]}]}, per_second]}
+        ]}]}
+        # Refill and conditionally consume in one atomic pipeline update
+        doc = await self.collection.find_one_and_update(
+            {"_id": key},
+            [
+                {"$set": {"tokens": refilled, "updated_at": now, "expires_at": self.expires_at()}},
+                {"$set": {
+                    "allowed": {"$gte": ["$tokens", 1]},
+                    "tokens": {"$cond": [{"$gte": ["$tokens", 1]}, {"$subtract": ["$tokens", 1]}, "$tokens"]}
+                }}
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return 0.0 if doc['allowed'] else (1 - doc['tokens']) / per_second
+    
+    async def blocked_for(self, key: str) -> float:
+        doc = await self.collection.find_one({"_id": key}, {"blocked_until": 1})
+        return max(0.0, doc.get('blocked_until', 0.0) - time.time()) if doc else 0.0
+    
+    async def record_failure(self, key: str) -> int:
+        doc = await self.collection.find_one_and_update(
+            {"_id": key},
+            {"$inc": {"failures": 1}, "$set": {"expires_at": self.expires_at()}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        await self.collection.update_one(
+            {"_id": key},
+            {"$set": {"blocked_until": time.time() + login_backoff_seconds(doc['failures'])}}
+        )
+        return doc['failures']
+    
+    async def reset(self, key: str):
+        await self.collection.delete_one({"_id": key})
+
+class LoginThrottle:
+    def __init__(self, store):
+        self.store = store
+        self.metrics = {
+            "attempts": 0,
+            "throttled_ip": 0,
+            "throttled_email": 0,
+            "backoff_rejections": 0,
+            "failures": 0
+        }
+    
+    async def check(self, ip: str, email: str) -> float:
+        """Return 0 if the attempt may proceed, else the number of seconds to wait."""
+        self.metrics['attempts'] += 1
+        wait = await self.store.blocked_for(f"fail:{email}")
+        if wait > 0:
+            self.metrics['backoff_rejections'] += 1
+            return wait
+        wait = await self.store.take(f"ip:{ip}", LOGIN_IP_BURST, LOGIN_IP_PER_MINUTE / 60)
+        if wait > 0:
+            self.metrics['throttled_ip'] += 1
+            return wait
+        wait = await self.store.take(f"email:{email}", LOGIN_EMAIL_BURST, LOGIN_EMAIL_PER_MINUTE / 60)
+        if wait > 0:
+            self.metrics['throttled_email'] += 1
+        return wait
+    
+    async def failure(self, email: str):
+        self.metrics['failures'] += 1
+        await self.store.record_failure(f"fail:{email}")
+    
+    async def success(self, email: str):
+        await self.store.reset(f"fail:{email}")
+
+login_throttle = LoginThrottle(
+    MongoThrottleStore("login_throttle") if LOGIN_THROTTLE_BACKEND == 'mongo' else MemoryThrottleStore()
+)
+
+def client_ip(request: Request) -> str:
+    if TRUST_PROXY_HEADERS and request.headers.get('x-real-ip'):
+        return request.headers['x-real-ip']
+    return request.client.host if request.client else "unknown"
+
+# Change tracking
+async def next_change_seq(count: int = 1) -> int:
+    """Reserve `count` change sequence numbers and return the highest."""
+    counter = await db.counters.find_one_and_update(
+        {"_id": "changes"},
+        {"$inc": {"seq": count}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return counter['seq']
+
+async def change_stamp() -> Dict[str, Any]:
+    return {"seq": await next_change_seq(), "updated_at": datetime.now(timezone.utc).isoformat()}
+
+async def stamp_changes(docs: List[Dict[str, Any]]):
+    last = await next_change_seq(len(docs))
+    now = datetime.now(timezone.utc).isoformat()
+    for offset, doc in enumerate(docs):
+        doc['seq'] = last - len(docs) + 1 + offset
+        doc['updated_at'] = now
+
+async def record_removals(collection: str, ids: List[str]):
+    """Leave tombstones so ?since= clients learn about documents that went away."""
+    if not ids:
+        return
+    now = datetime.now(timezone.utc).isoformat()
+    tombstones = [{"collection": collection, "id": doc_id, "deleted_at": now} for doc_id in ids]
+    await stamp_changes(tombstones)
+    await db.tombstones.insert_many(tombstones)
+
+# Sparse fieldsets
+def parse_fields(model: Type[BaseModel], fields: Optional[str]) -> Optional[Tuple[str, ...]]:
+    """Validate a comma-separated ?fields= value against the model's fields."""
+    if not fields:
+        return None
+    selected = tuple(dict.fromkeys(f.strip() for f in fields.split(',') if f.strip()))
+    unknown = [f for f in selected if f not in model.model_fields]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    return selected or None
+
+def field_projection(selected: Optional[Tuple[str, ...]], default: Optional[Dict[str, int]] = None) -> Dict[str, int]:
+    if not selected:
+        return default or {"_id": 0}
+    projection = {"_id": 0}
+    projection.update({f: 1 for f in selected})
+    return projection
+
+@lru_cache(maxsize=256)
+def sparse_adapter(model: Type[BaseModel], selected: Tuple[str, ...]) -> TypeAdapter:
+    trimmed = create_model(
+        f"{model.__name__}Fields",
+        __config__=ConfigDict(extra="ignore"),
+        **{name: (Optional[model.model_fields[name].annotation], None) for name in selected}
+    )
+    return TypeAdapter(List[trimmed])
+
+def sparse_response(model: Type[BaseModel], selected: Tuple[str, ...], docs: List[Dict[str, Any]]) -> Response:
+    adapter = sparse_adapter(model, selected)
+    return Response(content=adapter.dump_json(adapter.validate_python(docs)), media_type="application/json")
+
+@lru_cache(maxsize=64)
+def list_adapter(model: Type[BaseModel]) -> TypeAdapter:
+    return TypeAdapter(List[model])
+
+async def stamp_legacy_changes():
+    """Give documents written before change tracking a sequence number.
+    
+    sync_changes pages by seq, so unstamped documents would all sort as 0 and a
+    full page of them could never move the cursor.
+    """
+    for collection in SYNCED_COLLECTIONS:
+        while True:
+            docs = await db[collection].find({"seq": {"$exists": False}}, {"_id": 1}).to_list(1000)
+            if not docs:
+                break
+            last = await next_change_seq(len(docs))
+            now = datetime.now(timezone.utc).isoformat()
+            await db[collection].bulk_write([
+                UpdateOne({"_id": doc['_id'], "seq": {"$exists": False}},
+                          {"$set": {"seq": last - len(docs) + 1 + offset, "updated_at": now}})
+                for offset, doc in enumerate(docs)
+            ], ordered=False)
+
+async def sync_changes(
+    collection: str,
+    model: Type[BaseModel],
+    query: Dict[str, Any],
+    selected: Optional[Tuple[str, ...]],
+    since: int,
+    projection: Optional[Dict[str, int]] = None,
+    filters: Optional[Dict[str, Any]] = None
+) -> Response:
+    """Answer a list route's ?since= request: documents and tombstones newer than `since`.
+    
+    since=0 returns the full list along with the cursor to use next time. Changes
+    stamped within SYNC_SETTLE_SECONDS may come back again on the next pull, since
+    a write holding an earlier sequence number could still be landing; clients
+    apply items by id, so repeats are harmless.
+    
+    `query` scopes what the caller may see; `filters` are the list route's own
+    equality filters. A changed document that no longer matches the filters is
+    reported in `removed` so the client drops it from the filtered list.
+    """
+    filters = filters or {}
+    projection = dict(projection or field_projection(selected))
+    if any(value for key, value in projection.items() if key != '_id'):
+        projection.update({"seq": 1, "updated_at": 1})
+    if since:
+        query = {**query, "seq": {"$gt": since}}
+        if filters and any(value for key, value in projection.items() if key != '_id'):
+            projection.update({"id": 1, **{key: 1 for key in filters}})
+    else:
+        query = {**query, **filters}
+    docs = await db[collection].find(query, projection).sort("seq", 1).to_list(SYNC_PAGE_SIZE)
+    tombstones = []
+    if since:
+        tombstones = await db.tombstones.find(
+            {"collection": collection, "seq": {"$gt": since}}, {"_id": 0, "id": 1, "seq": 1, "updated_at": 1}
+        ).sort("seq", 1).to_list(SYNC_PAGE_SIZE)
+    
+    # A full page means there may be more after its last entry, so the cursor can't go past it
+    bound = math.inf
+    for page in (docs, tombstones):
+        if len(page) == SYNC_PAGE_SIZE:
+            bound = min(bound, page[-1].get('seq') or 0)
+    has_more = bound != math.inf
+    settled_before = (datetime.now(timezone.utc) - timedelta(seconds=SYNC_SETTLE_SECONDS)).isoformat()
+    seq = since
+    for change in itertools.chain(docs, tombstones):
+        change_seq = change.get('seq') or 0
+        if change_seq <= bound and change.get('updated_at', '') <= settled_before:
+            seq = max(seq, change_seq)
+    if has_more and seq == since:
+        # A page made entirely of unsettled changes still has to move the cursor forward
+        seq = bound
+    removed = [t['id'] for t in tombstones if t['seq'] <= bound]
+    items = docs
+    if since and filters:
+        items = [doc for doc in docs if all(doc.get(key) == value for key, value in filters.items())]
+        removed += [doc['id'] for doc in docs if not all(doc.get(key) == value for key, value in filters.items())]
+    adapter = sparse_adapter(model, selected) if selected else list_adapter(model)
+    body = {
+        "seq": seq,
+        "has_more": has_more,
+        "items": adapter.dump_python(adapter.validate_python(items), mode="json"),
+        "removed": removed
+    }
+    return Response(content=json.dumps(body), media_type="application/json")
+
+# Background jobs
+background_jobs: Set[asyncio.Task] = set()
+
+def start_background_job(job, *args):
+    """Run a job after the response without inheriting the request's context.
+    
+    BackgroundTasks run inside the request's ASGI call, so they kept its admission
+    slot, deadline and CSOT budget. A fresh context starts the job with none of them.
+    """
+    task = asyncio.get_running_loop().create_task(job(*args), context=contextvars.Context())
+    background_jobs.add(task)
+    task.add_done_callback(finish_background_job)
+    return task
+
+def finish_background_job(task: asyncio.Task):
+    background_jobs.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Background job failed", exc_info=task.exception())
+
+async def drain_background_jobs():
+    # Let running jobs finish, as uvicorn did when they ran inside the request;
+    # a cancelled archive would be left marked as running
+    await asyncio.gather(*background_jobs, return_exceptions=True)
+
+# Request coalescing
+class SingleFlight:
+    """Concurrent calls with the same key share one execution and its result.
+    
+    Results are not kept once the shared call finishes; caches sit on top of this.
+    The shared call runs in a fresh context, so it carries no caller's deadline, CSOT
+    budget or request log; each caller waits on it for its own remaining deadline.
+    """
+    def __init__(self):
+        self.in_flight: Dict[Tuple, asyncio.Task] = {}
+        self.waiting: Dict[asyncio.Task, int] = {}
+        self.metrics: Dict[str, Dict[str, int]] = {}
+    
+    async def run(self, route: str, key: Tuple, compute):
+        counts = self.metrics.setdefault(route, {"calls": 0, "executions": 0})
+        counts['calls'] += 1
+        flight_key = (route, *key)
+        task = self.in_flight.get(flight_key)
+        if task is None:
+            counts['executions'] += 1
+            task = asyncio.get_running_loop().create_task(compute(), context=contextvars.Context())
+            self.in_flight[flight_key] = task
+            task.add_done_callback(lambda _: self.in_flight.pop(flight_key, None))
+        
+        deadline = request_deadline.get()
+        timeout = None if deadline is None or deadline == math.inf else max(deadline - time.monotonic(), 0)
+        self.waiting[task] = self.waiting.get(task, 0) + 1
+        try:
+            # A caller that times out or disconnects must not cancel the query the others are waiting on
+            return await asyncio.wait_for(asyncio.shield(task), timeout)
+        except asyncio.TimeoutError:
+            raise ExecutionTimeout("Request deadline exceeded waiting for a shared query", 50)
+        finally:
+            self.waiting[task] -= 1
+            if not self.waiting[task]:
+                del self.waiting[task]
+                # Nobody is left to use the result
+                task.cancel()
+    
+    def report(self) -> Dict[str, Any]:
+        def summary(counts: Dict[str, int]) -> Dict[str, Any]:
+            calls, executions = counts['calls'], counts['executions']
+            return {
+                "calls": calls,
+                "executions": executions,
+                "collapsed": calls - executions,
+                "collapse_ratio": round(1 - executions / calls, 4) if calls else 0.0
+            }
+        total = {
+            "calls": sum(c['calls'] for c in self.metrics.values()),
+            "executions": sum(c['executions'] for c in self.metrics.values())
+        }
+        return {
+            **summary(total),
+            "in_flight": len(self.in_flight),
+            "routes": {route: summary(counts) for route, counts in sorted(self.metrics.items())}
+        }
+
+single_flight = SingleFlight()
+
+async def coalesced_json(route: str, key: Tuple, load) -> Response:
+    """Serve a read from one shared query; `load` returns the serialized JSON body."""
+    return Response(content=await single_flight.run(route, key, load), media_type="application/json")
+
+def list_json(model: Type[BaseModel], selected: Optional[Tuple[str, ...]], docs: List[Dict[str, Any]]) -> bytes:
+    adapter = sparse_adapter(model, selected) if selected else list_adapter(model)
+    return adapter.dump_json(adapter.validate_python(docs))
+
 # Auth Routes
 @api_router.post("/auth/register", response_model=User)
 async def register(user_data: UserCreate):
@@ -320,33 +1171,102 @@ async def register(user_data: UserCreate):
     
     doc = user.model_dump()
     doc['password'] = hashed_pw
+    doc['token_version'] = 0
     doc['created_at'] = doc['created_at'].isoformat()
+    doc.update(await change_stamp())
     
     await db.users.insert_one(doc)
+    await index_for_search([user_search_doc(doc)])
     return user
 
 @api_router.post("/auth/login", response_model=TokenResponse)
-async def login(credentials: UserLogin):
+async def login(credentials: UserLogin, request: Request):
+    email = credentials.email.lower()
+    # Reject throttled attempts before any database or bcrypt work
+    wait = await login_throttle.check(client_ip(request), email)
+    if wait > 0:
+        raise HTTPException(
+            status_code=429,
+            detail="Too many login attempts",
+            headers={"Retry-After": str(math.ceil(wait))}
+        )
+    
     user = await db.users.find_one({"email": credentials.email}, {"_id": 0})
-    if not user or not verify_password(credentials.password, user['password']):
+    # bcrypt runs in the threadpool so a burst of attempts can't stall the event loop
+    if not user or not await run_in_threadpool(verify_password, credentials.password, user['password']):
+        await login_throttle.failure(email)
         raise HTTPException(status_code=401, detail="Invalid credentials")
+    await login_throttle.success(email)
     
     if not user.get('is_active', True):
         raise HTTPException(status_code=401, detail="Account is inactive")
     
-    token = create_token(user['id'], user['role'])
     user_obj = User(**user)
+    if AUTH_STATELESS:
+        return TokenResponse(
+            token=create_access_token(user),
+            refresh_token=create_refresh_token(user),
+            user=user_obj
+        )
     
+    token = create_token(user['id'], user['role'])
     return TokenResponse(token=token, user=user_obj)
 
+@api_router.get("/auth/throttle/metrics")
+async def get_login_throttle_metrics(current_user: Dict = Depends(require_role([UserRole.ADMIN]))):
+    return {"backend": LOGIN_THROTTLE_BACKEND, **login_throttle.metrics}
+
+@api_router.post("/auth/refresh", response_model=TokenResponse)
+async def refresh(request: RefreshRequest):
+    payload = decode_token(request.refresh_token)
+    if payload.get('type') != 'refresh':
+        raise HTTPException(status_code=401, detail="Invalid token")
+    
+    user = await db.users.find_one({"id": payload['user_id']}, {"_id": 0, "password": 0})
+    if not user:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    if payload.get('ver', 0) != user.get('token_version', 0) or 'jti' not in payload:
+        raise HTTPException(status_code=401, detail="Token revoked")
+    if not user.get('is_active', True):
+        raise HTTPException(status_code=401, detail="Account is inactive")
+    if not await consume_refresh_token(payload):
+        # A replayed refresh token means it leaked: revoke the whole token family
+        user = await db.users.find_one_and_update(
+            {"id": user['id']},
+            {"$inc": {"token_version": 1}, "$set": await change_stamp()},
+            projection={"_id": 0, "token_version": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if user:
+            revoke_tokens(payload['user_id'], user['token_version'])
+        raise HTTPException(status_code=401, detail="Token reused")
+    
+    return TokenResponse(
+        token=create_access_token(user),
+        refresh_token=create_refresh_token(user),
+        user=User(**user)
+    )
+
 @api_router.get("/auth/me", response_model=User)
 async def get_me(current_user: Dict = Depends(get_current_user)):
-    return User(**current_user)
+    # Legacy tokens already resolved the full document; stateless principals only
+    # carry the claims, so read the profile for those
+    if 'created_at' in current_user:
+        return User(**current_user)
+    user = await db.users.find_one({"id": current_user['id']}, {"_id": 0, "password": 0})
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    return User(**user)
 
 # User Management Routes
 @api_router.get("/users", response_model=List[User])
-async def get_users(current_user: Dict = Depends(require_role([UserRole.ADMIN]))):
-    users = await db.users.find({}, {"_id": 0, "password": 0}).to_list(1000)
+async def get_users(fields: Optional[str] = None, since: Optional[int] = Query(None, ge=0), current_user: Dict = Depends(require_role([UserRole.ADMIN]))):
+    selected = parse_fields(User, fields)
+    if since is not None:
+        return await sync_changes("users", User, {}, selected, since, field_projection(selected, {"_id": 0, "password": 0}))
+    users = await db.users.find({}, field_projection(selected, {"_id": 0, "password": 0})).to_list(1000)
+    if selected:
+        return sparse_response(User, selected, users)
     for user in users:
         if isinstance(user.get('created_at'), str):
             user['created_at'] = datetime.fromisoformat(user['created_at'])
@@ -354,12 +1274,16 @@ async def get_users(current_user: Dict = Depends(require_role([UserRole.ADMIN]))
 
 @api_router.patch("/users/{user_id}/status")
 async def update_user_status(user_id: str, is_active: bool, current_user: Dict = Depends(require_role([UserRole.ADMIN]))):
-    result = await db.users.update_one(
+    # Bumping token_version invalidates outstanding access and refresh tokens
+    user = await db.users.find_one_and_update(
         {"id": user_id},
-        {"$set": {"is_active": is_active}}
+        {"$set": {"is_active": is_active, **await change_stamp()}, "$inc": {"token_version": 1}},
+        projection={"_id": 0, "token_version": 1},
+        return_document=ReturnDocument.AFTER
     )
-    if result.modified_count == 0:
+    if not user:
         raise HTTPException(status_code=404, detail="User not found")
+    revoke_tokens(user_id, user['token_version'])
     return {"message": "User status updated successfully"}
 
 # Department Routes
@@ -368,12 +1292,18 @@ async def create_department(dept: DepartmentCreate, current_user: Dict = Depends
     department = Department(**dept.model_dump())
     doc = department.model_dump()
     doc['created_at'] = doc['created_at'].isoformat()
+    doc.update(await change_stamp())
     await db.departments.insert_one(doc)
     return department
 
 @api_router.get("/departments", response_model=List[Department])
-async def get_departments(current_user: Dict = Depends(get_current_user)):
-    departments = await db.departments.find({}, {"_id": 0}).to_list(1000)
+async def get_departments(fields: Optional[str] = None, since: Optional[int] = Query(None, ge=0), current_user: Dict = Depends(get_current_user)):
+    selected = parse_fields(Department, fields)
+    if since is not None:
+        return await sync_changes("departments", Department, {}, selected, since)
+    departments = await db.departments.find({}, field_projection(selected)).to_list(1000)
+    if selected:
+        return sparse_response(Department, selected, departments)
     for dept in departments:
         if isinstance(dept.get('created_at'), str):
             dept['created_at'] = datetime.fromisoformat(dept['created_at'])
@@ -390,7 +1320,10 @@ async def create_student(student_data: StudentCreate, current_user: Dict = Depen
     student = Student(**student_data.model_dump())
     doc = student.model_dump()
     doc['created_at'] = doc['created_at'].isoformat()
+    doc.update(await change_stamp())
     await db.students.insert_one(doc)
+    user = await db.users.find_one({"id": student.user_id}, {"_id": 0, "first_name": 1, "last_name": 1, "email": 1})
+    await index_for_search([student_search_doc(doc, user)])
     
     # Create notification
     notif = Notification(
@@ -401,17 +1334,23 @@ async def create_student(student_data: StudentCreate, current_user: Dict = Depen
     )
     notif_doc = notif.model_dump()
     notif_doc['created_at'] = notif_doc['created_at'].isoformat()
+    notif_doc.update(await change_stamp())
     await db.notifications.insert_one(notif_doc)
     
     return student
 
 @api_router.get("/students", response_model=List[Student])
-async def get_students(status: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
+async def get_students(status: Optional[str] = None, fields: Optional[str] = None, since: Optional[int] = Query(None, ge=0), current_user: Dict = Depends(get_current_user)):
+    selected = parse_fields(Student, fields)
     query = {}
     if status:
         query['enrollment_status'] = status
     
-    students = await db.students.find(query, {"_id": 0}).to_list(1000)
+    if since is not None:
+        return await sync_changes("students", Student, {}, selected, since, filters=query)
+    students = await db.students.find(query, field_projection(selected)).to_list(1000)
+    if selected:
+        return sparse_response(Student, selected, students)
     for student in students:
         if isinstance(student.get('created_at'), str):
             student['created_at'] = datetime.fromisoformat(student['created_at'])
@@ -430,7 +1369,7 @@ async def get_student(student_id: str, current_user: Dict = Depends(get_current_
 async def update_student_status(student_id: str, status: EnrollmentStatus, current_user: Dict = Depends(require_role([UserRole.ADMIN]))):
     result = await db.students.update_one(
         {"id": student_id},
-        {"$set": {"enrollment_status": status.value}}
+        {"$set": {"enrollment_status": status.value, **await change_stamp()}}
     )
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="Student not found")
@@ -447,6 +1386,7 @@ async def update_student_status(student_id: str, status: EnrollmentStatus, curre
         )
         notif_doc = notif.model_dump()
         notif_doc['created_at'] = notif_doc['created_at'].isoformat()
+        notif_doc.update(await change_stamp())
         await db.notifications.insert_one(notif_doc)
     
     return {"message": "Status updated successfully"}
@@ -457,12 +1397,20 @@ async def create_teacher(teacher_data: TeacherCreate, current_user: Dict = Depen
     teacher = Teacher(**teacher_data.model_dump())
     doc = teacher.model_dump()
     doc['created_at'] = doc['created_at'].isoformat()
+    doc.update(await change_stamp())
     await db.teachers.insert_one(doc)
+    user = await db.users.find_one({"id": teacher.user_id}, {"_id": 0, "first_name": 1, "last_name": 1, "email": 1})
+    await index_for_search([teacher_search_doc(doc, user)])
     return teacher
 
 @api_router.get("/teachers", response_model=List[Teacher])
-async def get_teachers(current_user: Dict = Depends(get_current_user)):
-    teachers = await db.teachers.find({}, {"_id": 0}).to_list(1000)
+async def get_teachers(fields: Optional[str] = None, since: Optional[int] = Query(None, ge=0), current_user: Dict = Depends(get_current_user)):
+    selected = parse_fields(Teacher, fields)
+    if since is not None:
+        return await sync_changes("teachers", Teacher, {}, selected, since)
+    teachers = await db.teachers.find({}, field_projection(selected)).to_list(1000)
+    if selected:
+        return sparse_response(Teacher, selected, teachers)
     for teacher in teachers:
         if isinstance(teacher.get('created_at'), str):
             teacher['created_at'] = datetime.fromisoformat(teacher['created_at'])
@@ -474,16 +1422,27 @@ async def create_course(course_data: CourseCreate, current_user: Dict = Depends(
     course = Course(**course_data.model_dump())
     doc = course.model_dump()
     doc['created_at'] = doc['created_at'].isoformat()
+    doc.update(await change_stamp())
     await db.courses.insert_one(doc)
+    await index_for_search([course_search_doc(doc)])
+    if course.teacher_id:
+        teacher = await db.teachers.find_one({"id": course.teacher_id}, {"_id": 0, "user_id": 1})
+        if teacher:
+            invalidate_timetables(user_id=teacher['user_id'])
     return course
 
 @api_router.get("/courses", response_model=List[Course])
-async def get_courses(department_id: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
+async def get_courses(department_id: Optional[str] = None, fields: Optional[str] = None, since: Optional[int] = Query(None, ge=0), current_user: Dict = Depends(get_current_user)):
+    selected = parse_fields(Course, fields)
     query = {}
     if department_id:
         query['department_id'] = department_id
     
-    courses = await db.courses.find(query, {"_id": 0}).to_list(1000)
+    if since is not None:
+        return await sync_changes("courses", Course, {}, selected, since, filters=query)
+    courses = await db.courses.find(query, field_projection(selected)).to_list(1000)
+    if selected:
+        return sparse_response(Course, selected, courses)
     for course in courses:
         if isinstance(course.get('created_at'), str):
             course['created_at'] = datetime.fromisoformat(course['created_at'])
@@ -491,12 +1450,75 @@ async def get_courses(department_id: Optional[str] = None, current_user: Dict =
 
 @api_router.get("/courses/{course_id}", response_model=Course)
 async def get_course(course_id: str, current_user: Dict = Depends(get_current_user)):
-    course = await db.courses.find_one({"id": course_id}, {"_id": 0})
+    async def load() -> bytes:
+        course = await db.courses.find_one({"id": course_id}, {"_id": 0})
+        if not course:
+            raise HTTPException(status_code=404, detail="Course not found")
+        return Course(**course).model_dump_json().encode()
+    return await coalesced_json("get_course", (current_user['role'], course_id), load)
+
+@api_router.get("/courses/{course_id}/roster", response_model=List[RosterEntry])
+async def get_course_roster(
+    course_id: str,
+    status: Optional[EnrollmentStatus] = None,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=1000),
+    current_user: Dict = Depends(require_role([UserRole.ADMIN, UserRole.TEACHER]))
+):
+    course = await db.courses.find_one({"id": course_id}, {"_id": 0, "id": 1, "teacher_id": 1})
     if not course:
         raise HTTPException(status_code=404, detail="Course not found")
-    if isinstance(course.get('created_at'), str):
-        course['created_at'] = datetime.fromisoformat(course['created_at'])
-    return Course(**course)
+    # Rosters carry student emails: teachers only see the courses they teach
+    if current_user['role'] == UserRole.TEACHER.value:
+        teacher = await db.teachers.find_one({"user_id": current_user['id']}, {"_id": 0, "id": 1})
+        if not teacher or course.get('teacher_id') != teacher['id']:
+            raise HTTPException(status_code=403, detail="Insufficient permissions")
+    
+    match = {"course_id": course_id}
+    if status:
+        match['status'] = status.value
+    
+    # Single round trip: enrollments -> students -> users, each $lookup served by the "id" indexes
+    pipeline = [
+        {"$match": match},
+        {"$sort": {"enrolled_at": 1, "id": 1}},
+        {"$skip": skip},
+        {"$limit": limit},
+        {"$lookup": {
+            "from": "students",
+            "localField": "student_id",
+            "foreignField": "id",
+            "pipeline": [{"$project": {"_id": 0, "student_number": 1, "user_id": 1}}],
+            "as": "student"
+        }},
+        {"$unwind": {"path": "$student", "preserveNullAndEmptyArrays": True}},
+        {"$lookup": {
+            "from": "users",
+            "localField": "student.user_id",
+            "foreignField": "id",
+            "pipeline": [{"$project": {"_id": 0, "first_name": 1, "last_name": 1, "email": 1}}],
+            "as": "user"
+        }},
+        {"$unwind": {"path": "$user", "preserveNullAndEmptyArrays": True}},
+        {"$project": {
+            "_id": 0,
+            "enrollment_id": "$id",
+            "student_id": 1,
+            "student_number": "$student.student_number",
+            "user_id": "$student.user_id",
+            "first_name": "$user.first_name",
+            "last_name": "$user.last_name",
+            "email": "$user.email",
+            "status": 1,
+            "enrolled_at": 1
+        }}
+    ]
+    
+    roster = await db.enrollments.aggregate(pipeline).to_list(limit)
+    for entry in roster:
+        if isinstance(entry.get('enrolled_at'), str):
+            entry['enrolled_at'] = datetime.fromisoformat(entry['enrolled_at'])
+    return roster
 
 # Enrollment Routes
 @api_router.post("/enrollments", response_model=Enrollment)
@@ -522,18 +1544,27 @@ async def create_enrollment(enrollment_data: EnrollmentCreate, current_user: Dic
     enrollment = Enrollment(**enrollment_data.model_dump())
     doc = enrollment.model_dump()
     doc['enrolled_at'] = doc['enrolled_at'].isoformat()
+    doc.update(await change_stamp())
     await db.enrollments.insert_one(doc)
     return enrollment
 
 @api_router.get("/enrollments", response_model=List[Enrollment])
-async def get_enrollments(student_id: Optional[str] = None, course_id: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
+async def get_enrollments(student_id: Optional[str] = None, course_id: Optional[str] = None, fields: Optional[str] = None, since: Optional[int] = Query(None, ge=0), academic_year: Optional[str] = Query(None, pattern=ACADEMIC_YEAR_PATTERN), current_user: Dict = Depends(get_current_user)):
+    selected = parse_fields(Enrollment, fields)
     query = {}
     if student_id:
         query['student_id'] = student_id
     if course_id:
         query['course_id'] = course_id
     
-    enrollments = await db.enrollments.find(query, {"_id": 0}).to_list(1000)
+    if since is not None:
+        return await sync_changes("enrollments", Enrollment, {}, selected, since, filters=query)
+    source = db.enrollments
+    if academic_year:
+        source, query = await academic_year_source("enrollments", academic_year, query)
+    enrollments = await source.find(query, field_projection(selected)).to_list(1000)
+    if selected:
+        return sparse_response(Enrollment, selected, enrollments)
     for enrollment in enrollments:
         if isinstance(enrollment.get('enrolled_at'), str):
             enrollment['enrolled_at'] = datetime.fromisoformat(enrollment['enrolled_at'])
@@ -543,10 +1574,14 @@ async def get_enrollments(student_id: Optional[str] = None, course_id: Optional[
 async def update_enrollment_status(enrollment_id: str, status: EnrollmentStatus, current_user: Dict = Depends(require_role([UserRole.ADMIN, UserRole.TEACHER]))):
     result = await db.enrollments.update_one(
         {"id": enrollment_id},
-        {"$set": {"status": status.value}}
+        {"$set": {"status": status.value, **await change_stamp()}}
     )
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="Enrollment not found")
+    enrollment = await db.enrollments.find_one({"id": enrollment_id}, {"_id": 0, "student_id": 1})
+    student = await db.students.find_one({"id": enrollment['student_id']}, {"_id": 0, "user_id": 1})
+    if student:
+        invalidate_timetables(user_id=student['user_id'])
     return {"message": "Status updated successfully"}
 
 # Exam Routes
@@ -564,7 +1599,9 @@ async def create_exam(exam_data: ExamCreate, current_user: Dict = Depends(requir
     exam = Exam(**exam_data.model_dump())
     doc = exam.model_dump()
     doc['created_at'] = doc['created_at'].isoformat()
+    doc.update(await change_stamp())
     await db.exams.insert_one(doc)
+    invalidate_timetables(course_id=exam.course_id)
     
     # Notify enrolled students
     enrollments = await db.enrollments.find(
@@ -575,6 +1612,7 @@ async def create_exam(exam_data: ExamCreate, current_user: Dict = Depends(requir
     course = await db.courses.find_one({"id": exam.course_id})
     course_name = course['name'] if course else "Course"
     
+    notif_docs = []
     for enroll in enrollments:
         notif = Notification(
             user_id=(await db.students.find_one({"id": enroll['student_id']}))['user_id'],
@@ -584,21 +1622,26 @@ async def create_exam(exam_data: ExamCreate, current_user: Dict = Depends(requir
         )
         notif_doc = notif.model_dump()
         notif_doc['created_at'] = notif_doc['created_at'].isoformat()
-        await db.notifications.insert_one(notif_doc)
+        notif_docs.append(notif_doc)
+    if notif_docs:
+        await stamp_changes(notif_docs)
+        await db.notifications.insert_many(notif_docs)
     
     return exam
 
 @api_router.get("/exams", response_model=List[Exam])
-async def get_exams(course_id: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
+async def get_exams(course_id: Optional[str] = None, fields: Optional[str] = None, since: Optional[int] = Query(None, ge=0), current_user: Dict = Depends(get_current_user)):
+    selected = parse_fields(Exam, fields)
     query = {}
     if course_id:
         query['course_id'] = course_id
     
-    exams = await db.exams.find(query, {"_id": 0}).to_list(1000)
-    for exam in exams:
-        if isinstance(exam.get('created_at'), str):
-            exam['created_at'] = datetime.fromisoformat(exam['created_at'])
-    return exams
+    if since is not None:
+        return await sync_changes("exams", Exam, {}, selected, since, filters=query)
+    
+    async def load() -> bytes:
+        return list_json(Exam, selected, await db.exams.find(query, field_projection(selected)).to_list(1000))
+    return await coalesced_json("get_exams", (current_user['role'], course_id, selected), load)
 
 # Grade Routes
 @api_router.post("/grades", response_model=Grade)
@@ -611,12 +1654,16 @@ async def create_grade(grade_data: GradeCreate, current_user: Dict = Depends(req
     )
     doc = grade.model_dump()
     doc['graded_at'] = doc['graded_at'].isoformat()
+    doc.update(await change_stamp())
     await db.grades.insert_one(doc)
+    invalidate_grade_analytics()
+    
+    course = await db.courses.find_one({"id": grade.course_id})
+    await increment_academic_summary(grade, course)
     
     # Notify student
     student = await db.students.find_one({"id": grade.student_id})
     if student:
-        course = await db.courses.find_one({"id": grade.course_id})
         course_name = course['name'] if course else "Course"
         notif = Notification(
             user_id=student['user_id'],
@@ -626,54 +1673,329 @@ async def create_grade(grade_data: GradeCreate, current_user: Dict = Depends(req
         )
         notif_doc = notif.model_dump()
         notif_doc['created_at'] = notif_doc['created_at'].isoformat()
+        notif_doc.update(await change_stamp())
         await db.notifications.insert_one(notif_doc)
     
     return grade
 
 @api_router.get("/grades", response_model=List[Grade])
-async def get_grades(student_id: Optional[str] = None, course_id: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
+async def get_grades(student_id: Optional[str] = None, course_id: Optional[str] = None, fields: Optional[str] = None, since: Optional[int] = Query(None, ge=0), academic_year: Optional[str] = Query(None, pattern=ACADEMIC_YEAR_PATTERN), current_user: Dict = Depends(get_current_user)):
+    selected = parse_fields(Grade, fields)
     query = {}
     if student_id:
         query['student_id'] = student_id
     if course_id:
         query['course_id'] = course_id
     
-    grades = await db.grades.find(query, {"_id": 0}).to_list(1000)
+    if since is not None:
+        return await sync_changes("grades", Grade, {}, selected, since, filters=query)
+    source = db.grades
+    if academic_year:
+        source, query = await academic_year_source("grades", academic_year, query)
+    grades = await source.find(query, field_projection(selected)).to_list(1000)
+    if selected:
+        return sparse_response(Grade, selected, grades)
     for grade in grades:
         if isinstance(grade.get('graded_at'), str):
             grade['graded_at'] = datetime.fromisoformat(grade['graded_at'])
     return grades
 
+# Academic Summaries
+# academic_summaries holds one document per student with running per-course totals:
+# {"_id": student_id, "courses": {course_id: {"sum", "count", "credits", "semester"}}}
+async def increment_academic_summary(grade: Grade, course: Optional[Dict[str, Any]]):
+    entry = f"courses.{grade.course_id}"
+    await db.academic_summaries.update_one(
+        {"_id": grade.student_id},
+        {
+            "$inc": {f"{entry}.sum": grade.percentage, f"{entry}.count": 1},
+            "$set": {
+                "student_id": grade.student_id,
+                f"{entry}.credits": course.get('credits', 0) if course else 0,
+                f"{entry}.semester": course.get('semester') if course else None,
+                "updated_at": datetime.now(timezone.utc).isoformat()
+            }
+        },
+        upsert=True
+    )
+
+def weighted_average(courses: List[Dict[str, Any]]) -> Optional[float]:
+    if not courses:
+        return None
+    credits = sum(c['credits'] for c in courses)
+    if not credits:
+        return round(sum(c['average'] for c in courses) / len(courses), 2)
+    return round(sum(c['average'] * c['credits'] for c in courses) / credits, 2)
+
+def academic_summary(student_id: str, doc: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    courses = []
+    for course_id, totals in ((doc or {}).get('courses') or {}).items():
+        if not totals.get('count'):
+            continue
+        average = totals['sum'] / totals['count']
+        courses.append({
+            "course_id": course_id,
+            "semester": totals.get('semester'),
+            "credits": totals.get('credits') or 0,
+            "grades": totals['count'],
+            "average": round(average, 2),
+            "passed": average >= COURSE_PASS_MARK
+        })
+    
+    semesters: Dict[Any, List[Dict[str, Any]]] = {}
+    for course in courses:
+        semesters.setdefault(course['semester'], []).append(course)
+    return {
+        "student_id": student_id,
+        "weighted_average": weighted_average(courses),
+        "credits_attempted": sum(c['credits'] for c in courses),
+        "credits_earned": sum(c['credits'] for c in courses if c['passed']),
+        "semesters": [
+            {
+                "semester": semester,
+                "weighted_average": weighted_average(items),
+                "credits_attempted": sum(c['credits'] for c in items),
+                "credits_earned": sum(c['credits'] for c in items if c['passed'])
+            }
+            for semester, items in sorted(semesters.items(), key=lambda kv: (kv[0] is None, kv[0] or 0))
+        ],
+        "courses": courses,
+        "updated_at": (doc or {}).get('updated_at')
+    }
+
+async def archived_years_union(collection: str) -> List[Dict[str, Any]]:
+    """$unionWith stages that pull a collection's archived years into a rebuild."""
+    return [
+        {"$unionWith": {"coll": archive_collection_name(collection, archive['academic_year'])}}
+        async for archive in db.archives.find({"collections": collection}, {"_id": 0, "academic_year": 1})
+    ]
+
+async def ensure_student_access(student_id: str, current_user: Dict[str, Any]):
+    """Students may only read their own records."""
+    if current_user['role'] == UserRole.STUDENT.value:
+        own = await db.students.find_one({"id": student_id, "user_id": current_user['id']}, {"_id": 0, "id": 1})
+        if not own:
+            raise HTTPException(status_code=403, detail="Insufficient permissions")
+
+async def rebuild_academic_summaries():
+    """Recompute every student's summary from grades, archived years included."""
+    await db.grades.aggregate([
+        *await archived_years_union("grades"),
+        {"$group": {
+            "_id": {"student_id": "$student_id", "course_id": "$course_id"},
+            "sum": {"$sum": "$percentage"},
+            "count": {"$sum": 1}
+        }},
+        {"$lookup": {
+            "from": "courses",
+            "localField": "_id.course_id",
+            "foreignField": "id",
+            "pipeline": [{"$project": {"_id": 0, "credits": 1, "semester": 1}}],
+            "as": "course"
+        }},
+        {"$unwind": {"path": "$course", "preserveNullAndEmptyArrays": True}},
+        {"$group": {
+            "_id": "$_id.student_id",
+            "courses": {"$push": {"k": "$_id.course_id", "v": {
+                "sum": "$sum",
+                "count": "$count",
+                "credits": {"$ifNull": ["$course.credits", 0]},
+                "semester": "$course.semester"
+            }}}
+        }},
+        {"$set": {
+            "student_id": "$_id",
+            "courses": {"$arrayToObject": "$courses"},
+            "updated_at": datetime.now(timezone.utc).isoformat()
+        }},
+        {"$out": "academic_summaries"}
+    ], allowDiskUse=True).to_list(None)
+
+@api_router.get("/students/{student_id}/transcript")
+async def get_transcript(student_id: str, current_user: Dict = Depends(get_current_user)):
+    await ensure_student_access(student_id, current_user)
+    summary = academic_summary(student_id, await db.academic_summaries.find_one({"_id": student_id}))
+    course_info = {c['id']: c async for c in db.courses.find(
+        {"id": {"$in": [c['course_id'] for c in summary['courses']]}},
+        {"_id": 0, "id": 1, "name": 1, "code": 1}
+    )}
+    for course in summary['courses']:
+        info = course_info.get(course['course_id'], {})
+        course['name'] = info.get('name')
+        course['code'] = info.get('code')
+    return summary
+
+@api_router.post("/academic-summaries/rebuild")
+async def rebuild_academic_summaries_route(current_user: Dict = Depends(require_role([UserRole.ADMIN]))):
+    start_background_job(rebuild_academic_summaries)
+    return {"message": "Academic summary rebuild started"}
+
 # Attendance Routes
 @api_router.post("/attendance", response_model=Attendance)
 async def create_attendance(attendance_data: AttendanceCreate, current_user: Dict = Depends(require_role([UserRole.ADMIN, UserRole.TEACHER]))):
     attendance = Attendance(**attendance_data.model_dump(), marked_by=current_user['id'])
     doc = attendance.model_dump()
     doc['created_at'] = doc['created_at'].isoformat()
+    doc.update(await change_stamp())
     await db.attendance.insert_one(doc)
+    await increment_attendance_rollups(attendance)
     return attendance
 
 @api_router.get("/attendance", response_model=List[Attendance])
-async def get_attendance(student_id: Optional[str] = None, course_id: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
+async def get_attendance(student_id: Optional[str] = None, course_id: Optional[str] = None, fields: Optional[str] = None, since: Optional[int] = Query(None, ge=0), academic_year: Optional[str] = Query(None, pattern=ACADEMIC_YEAR_PATTERN), current_user: Dict = Depends(get_current_user)):
+    selected = parse_fields(Attendance, fields)
     query = {}
     if student_id:
         query['student_id'] = student_id
     if course_id:
         query['course_id'] = course_id
     
-    attendance = await db.attendance.find(query, {"_id": 0}).to_list(1000)
+    if since is not None:
+        return await sync_changes("attendance", Attendance, {}, selected, since, filters=query)
+    source = db.attendance
+    if academic_year:
+        source, query = await academic_year_source("attendance", academic_year, query)
+    attendance = await source.find(query, field_projection(selected)).to_list(1000)
+    if selected:
+        return sparse_response(Attendance, selected, attendance)
     for record in attendance:
         if isinstance(record.get('created_at'), str):
             record['created_at'] = datetime.fromisoformat(record['created_at'])
     return attendance
 
+# Attendance Rollups
+# attendance_daily holds one document per course per day, attendance_monthly one per
+# student per course per month; both carry a counter per status plus a total.
+def attendance_counts(doc: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    counts = {s.value: (doc or {}).get(s.value, 0) for s in AttendanceStatus}
+    attended = counts[AttendanceStatus.PRESENT.value] + counts[AttendanceStatus.LATE.value]
+    countable = attended + counts[AttendanceStatus.ABSENT.value]
+    counts['total'] = sum(counts[s.value] for s in AttendanceStatus)
+    counts['attendance_rate'] = round(attended / countable * 100, 2) if countable else None
+    return counts
+
+def sum_attendance_counts(docs: List[Dict[str, Any]]) -> Dict[str, Any]:
+    return attendance_counts({s.value: sum(d.get(s.value, 0) for d in docs) for s in AttendanceStatus})
+
+async def increment_attendance_rollups(record: Attendance):
+    inc = {record.status.value: 1, "total": 1}
+    month = record.date[:7]
+    await asyncio.gather(
+        db.attendance_daily.update_one(
+            {"_id": f"{record.course_id}:{record.date}"},
+            {"$inc": inc, "$setOnInsert": {"course_id": record.course_id, "date": record.date}},
+            upsert=True
+        ),
+        db.attendance_monthly.update_one(
+            {"_id": f"{record.student_id}:{record.course_id}:{month}"},
+            {"$inc": inc, "$setOnInsert": {"student_id": record.student_id, "course_id": record.course_id, "month": month}},
+            upsert=True
+        )
+    )
+
+async def rebuild_attendance_rollups():
+    """Recompute both rollups from attendance, archived years included. $out swaps each collection in atomically."""
+    counters = {s.value: {"$sum": {"$cond": [{"$eq": ["$status", s.value]}, 1, 0]}} for s in AttendanceStatus}
+    counters['total'] = {"$sum": 1}
+    union = await archived_years_union("attendance")
+    await db.attendance.aggregate([
+        *union,
+        {"$group": {"_id": {"course_id": "$course_id", "date": "$date"}, **counters}},
+        {"$set": {
+            "course_id": "$_id.course_id",
+            "date": "$_id.date",
+            "_id": {"$concat": ["$_id.course_id", ":", "$_id.date"]}
+        }},
+        {"$out": "attendance_daily"}
+    ], allowDiskUse=True).to_list(None)
+    await db.attendance.aggregate([
+        *union,
+        {"$group": {
+            "_id": {"student_id": "$student_id", "course_id": "$course_id", "month": {"$substrBytes": ["$date", 0, 7]}},
+            **counters
+        }},
+        {"$set": {
+            "student_id": "$_id.student_id",
+            "course_id": "$_id.course_id",
+            "month": "$_id.month",
+            "_id": {"$concat": ["$_id.student_id", ":", "$_id.course_id", ":", "$_id.month"]}
+        }},
+        {"$out": "attendance_monthly"}
+    ], allowDiskUse=True).to_list(None)
+    await db.attendance_daily.create_index([("course_id", 1), ("date", 1)])
+    await db.attendance_monthly.create_index([("student_id", 1), ("course_id", 1), ("month", 1)])
+
+@api_router.get("/attendance/rollups/courses/{course_id}")
+async def get_course_attendance_rollup(
+    course_id: str,
+    date: Optional[str] = Query(None, pattern=DATE_PATTERN),
+    start_date: Optional[str] = Query(None, pattern=DATE_PATTERN),
+    end_date: Optional[str] = Query(None, pattern=DATE_PATTERN),
+    current_user: Dict = Depends(require_role([UserRole.ADMIN, UserRole.TEACHER]))
+):
+    if date:
+        day = await db.attendance_daily.find_one({"_id": f"{course_id}:{date}"})
+        return {"course_id": course_id, "date": date, **attendance_counts(day)}
+    
+    query: Dict[str, Any] = {"course_id": course_id}
+    if start_date or end_date:
+        query['date'] = {}
+        if start_date:
+            query['date']['$gte'] = start_date
+        if end_date:
+            query['date']['$lte'] = end_date
+    days = await db.attendance_daily.find(query).sort("date", 1).to_list(None)
+    return {
+        "course_id": course_id,
+        "start_date": start_date,
+        "end_date": end_date,
+        **sum_attendance_counts(days),
+        "days": [{"date": d['date'], **attendance_counts(d)} for d in days]
+    }
+
+@api_router.get("/attendance/rollups/students/{student_id}")
+async def get_student_attendance_rollup(
+    student_id: str,
+    course_id: Optional[str] = None,
+    month: Optional[str] = Query(None, pattern=r'^\d{4}-\d{2}$'),
+    current_user: Dict = Depends(get_current_user)
+):
+    await ensure_student_access(student_id, current_user)
+    if course_id and month:
+        doc = await db.attendance_monthly.find_one({"_id": f"{student_id}:{course_id}:{month}"})
+        return {"student_id": student_id, "course_id": course_id, "month": month, **attendance_counts(doc)}
+    
+    query: Dict[str, Any] = {"student_id": student_id}
+    if course_id:
+        query['course_id'] = course_id
+    if month:
+        query['month'] = month
+    months = await db.attendance_monthly.find(query).sort([("course_id", 1), ("month", 1)]).to_list(None)
+    return {
+        "student_id": student_id,
+        "course_id": course_id,
+        "month": month,
+        **sum_attendance_counts(months),
+        "months": [{"course_id": m['course_id'], "month": m['month'], **attendance_counts(m)} for m in months]
+    }
+
+@api_router.post("/attendance/rollups/rebuild")
+async def rebuild_attendance_rollups_route(current_user: Dict = Depends(require_role([UserRole.ADMIN]))):
+    start_background_job(rebuild_attendance_rollups)
+    return {"message": "Attendance rollup rebuild started"}
+
 # Notification Routes
 @api_router.get("/notifications", response_model=List[Notification])
-async def get_notifications(current_user: Dict = Depends(get_current_user)):
+async def get_notifications(fields: Optional[str] = None, since: Optional[int] = Query(None, ge=0), current_user: Dict = Depends(get_current_user)):
+    selected = parse_fields(Notification, fields)
+    if since is not None:
+        return await sync_changes("notifications", Notification, {"user_id": current_user['id']}, selected, since)
     notifications = await db.notifications.find(
         {"user_id": current_user['id']},
-        {"_id": 0}
+        field_projection(selected)
     ).sort("created_at", -1).to_list(100)
+    if selected:
+        return sparse_response(Notification, selected, notifications)
     
     for notif in notifications:
         if isinstance(notif.get('created_at'), str):
@@ -684,7 +2006,7 @@ async def get_notifications(current_user: Dict = Depends(get_current_user)):
 async def mark_notification_read(notification_id: str, current_user: Dict = Depends(get_current_user)):
     result = await db.notifications.update_one(
         {"id": notification_id, "user_id": current_user['id']},
-        {"$set": {"read": True}}
+        {"$set": {"read": True, **await change_stamp()}}
     )
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="Notification not found")
@@ -696,20 +2018,1266 @@ async def create_schedule(schedule_data: ScheduleCreate, current_user: Dict = De
     schedule = Schedule(**schedule_data.model_dump())
     doc = schedule.model_dump()
     doc['created_at'] = doc['created_at'].isoformat()
+    doc.update(await change_stamp())
     await db.schedules.insert_one(doc)
+    invalidate_timetables(course_id=schedule.course_id)
     return schedule
 
 @api_router.get("/schedules", response_model=List[Schedule])
-async def get_schedules(course_id: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
+async def get_schedules(course_id: Optional[str] = None, fields: Optional[str] = None, since: Optional[int] = Query(None, ge=0), current_user: Dict = Depends(get_current_user)):
+    selected = parse_fields(Schedule, fields)
     query = {}
     if course_id:
         query['course_id'] = course_id
     
-    schedules = await db.schedules.find(query, {"_id": 0}).to_list(1000)
-    for schedule in schedules:
-        if isinstance(schedule.get('created_at'), str):
-            schedule['created_at'] = datetime.fromisoformat(schedule['created_at'])
-    return schedules
+    if since is not None:
+        return await sync_changes("schedules", Schedule, {}, selected, since, filters=query)
+    
+    async def load() -> bytes:
+        return list_json(Schedule, selected, await db.schedules.find(query, field_projection(selected)).to_list(1000))
+    return await coalesced_json("get_schedules", (current_user['role'], course_id, selected), load)
+
+# Timetables
+# Per-process cache of user_id -> computed timetable, its serialized bodies and their
+# ETags. Entries are dropped when a schedule, exam or enrollment touches their courses.
+timetable_cache: Dict[str, Dict[str, Any]] = {}
+
+def invalidate_timetables(course_id: Optional[str] = None, user_id: Optional[str] = None):
+    stale = [uid for uid, entry in timetable_cache.items() if uid == user_id or course_id in entry['course_ids']]
+    for uid in stale:
+        del timetable_cache[uid]
+
+def timetable_pipeline(role: str, user_id: str) -> Optional[Tuple[str, List[Dict[str, Any]]]]:
+    """One aggregation from the user's profile to their courses, weekly sessions and exams."""
+    if role == UserRole.STUDENT.value:
+        collection, courses_stage = "students", [
+            {"$lookup": {
+                "from": "enrollments",
+                "localField": "id",
+                "foreignField": "student_id",
+                "pipeline": [{"$match": {"status": EnrollmentStatus.APPROVED.value}}, {"$project": {"_id": 0, "course_id": 1}}],
+                "as": "enrollments"
+            }},
+            {"$project": {"_id": 0, "course_ids": "$enrollments.course_id"}}
+        ]
+    elif role == UserRole.TEACHER.value:
+        collection, courses_stage = "teachers", [
+            {"$lookup": {
+                "from": "courses",
+                "localField": "id",
+                "foreignField": "teacher_id",
+                "pipeline": [{"$project": {"_id": 0, "id": 1}}],
+                "as": "taught"
+            }},
+            {"$project": {"_id": 0, "course_ids": "$taught.id"}}
+        ]
+    else:
+        return None
+    return collection, [
+        {"$match": {"user_id": user_id}},
+        *courses_stage,
+        {"$lookup": {
+            "from": "courses",
+            "localField": "course_ids",
+            "foreignField": "id",
+            "pipeline": [{"$project": {"_id": 0, "id": 1, "name": 1, "code": 1}}],
+            "as": "courses"
+        }},
+        {"$lookup": {
+            "from": "schedules",
+            "localField": "course_ids",
+            "foreignField": "course_id",
+            "pipeline": [
+                {"$project": {"_id": 0, "id": 1, "course_id": 1, "day_of_week": 1, "start_time": 1, "end_time": 1, "room": 1}},
+                {"$sort": {"day_of_week": 1, "start_time": 1}}
+            ],
+            "as": "sessions"
+        }},
+        {"$lookup": {
+            "from": "exams",
+            "localField": "course_ids",
+            "foreignField": "course_id",
+            "pipeline": [
+                {"$project": {"_id": 0, "id": 1, "course_id": 1, "name": 1, "exam_date": 1, "start_time": 1,
+                              "duration_minutes": 1, "room": 1}},
+                {"$sort": {"exam_date": 1, "start_time": 1}}
+            ],
+            "as": "exams"
+        }}
+    ]
+
+async def compute_timetable(user: Dict[str, Any]) -> Dict[str, Any]:
+    timetable = {"user_id": user['id'], "generated_at": datetime.now(timezone.utc).isoformat(),
+                 "courses": [], "sessions": [], "exams": []}
+    plan = timetable_pipeline(user['role'], user['id'])
+    if plan:
+        collection, pipeline = plan
+        rows = await db[collection].aggregate(pipeline).to_list(1)
+        if rows:
+            timetable.update({key: rows[0][key] for key in ("courses", "sessions", "exams")})
+    return timetable
+
+async def cached_timetable(user: Dict[str, Any]) -> Dict[str, Any]:
+    entry = timetable_cache.get(user['id'])
+    if entry is None:
+        timetable = await compute_timetable(user)
+        entry = {"timetable": timetable, "course_ids": {c['id'] for c in timetable['courses']}, "bodies": {}}
+        if len(timetable_cache) >= TIMETABLE_CACHE_SIZE:
+            del timetable_cache[next(iter(timetable_cache))]
+        timetable_cache[user['id']] = entry
+    return entry
+
+def ics_escape(text: str) -> str:
+    return text.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+def ics_fold(line: str) -> str:
+    # RFC 5545 lines are limited to 75 octets; continuation lines start with a space
+    raw = line.encode('utf-8')
+    parts = []
+    while len(raw) > 75:
+        cut = 75 if not parts else 74
+        while (raw[cut] & 0xC0) == 0x80:
+            cut -= 1
+        parts.append(raw[:cut].decode('utf-8'))
+        raw = raw[cut:]
+    parts.append(raw.decode('utf-8'))
+    return '\r\n '.join(parts)
+
+def render_ics(timetable: Dict[str, Any]) -> bytes:
+    courses = {c['id']: c for c in timetable['courses']}
+    stamp = datetime.fromisoformat(timetable['generated_at']).strftime('%Y%m%dT%H%M%SZ')
+    year_start, year_end = academic_year_range(current_academic_year())
+    first_day = datetime.strptime(year_start, '%Y-%m-%d')
+    # DTSTART is floating local time, and RFC 5545 requires UNTIL to match it
+    until = datetime.strptime(year_end, '%Y-%m-%d').strftime('%Y%m%dT000000')
+    lines = ["BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//Campus Manager//Timetable//FR", "CALSCALE:GREGORIAN"]
+    
+    for session in timetable['sessions']:
+        course = courses.get(session['course_id'], {})
+        day = first_day + timedelta(days=(session['day_of_week'] - first_day.weekday()) % 7)
+        lines += [
+            "BEGIN:VEVENT",
+            f"UID:schedule-{session['id']}",
+            f"DTSTAMP:{stamp}",
+            f"DTSTART:{day.strftime('%Y%m%d')}T{session['start_time'].replace(':', '')[:4]}00",
+            f"DTEND:{day.strftime('%Y%m%d')}T{session['end_time'].replace(':', '')[:4]}00",
+            f"RRULE:FREQ=WEEKLY;UNTIL={until}",
+            f"SUMMARY:{ics_escape(course.get('name', ''))}",
+            f"LOCATION:{ics_escape(session['room'])}",
+            "END:VEVENT"
+        ]
+    for exam in timetable['exams']:
+        course = courses.get(exam['course_id'], {})
+        lines += [
+            "BEGIN:VEVENT",
+            f"UID:exam-{exam['id']}",
+            f"DTSTAMP:{stamp}",
+            f"DTSTART:{exam['exam_date'].replace('-', '')}T{exam['start_time'].replace(':', '')[:4]}00",
+            f"DURATION:PT{exam['duration_minutes']}M",
+            f"SUMMARY:{ics_escape(exam['name'] + ' - ' + course.get('name', ''))}",
+            f"LOCATION:{ics_escape(exam['room'])}",
+            "END:VEVENT"
+        ]
+    lines.append("END:VCALENDAR")
+    return ('\r\n'.join(ics_fold(line) for line in lines) + '\r\n').encode('utf-8')
+
+def timetable_response(request: Request, entry: Dict[str, Any], media_type: str) -> Response:
+    body = entry['bodies'].get(media_type)
+    if body is None:
+        if media_type == "text/calendar":
+            content = render_ics(entry['timetable'])
+        else:
+            content = json.dumps(entry['timetable'], ensure_ascii=False).encode('utf-8')
+        body = entry['bodies'][media_type] = (content, f'"{hashlib.sha1(content).hexdigest()}"')
+    content, etag = body
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    return Response(content=content, media_type=media_type, headers=headers)
+
+@api_router.get("/me/timetable")
+async def get_my_timetable(request: Request, current_user: Dict = Depends(get_current_user)):
+    return timetable_response(request, await cached_timetable(current_user), "application/json")
+
+@api_router.get("/me/timetable/feed")
+async def get_my_timetable_feed(current_user: Dict = Depends(get_current_user)):
+    user = await db.users.find_one({"id": current_user['id']}, {"_id": 0, "id": 1, "role": 1, "token_version": 1})
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    return {"url": f"/api/timetable/{create_calendar_token(user)}.ics"}
+
+@api_router.get("/timetable/{token}.ics")
+async def get_timetable_feed(token: str, request: Request):
+    payload = decode_token(token)
+    if payload.get('type') != 'calendar':
+        raise HTTPException(status_code=401, detail="Invalid token")
+    # The revocation map is per worker and short-lived, so go to the user document.
+    # Calendar apps poll rarely; this is one point read by the unique id index.
+    user = await db.users.find_one({"id": payload['user_id']}, {"_id": 0, "token_version": 1, "is_active": 1})
+    if not user or payload.get('ver', 0) != user.get('token_version', 0):
+        raise HTTPException(status_code=401, detail="Token revoked")
+    if not user.get('is_active', True):
+        raise HTTPException(status_code=401, detail="Account is inactive")
+    principal = {"id": payload['user_id'], "role": payload['role']}
+    return timetable_response(request, await cached_timetable(principal), "text/calendar")
+
+# Bulk Import
+hash_pool: Optional[ProcessPoolExecutor] = None
+
+def get_hash_pool() -> ProcessPoolExecutor:
+    global hash_pool
+    if hash_pool is None:
+        # spawn, not fork: the parent holds Motor's monitor threads and their locks
+        hash_pool = ProcessPoolExecutor(
+            max_workers=IMPORT_HASH_WORKERS,
+            mp_context=multiprocessing.get_context('spawn')
+        )
+    return hash_pool
+
+def shutdown_hash_pool():
+    global hash_pool
+    if hash_pool is not None:
+        hash_pool.shutdown()
+        hash_pool = None
+
+def hash_passwords(passwords: List[str]) -> List[str]:
+    return [hash_password(p) for p in passwords]
+
+async def hash_passwords_parallel(passwords: List[str]) -> List[str]:
+    if not passwords:
+        return []
+    loop = asyncio.get_running_loop()
+    size = math.ceil(len(passwords) / IMPORT_HASH_WORKERS)
+    chunks = [passwords[i:i + size] for i in range(0, len(passwords), size)]
+    results = await asyncio.gather(*(loop.run_in_executor(get_hash_pool(), hash_passwords, c) for c in chunks))
+    return [hashed for chunk in results for hashed in chunk]
+
+def import_error(report: Dict[str, Any], row_number: int, message: str, email: Optional[str] = None):
+    report['errors'].append({"row": row_number, "email": email, "errors": [message]})
+
+async def import_students_batch(batch: List[Tuple[int, StudentImportRow]], report: Dict[str, Any]):
+    taken_emails = {u['email'] async for u in db.users.find(
+        {"email": {"$in": [row.email for _, row in batch]}}, {"_id": 0, "email": 1}
+    )}
+    taken_numbers = {s['student_number'] async for s in db.students.find(
+        {"student_number": {"$in": [row.student_number for _, row in batch]}}, {"_id": 0, "student_number": 1}
+    )}
+    
+    accepted = []
+    for row_number, row in batch:
+        if row.email in taken_emails:
+            import_error(report, row_number, "Email already registered", row.email)
+        elif row.student_number in taken_numbers:
+            import_error(report, row_number, "Student number already exists", row.email)
+        else:
+            accepted.append(row)
+    if not accepted:
+        return
+    
+    hashes = await hash_passwords_parallel([row.password for row in accepted])
+    user_docs, student_docs, notif_docs = [], [], []
+    for row, hashed_pw in zip(accepted, hashes):
+        user = User(
+            email=row.email,
+            role=UserRole.STUDENT,
+            first_name=row.first_name,
+            last_name=row.last_name,
+            phone=row.phone
+        )
+        user_doc = user.model_dump()
+        user_doc['password'] = hashed_pw
+        user_doc['token_version'] = 0
+        user_doc['created_at'] = user_doc['created_at'].isoformat()
+        user_docs.append(user_doc)
+        
+        student = Student(
+            user_id=user.id,
+            student_number=row.student_number,
+            department_id=row.department_id,
+            academic_year=row.academic_year,
+            date_of_birth=row.date_of_birth,
+            address=row.address,
+            emergency_contact=row.emergency_contact
+        )
+        student_doc = student.model_dump()
+        student_doc['created_at'] = student_doc['created_at'].isoformat()
+        student_docs.append(student_doc)
+        
+        notif = Notification(
+            user_id=user.id,
+            title="Bienvenue",
+            message="Votre compte étudiant a été créé. Votre inscription est en attente d'approbation.",
+            type="info"
+        )
+        notif_doc = notif.model_dump()
+        notif_doc['created_at'] = notif_doc['created_at'].isoformat()
+        notif_docs.append(notif_doc)
+    
+    await stamp_changes(user_docs + student_docs + notif_docs)
+    await db.users.insert_many(user_docs, ordered=False)
+    await db.students.insert_many(student_docs, ordered=False)
+    await db.notifications.insert_many(notif_docs, ordered=False)
+    await index_for_search(
+        [user_search_doc(u) for u in user_docs] +
+        [student_search_doc(st, u) for st, u in zip(student_docs, user_docs)]
+    )
+    report['imported'] += len(user_docs)
+
+async def import_students_csv(lines: Iterable[str]) -> Dict[str, Any]:
+    """Import students row by row from CSV text, committing every IMPORT_BATCH_SIZE rows."""
+    report = {"total": 0, "imported": 0, "failed": 0, "errors": []}
+    seen_emails, seen_numbers = set(), set()
+    batch: List[Tuple[int, StudentImportRow]] = []
+    
+    # Row numbers match the file's line numbers, the header being line 1
+    for row_number, raw in enumerate(csv.DictReader(lines), start=2):
+        report['total'] += 1
+        try:
+            row = StudentImportRow(**{
+                key.strip(): (value or '').strip() or None
+                for key, value in raw.items() if key and not isinstance(value, list)
+            })
+        except ValidationError as e:
+            report['errors'].append({
+                "row": row_number,
+                "email": raw.get('email'),
+                "errors": [f"{'.'.join(str(loc) for loc in err['loc'])}: {err['msg']}" for err in e.errors()]
+            })
+            continue
+        
+        if row.email.lower() in seen_emails:
+            import_error(report, row_number, "Duplicate email in file", row.email)
+            continue
+        if row.student_number in seen_numbers:
+            import_error(report, row_number, "Duplicate student number in file", row.email)
+            continue
+        seen_emails.add(row.email.lower())
+        seen_numbers.add(row.student_number)
+        
+        batch.append((row_number, row))
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            await import_students_batch(batch, report)
+            batch = []
+    if batch:
+        await import_students_batch(batch, report)
+    
+    report['errors'].sort(key=lambda e: e['row'])
+    report['failed'] = len(report['errors'])
+    return report
+
+@api_router.post("/import/students")
+async def import_students(file: UploadFile = File(...), current_user: Dict = Depends(require_role([UserRole.ADMIN]))):
+    # The upload is spooled to disk; wrapping it reads the CSV incrementally
+    lines = io.TextIOWrapper(file.file, encoding='utf-8-sig', newline='')
+    try:
+        return await import_students_csv(lines)
+    except (UnicodeDecodeError, csv.Error) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid CSV file: {e}")
+    finally:
+        lines.detach()
+
+# Report Cards
+# A job reads the department's students, courses and grades in a handful of queries,
+# renders the cards in chunks on a process pool, then zips them into one artifact.
+report_pool: Optional[ProcessPoolExecutor] = None
+
+def get_report_pool() -> ProcessPoolExecutor:
+    global report_pool
+    if report_pool is None:
+        report_pool = ProcessPoolExecutor(
+            max_workers=REPORT_WORKERS,
+            mp_context=multiprocessing.get_context('spawn')
+        )
+    return report_pool
+
+def shutdown_report_pool():
+    global report_pool
+    if report_pool is not None:
+        report_pool.shutdown()
+        report_pool = None
+
+def report_filename(card: Dict[str, Any]) -> str:
+    return re.sub(r'[^A-Za-z0-9_-]', '_', card['student_number']) or card['student_id']
+
+def render_report_html(card: Dict[str, Any]) -> str:
+    rows = ''.join(
+        f"<tr><td>{html.escape(c['code'])}</td><td>{html.escape(c['name'])}</td><td>{c['credits']}</td>"
+        f"<td>{c['average']:.2f}</td><td>{'Validé' if c['passed'] else 'Non validé'}</td></tr>"
+        for c in card['courses']
+    )
+    average = '-' if card['weighted_average'] is None else f"{card['weighted_average']:.2f}"
+    return (
+        "<!DOCTYPE html><html lang=\"fr\"><head><meta charset=\"utf-8\">"
+        f"<title>Bulletin {html.escape(card['student_number'])}</title></head><body>"
+        f"<h1>{html.escape(card['name'])}</h1>"
+        f"<p>{html.escape(card['student_number'])} - {html.escape(card['department'])} - "
+        f"Semestre {card['semester']}{' - ' + html.escape(card['academic_year']) if card['academic_year'] else ''}</p>"
+        "<table><thead><tr><th>Code</th><th>Cours</th><th>Crédits</th><th>Moyenne</th><th>Résultat</th></tr></thead>"
+        f"<tbody>{rows}</tbody></table>"
+        f"<p>Moyenne pondérée : {average} - Crédits obtenus : {card['credits_earned']}/{card['credits_attempted']}</p>"
+        "</body></html>"
+    )
+
+def render_report_csv(card: Dict[str, Any]) -> str:
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(["student_number", "name", "course_code", "course_name", "credits", "grades", "average", "passed"])
+    for c in card['courses']:
+        writer.writerow([card['student_number'], card['name'], c['code'], c['name'], c['credits'], c['grades'], c['average'], c['passed']])
+    return out.getvalue()
+
+def render_report_pdf(card: Dict[str, Any], path: Path):
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfgen import canvas
+    
+    pdf = canvas.Canvas(str(path), pagesize=A4)
+    width, height = A4
+    y = height - 60
+    pdf.setFont("Helvetica-Bold", 14)
+    pdf.drawString(50, y, f"{card['name']} ({card['student_number']})")
+    pdf.setFont("Helvetica", 10)
+    y -= 20
+    pdf.drawString(50, y, f"{card['department']} - Semestre {card['semester']} {card['academic_year'] or ''}")
+    y -= 30
+    for c in card['courses']:
+        if y < 60:
+            pdf.showPage()
+            pdf.setFont("Helvetica", 10)
+            y = height - 60
+        pdf.drawString(50, y, f"{c['code']}  {c['name'][:60]}")
+        pdf.drawRightString(width - 50, y, f"{c['credits']} cr.  {c['average']:.2f}")
+        y -= 16
+    average = '-' if card['weighted_average'] is None else f"{card['weighted_average']:.2f}"
+    pdf.drawString(50, y - 14, f"Moyenne pondérée : {average}  Crédits : {card['credits_earned']}/{card['credits_attempted']}")
+    pdf.save()
+
+def render_report_cards(cards: List[Dict[str, Any]], formats: List[str], directory: str) -> int:
+    """Runs in a report pool worker: write every card in every requested format."""
+    target = Path(directory)
+    for card in cards:
+        name = report_filename(card)
+        if ReportFormat.HTML.value in formats:
+            (target / f"{name}.html").write_text(render_report_html(card), encoding='utf-8')
+        if ReportFormat.CSV.value in formats:
+            (target / f"{name}.csv").write_text(render_report_csv(card), encoding='utf-8', newline='')
+        if ReportFormat.PDF.value in formats:
+            render_report_pdf(card, target / f"{name}.pdf")
+    return len(cards)
+
+async def load_report_cards(job: Dict[str, Any]) -> List[Dict[str, Any]]:
+    department = await db.departments.find_one({"id": job['department_id']}, {"_id": 0, "name": 1})
+    courses = {c['id']: c async for c in db.courses.find(
+        {"department_id": job['department_id'], "semester": job['semester']},
+        {"_id": 0, "id": 1, "name": 1, "code": 1, "credits": 1}
+    )}
+    students = await db.students.find(
+        {"department_id": job['department_id']}, {"_id": 0, "id": 1, "user_id": 1, "student_number": 1}
+    ).to_list(None)
+    users = {u['id']: u async for u in db.users.find(
+        {"id": {"$in": [st['user_id'] for st in students]}}, {"_id": 0, "id": 1, "first_name": 1, "last_name": 1}
+    )}
+    
+    query: Dict[str, Any] = {"course_id": {"$in": list(courses)}}
+    source = db.grades
+    if job.get('academic_year'):
+        source, query = await academic_year_source("grades", job['academic_year'], query)
+    totals: Dict[str, Dict[str, List[float]]] = {}
+    async for grade in source.find(query, {"_id": 0, "student_id": 1, "course_id": 1, "percentage": 1}):
+        totals.setdefault(grade['student_id'], {}).setdefault(grade['course_id'], []).append(grade['percentage'])
+    
+    cards = []
+    for student in students:
+        course_rows = []
+        for course_id, values in totals.get(student['id'], {}).items():
+            course = courses[course_id]
+            average = sum(values) / len(values)
+            course_rows.append({
+                "code": course['code'],
+                "name": course['name'],
+                "credits": course.get('credits') or 0,
+                "grades": len(values),
+                "average": round(average, 2),
+                "passed": average >= COURSE_PASS_MARK
+            })
+        if not course_rows:
+            continue
+        course_rows.sort(key=lambda c: c['code'])
+        cards.append({
+            "student_id": student['id'],
+            "student_number": student['student_number'],
+            "name": full_name(users.get(student['user_id'])),
+            "department": department['name'] if department else "",
+            "semester": job['semester'],
+            "academic_year": job.get('academic_year'),
+            "courses": course_rows,
+            "weighted_average": weighted_average(course_rows),
+            "credits_attempted": sum(c['credits'] for c in course_rows),
+            "credits_earned": sum(c['credits'] for c in course_rows if c['passed'])
+        })
+    return cards
+
+async def run_report_job(job_id: str):
+    job = await db.report_jobs.find_one({"id": job_id}, {"_id": 0})
+    directory = REPORT_ARTIFACT_DIR / job_id
+    try:
+        cards = await load_report_cards(job)
+        await db.report_jobs.update_one({"id": job_id}, {"$set": {"status": "running", "total": len(cards)}})
+        directory.mkdir(parents=True, exist_ok=True)
+        
+        loop = asyncio.get_running_loop()
+        chunks = [
+            loop.run_in_executor(get_report_pool(), render_report_cards, cards[i:i + REPORT_CHUNK_SIZE], job['formats'], str(directory))
+            for i in range(0, len(cards), REPORT_CHUNK_SIZE)
+        ]
+        for chunk in asyncio.as_completed(chunks):
+            await db.report_jobs.update_one({"id": job_id}, {"$inc": {"done": await chunk}})
+        
+        archive = await run_in_threadpool(shutil.make_archive, str(directory), 'zip', str(directory))
+    except Exception:
+        await db.report_jobs.update_one({"id": job_id}, {"$set": {"status": "failed"}})
+        logger.exception("Report job %s failed", job_id)
+        raise
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    
+    await db.report_jobs.update_one(
+        {"id": job_id},
+        {"$set": {
+            "status": "completed",
+            "artifact": Path(archive).name,
+            "completed_at": datetime.now(timezone.utc).isoformat()
+        }}
+    )
+
+@api_router.post("/report-jobs", status_code=202)
+async def create_report_job(job_data: ReportJobCreate, current_user: Dict = Depends(require_role([UserRole.ADMIN]))):
+    if ReportFormat.PDF in job_data.formats and importlib.util.find_spec('reportlab') is None:
+        raise HTTPException(status_code=400, detail="PDF output requires the reportlab package")
+    if not await db.departments.find_one({"id": job_data.department_id}, {"_id": 0, "id": 1}):
+        raise HTTPException(status_code=404, detail="Department not found")
+    job = {
+        "id": str(uuid.uuid4()),
+        **job_data.model_dump(mode="json"),
+        "status": "queued",
+        "total": None,
+        "done": 0,
+        "artifact": None,
+        "created_by": current_user['id'],
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "completed_at": None
+    }
+    await db.report_jobs.insert_one(job)
+    start_background_job(run_report_job, job['id'])
+    job.pop('_id', None)
+    return job
+
+@api_router.get("/report-jobs/{job_id}")
+async def get_report_job(job_id: str, current_user: Dict = Depends(require_role([UserRole.ADMIN]))):
+    job = await db.report_jobs.find_one({"id": job_id}, {"_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Report job not found")
+    return job
+
+@api_router.get("/report-jobs/{job_id}/download")
+async def download_report_job(job_id: str, current_user: Dict = Depends(require_role([UserRole.ADMIN]))):
+    job = await db.report_jobs.find_one({"id": job_id}, {"_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Report job not found")
+    if job['status'] != "completed":
+        raise HTTPException(status_code=409, detail="Report job not completed")
+    path = REPORT_ARTIFACT_DIR / job['artifact']
+    if not path.exists():
+        raise HTTPException(status_code=410, detail="Report archive no longer available")
+    return FileResponse(path, media_type="application/zip", filename=f"bulletins-{job_id}.zip")
+
+# Search
+# search_index holds one document per searchable entity. "terms" are the word prefixes
+# (edge n-grams) and "trigrams" the character trigrams of its searchable text; both are
+# multikey-indexed, so prefix lookups and fuzzy candidate selection are index scans.
+SEARCH_VISIBILITY = {
+    "user": [UserRole.ADMIN.value],
+    "student": [UserRole.ADMIN.value, UserRole.TEACHER.value],
+    "teacher": [r.value for r in UserRole],
+    "course": [r.value for r in UserRole]
+}
+
+def search_words(*values: Optional[str]) -> List[str]:
+    text = unicodedata.normalize('NFKD', ' '.join(v for v in values if v)).lower()
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch))
+    return list(dict.fromkeys(re.findall(r'[a-z0-9]+', text)))
+
+def word_trigrams(words: List[str]) -> List[str]:
+    grams = set()
+    for word in words:
+        padded = f" {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return sorted(grams)
+
+def search_document(kind: str, ref_id: str, title: str, subtitle: Optional[str], *values: Optional[str]) -> Dict[str, Any]:
+    words = search_words(*values)
+    terms = {word[:n] for word in words for n in range(1, min(len(word), SEARCH_MAX_PREFIX) + 1)}
+    return {
+        "_id": f"{kind}:{ref_id}",
+        "kind": kind,
+        "ref_id": ref_id,
+        "title": title,
+        "subtitle": subtitle,
+        "words": words,
+        "terms": sorted(terms),
+        "trigrams": word_trigrams(words),
+        "roles": SEARCH_VISIBILITY[kind]
+    }
+
+def full_name(user: Optional[Dict[str, Any]]) -> str:
+    return f"{user.get('first_name', '')} {user.get('last_name', '')}".strip() if user else ""
+
+def user_search_doc(user: Dict[str, Any]) -> Dict[str, Any]:
+    return search_document("user", user['id'], full_name(user), user.get('email'),
+                           user.get('first_name'), user.get('last_name'), user.get('email'))
+
+def student_search_doc(student: Dict[str, Any], user: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    user = user or {}
+    return search_document("student", student['id'], full_name(user) or student['student_number'], student['student_number'],
+                           student['student_number'], user.get('first_name'), user.get('last_name'), user.get('email'))
+
+def teacher_search_doc(teacher: Dict[str, Any], user: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    user = user or {}
+    return search_document("teacher", teacher['id'], full_name(user) or teacher['employee_number'], teacher['employee_number'],
+                           teacher['employee_number'], user.get('first_name'), user.get('last_name'), user.get('email'))
+
+def course_search_doc(course: Dict[str, Any]) -> Dict[str, Any]:
+    return search_document("course", course['id'], course['name'], course['code'], course['name'], course['code'])
+
+async def index_for_search(docs: List[Dict[str, Any]]):
+    if docs:
+        await db.search_index.bulk_write([ReplaceOne({"_id": d['_id']}, d, upsert=True) for d in docs], ordered=False)
+
+async def rebuild_search_index(batch_size: int = 1000):
+    """Re-index every user, student, teacher and course."""
+    async def index_profiles(build, profiles):
+        users = {u['id']: u async for u in db.users.find(
+            {"id": {"$in": [p['user_id'] for p in profiles]}},
+            {"_id": 0, "id": 1, "first_name": 1, "last_name": 1, "email": 1}
+        )}
+        await index_for_search([build(p, users.get(p['user_id'])) for p in profiles])
+    
+    batch = []
+    async for user in db.users.find({}, {"_id": 0, "password": 0}):
+        batch.append(user_search_doc(user))
+        if len(batch) >= batch_size:
+            await index_for_search(batch)
+            batch = []
+    await index_for_search(batch)
+    
+    for collection, build in (("students", student_search_doc), ("teachers", teacher_search_doc)):
+        profiles = []
+        async for profile in db[collection].find({}, {"_id": 0}):
+            profiles.append(profile)
+            if len(profiles) >= batch_size:
+                await index_profiles(build, profiles)
+                profiles = []
+        if profiles:
+            await index_profiles(build, profiles)
+    
+    batch = []
+    async for course in db.courses.find({}, {"_id": 0}):
+        batch.append(course_search_doc(course))
+        if len(batch) >= batch_size:
+            await index_for_search(batch)
+            batch = []
+    await index_for_search(batch)
+
+def search_rank(tokens: List[str]) -> Dict[str, Any]:
+    """Score expression for prefix hits: whole-word matches outrank prefix matches, shorter titles break ties."""
+    return {"$subtract": [
+        {"$add": [2.0, {"$divide": [{"$size": {"$setIntersection": ["$words", tokens]}}, len(tokens)]}]},
+        {"$divide": [{"$strLenCP": {"$ifNull": ["$title", ""]}}, 1000]}
+    ]}
+
+@api_router.get("/search")
+async def search(
+    q: str = Query(..., min_length=2, max_length=100),
+    types: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=100),
+    current_user: Dict = Depends(get_current_user)
+):
+    tokens = [t[:SEARCH_MAX_PREFIX] for t in search_words(q)][:5]
+    if not tokens:
+        return []
+    base: Dict[str, Any] = {"roles": current_user['role']}
+    if types:
+        kinds = [t.strip() for t in types.split(',') if t.strip()]
+        unknown = [k for k in kinds if k not in SEARCH_VISIBILITY]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown types: {', '.join(unknown)}")
+        base['kind'] = {"$in": kinds}
+    projection = {"kind": 1, "ref_id": 1, "title": 1, "subtitle": 1}
+    
+    # Prefix matches: every query token must start some word of the entity. Ranked
+    # server-side over all of them so exact matches aren't lost to an arbitrary subset.
+    prefix_hits = await db.search_index.aggregate([
+        {"$match": {**base, "terms": {"$all": tokens}}},
+        {"$project": {**projection, "score": search_rank(tokens)}},
+        {"$sort": {"score": -1, "_id": 1}},
+        {"$limit": limit}
+    ]).to_list(limit)
+    results = [(d['score'], d) for d in prefix_hits]
+    
+    # Fuzzy matches by trigram overlap, for typos the prefixes can't catch
+    if len(results) < limit:
+        query_grams = word_trigrams(tokens)
+        fuzzy_hits = await db.search_index.aggregate([
+            {"$match": {**base, "trigrams": {"$in": query_grams}, "_id": {"$nin": [d['_id'] for _, d in results]}}},
+            {"$project": {**projection, "similarity": {"$divide": [
+                {"$size": {"$setIntersection": ["$trigrams", query_grams]}}, len(query_grams)
+            ]}}},
+            {"$match": {"similarity": {"$gte": SEARCH_MIN_SIMILARITY}}},
+            {"$sort": {"similarity": -1}},
+            {"$limit": limit - len(results)}
+        ]).to_list(limit)
+        results += [(d['similarity'], d) for d in fuzzy_hits]
+    
+    return [
+        {"type": d['kind'], "id": d['ref_id'], "title": d['title'], "subtitle": d.get('subtitle'), "score": round(score, 3)}
+        for score, d in results
+    ]
+
+@api_router.post("/search/rebuild")
+async def rebuild_search_index_route(current_user: Dict = Depends(require_role([UserRole.ADMIN]))):
+    start_background_job(rebuild_search_index)
+    return {"message": "Search index rebuild started"}
+
+# Analytics Routes
+# Per-process cache of computed grade analytics, dropped on every grade write.
+# The generation is bumped on each drop so a computation that started before the
+# write can't repopulate the cache with its stale result.
+grade_analytics_cache: Dict[Tuple, Dict[str, Any]] = {}
+grade_analytics_generation = 0
+
+def invalidate_grade_analytics():
+    global grade_analytics_generation
+    grade_analytics_generation += 1
+    grade_analytics_cache.clear()
+
+async def cached_grade_analytics(route: str, key: Tuple, compute) -> Dict[str, Any]:
+    cached = grade_analytics_cache.get(key)
+    if cached is not None:
+        return cached
+    generation = grade_analytics_generation
+    # Cache misses for the same key and generation wait on one computation
+    result = await single_flight.run(route, (*key, generation), compute)
+    if generation == grade_analytics_generation:
+        if len(grade_analytics_cache) >= GRADE_ANALYTICS_CACHE_SIZE:
+            del grade_analytics_cache[next(iter(grade_analytics_cache))]
+        grade_analytics_cache[key] = result
+    return result
+
+def summarize_grades(values: np.ndarray, pass_mark: float, edges: np.ndarray) -> Dict[str, Any]:
+    if values.size == 0:
+        return {"count": 0, "mean": None, "median": None, "std": None, "min": None, "max": None,
+                "percentiles": {}, "histogram": {"edges": edges.tolist(), "counts": [0] * (edges.size - 1)},
+                "pass_rate": None}
+    p10, p25, p50, p75, p90 = np.percentile(values, [10, 25, 50, 75, 90])
+    counts, _ = np.histogram(np.clip(values, edges[0], edges[-1]), bins=edges)
+    return {
+        "count": int(values.size),
+        "mean": round(float(values.mean()), 2),
+        "median": round(float(p50), 2),
+        "std": round(float(values.std()), 2),
+        "min": round(float(values.min()), 2),
+        "max": round(float(values.max()), 2),
+        "percentiles": {"p10": round(float(p10), 2), "p25": round(float(p25), 2),
+                        "p75": round(float(p75), 2), "p90": round(float(p90), 2)},
+        "histogram": {"edges": edges.tolist(), "counts": counts.tolist()},
+        "pass_rate": round(float(np.count_nonzero(values >= pass_mark)) / values.size * 100, 2)
+    }
+
+async def compute_grade_analytics(match: Dict[str, Any], pass_mark: float, bins: int) -> Dict[str, Any]:
+    # Let Mongo pack percentages into one array per (course, exam) so we never
+    # materialise a Python dict per grade row
+    pipeline = [
+        {"$match": match},
+        {"$group": {
+            "_id": {"course_id": "$course_id", "exam_id": "$exam_id"},
+            "values": {"$push": "$percentage"}
+        }},
+        {"$sort": {"_id.course_id": 1, "_id.exam_id": 1}}
+    ]
+    edges = np.linspace(0.0, 100.0, bins + 1)
+    courses: Dict[str, Dict[str, Any]] = {}
+    async for group in db.grades.aggregate(pipeline, allowDiskUse=True):
+        values = np.asarray(group['values'], dtype=np.float64)
+        course = courses.setdefault(group['_id']['course_id'], {"values": [], "exams": []})
+        course['values'].append(values)
+        course['exams'].append({"exam_id": group['_id'].get('exam_id'), **summarize_grades(values, pass_mark, edges)})
+    
+    course_summaries = []
+    all_values = []
+    for course_id, course in courses.items():
+        values = np.concatenate(course['values'])
+        all_values.append(values)
+        course_summaries.append({
+            "course_id": course_id,
+            **summarize_grades(values, pass_mark, edges),
+            "exams": course['exams']
+        })
+    overall = np.concatenate(all_values) if all_values else np.empty(0)
+    return {
+        "pass_mark": pass_mark,
+        "overall": summarize_grades(overall, pass_mark, edges),
+        "courses": course_summaries
+    }
+
+@api_router.get("/analytics/courses/{course_id}/grades")
+async def get_course_grade_analytics(
+    course_id: str,
+    pass_mark: float = Query(50.0, ge=0, le=100),
+    bins: int = Query(10, ge=1, le=100),
+    current_user: Dict = Depends(require_role([UserRole.ADMIN, UserRole.TEACHER]))
+):
+    async def compute() -> Dict[str, Any]:
+        course = await db.courses.find_one({"id": course_id}, {"_id": 0, "id": 1})
+        if not course:
+            raise HTTPException(status_code=404, detail="Course not found")
+        analytics = await compute_grade_analytics({"course_id": course_id}, pass_mark, bins)
+        course_summary = analytics['courses'][0] if analytics['courses'] else {"exams": []}
+        return {
+            "course_id": course_id,
+            "pass_mark": pass_mark,
+            "overall": analytics['overall'],
+            "exams": course_summary['exams']
+        }
+    return await cached_grade_analytics("course_grade_analytics", ("course", course_id, pass_mark, bins), compute)
+
+@api_router.get("/analytics/departments/{department_id}/grades")
+async def get_department_grade_analytics(
+    department_id: str,
+    pass_mark: float = Query(50.0, ge=0, le=100),
+    bins: int = Query(10, ge=1, le=100),
+    current_user: Dict = Depends(require_role([UserRole.ADMIN, UserRole.TEACHER]))
+):
+    async def compute() -> Dict[str, Any]:
+        course_ids = [c['id'] async for c in db.courses.find({"department_id": department_id}, {"_id": 0, "id": 1})]
+        analytics = await compute_grade_analytics({"course_id": {"$in": course_ids}}, pass_mark, bins)
+        return {"department_id": department_id, **analytics}
+    return await cached_grade_analytics("department_grade_analytics", ("department", department_id, pass_mark, bins), compute)
+
+# Status codes used in the students x sessions matrix; -1 means no record
+ATTENDANCE_STATUS_CODES = {s.value: i for i, s in enumerate(AttendanceStatus)}
+ATTENDANCE_STATUS_NAMES = np.array([s.value for s in AttendanceStatus] + [None], dtype=object)
+
+async def compute_attendance_analytics(
+    match: Dict[str, Any],
+    min_rate: float,
+    max_absence_streak: int,
+    max_late_ratio: float,
+    include_matrix: bool
+) -> Dict[str, Any]:
+    # Let Mongo pack dates and statuses into arrays per (student, course) so the
+    # NumPy inputs are built per group rather than per attendance row
+    pipeline = [
+        {"$match": {**match, "status": {"$in": list(ATTENDANCE_STATUS_CODES)}}},
+        {"$group": {
+            "_id": {"student_id": "$student_id", "course_id": "$course_id"},
+            "dates": {"$push": "$date"},
+            "statuses": {"$push": "$status"}
+        }}
+    ]
+    group_students, group_courses, group_sizes, dates, statuses = [], [], [], [], []
+    async for group in db.attendance.aggregate(pipeline, allowDiskUse=True):
+        group_students.append(group['_id']['student_id'])
+        group_courses.append(group['_id']['course_id'])
+        group_sizes.append(len(group['dates']))
+        dates.append(np.asarray(group['dates']))
+        statuses.append(np.asarray(group['statuses'], dtype=object))
+    
+    thresholds = {
+        "min_rate": min_rate,
+        "max_absence_streak": max_absence_streak,
+        "max_late_ratio": max_late_ratio
+    }
+    if not group_sizes:
+        return {"thresholds": thresholds, "sessions": 0, "at_risk_count": 0, "students": []}
+    
+    group_sizes = np.asarray(group_sizes)
+    status_names, status_idx = np.unique(np.concatenate(statuses), return_inverse=True)
+    codes = np.fromiter((ATTENDANCE_STATUS_CODES[name] for name in status_names),
+                        dtype=np.int8, count=status_names.size)[status_idx]
+    students, student_idx = np.unique(np.asarray(group_students), return_inverse=True)
+    student_idx = np.repeat(student_idx, group_sizes)
+    days, day_idx = np.unique(np.concatenate(dates), return_inverse=True)
+    courses, course_idx = np.unique(np.asarray(group_courses), return_inverse=True)
+    course_idx = np.repeat(course_idx, group_sizes)
+    # A session is one course meeting on one day; ordering by day first keeps sessions chronological
+    sessions, session_idx = np.unique(day_idx * courses.size + course_idx, return_inverse=True)
+    n_students = students.size
+    
+    counts = np.bincount(
+        student_idx * len(ATTENDANCE_STATUS_CODES) + codes,
+        minlength=n_students * len(ATTENDANCE_STATUS_CODES)
+    ).reshape(n_students, len(ATTENDANCE_STATUS_CODES))
+    present = counts[:, ATTENDANCE_STATUS_CODES[AttendanceStatus.PRESENT.value]]
+    absent = counts[:, ATTENDANCE_STATUS_CODES[AttendanceStatus.ABSENT.value]]
+    late = counts[:, ATTENDANCE_STATUS_CODES[AttendanceStatus.LATE.value]]
+    excused = counts[:, ATTENDANCE_STATUS_CODES[AttendanceStatus.EXCUSED.value]]
+    attended = present + late
+    countable = attended + absent  # excused sessions don't count against the rate
+    rate = np.where(countable > 0, attended / np.maximum(countable, 1) * 100, 100.0)
+    late_ratio = np.where(attended > 0, late / np.maximum(attended, 1), 0.0)
+    
+    # Longest run of consecutive absences per student, over that student's own sessions
+    order = np.lexsort((session_idx, student_idx))
+    sorted_students = student_idx[order]
+    sorted_absent = codes[order] == ATTENDANCE_STATUS_CODES[AttendanceStatus.ABSENT.value]
+    continues_run = np.zeros_like(sorted_absent)
+    continues_run[1:] = sorted_absent[:-1] & (sorted_students[1:] == sorted_students[:-1])
+    run_starts = sorted_absent & ~continues_run
+    longest_streak = np.zeros(n_students, dtype=np.int64)
+    if run_starts.any():
+        run_ids = np.cumsum(run_starts) - 1
+        run_lengths = np.bincount(run_ids[sorted_absent])
+        np.maximum.at(longest_streak, sorted_students[run_starts], run_lengths)
+    
+    low_rate = rate < min_rate
+    long_streak = longest_streak >= max_absence_streak
+    often_late = late_ratio > max_late_ratio
+    at_risk = low_rate | long_streak | often_late
+    
+    report = []
+    for i in np.argsort(rate, kind="stable"):
+        reasons = [name for name, flag in (("low_attendance_rate", low_rate[i]),
+                                           ("absence_streak", long_streak[i]),
+                                           ("frequent_lateness", often_late[i])) if flag]
+        report.append({
+            "student_id": str(students[i]),
+            "recorded": int(counts[i].sum()),
+            "present": int(present[i]),
+            "absent": int(absent[i]),
+            "late": int(late[i]),
+            "excused": int(excused[i]),
+            "attendance_rate": round(float(rate[i]), 2),
+            "late_ratio": round(float(late_ratio[i]), 3),
+            "longest_absence_streak": int(longest_streak[i]),
+            "at_risk": bool(at_risk[i]),
+            "reasons": reasons
+        })
+    
+    result = {
+        "thresholds": thresholds,
+        "sessions": int(sessions.size),
+        "at_risk_count": int(at_risk.sum()),
+        "students": report
+    }
+    if include_matrix:
+        matrix = np.full((n_students, sessions.size), -1, dtype=np.int8)
+        matrix[student_idx, session_idx] = codes
+        session_days = sessions // courses.size
+        session_courses = sessions % courses.size
+        result['matrix'] = {
+            "student_ids": students.tolist(),
+            "sessions": [{"course_id": str(courses[c]), "date": str(days[d])}
+                         for d, c in zip(session_days, session_courses)],
+            "statuses": ATTENDANCE_STATUS_NAMES[matrix].tolist()
+        }
+    return result
+
+def attendance_match(course_ids: Any, start_date: Optional[str], end_date: Optional[str]) -> Dict[str, Any]:
+    match: Dict[str, Any] = {"course_id": course_ids}
+    if start_date or end_date:
+        match['date'] = {}
+        if start_date:
+            match['date']['$gte'] = start_date
+        if end_date:
+            match['date']['$lte'] = end_date
+    return match
+
+@api_router.get("/analytics/courses/{course_id}/attendance")
+async def get_course_attendance_analytics(
+    course_id: str,
+    start_date: Optional[str] = Query(None, pattern=DATE_PATTERN),
+    end_date: Optional[str] = Query(None, pattern=DATE_PATTERN),
+    min_rate: float = Query(ATTENDANCE_MIN_RATE, ge=0, le=100),
+    max_absence_streak: int = Query(ATTENDANCE_MAX_ABSENCE_STREAK, ge=1),
+    max_late_ratio: float = Query(ATTENDANCE_MAX_LATE_RATIO, ge=0, le=1),
+    include_matrix: bool = False,
+    current_user: Dict = Depends(require_role([UserRole.ADMIN, UserRole.TEACHER]))
+):
+    course = await db.courses.find_one({"id": course_id}, {"_id": 0, "id": 1})
+    if not course:
+        raise HTTPException(status_code=404, detail="Course not found")
+    analytics = await compute_attendance_analytics(
+        attendance_match(course_id, start_date, end_date),
+        min_rate, max_absence_streak, max_late_ratio, include_matrix
+    )
+    return {"course_id": course_id, "start_date": start_date, "end_date": end_date, **analytics}
+
+@api_router.get("/analytics/departments/{department_id}/attendance")
+async def get_department_attendance_analytics(
+    department_id: str,
+    start_date: Optional[str] = Query(None, pattern=DATE_PATTERN),
+    end_date: Optional[str] = Query(None, pattern=DATE_PATTERN),
+    min_rate: float = Query(ATTENDANCE_MIN_RATE, ge=0, le=100),
+    max_absence_streak: int = Query(ATTENDANCE_MAX_ABSENCE_STREAK, ge=1),
+    max_late_ratio: float = Query(ATTENDANCE_MAX_LATE_RATIO, ge=0, le=1),
+    include_matrix: bool = False,
+    current_user: Dict = Depends(require_role([UserRole.ADMIN, UserRole.TEACHER]))
+):
+    course_ids = [c['id'] async for c in db.courses.find({"department_id": department_id}, {"_id": 0, "id": 1})]
+    analytics = await compute_attendance_analytics(
+        attendance_match({"$in": course_ids}, start_date, end_date),
+        min_rate, max_absence_streak, max_late_ratio, include_matrix
+    )
+    return {"department_id": department_id, "start_date": start_date, "end_date": end_date, **analytics}
+
+# Export Routes
+async def export_chunks(cursor, columns: List[str], export_format: ExportFormat) -> AsyncIterator[bytes]:
+    """Serialize documents from a cursor into ~EXPORT_CHUNK_BYTES chunks."""
+    buffer = io.StringIO()
+    writer = None
+    if export_format == ExportFormat.CSV:
+        writer = csv.DictWriter(buffer, fieldnames=columns, extrasaction='ignore')
+        writer.writeheader()
+    async for doc in cursor:
+        if writer:
+            writer.writerow(doc)
+        else:
+            buffer.write(json.dumps(doc, ensure_ascii=False, default=str))
+            buffer.write('\n')
+        if buffer.tell() >= EXPORT_CHUNK_BYTES:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+async def gzip_chunks(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    compressor = zlib.compressobj(wbits=31)  # gzip container
+    async for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+@api_router.get("/export/{collection}")
+async def export_collection(
+    collection: ExportCollection,
+    format: ExportFormat = ExportFormat.CSV,
+    course_id: Optional[str] = None,
+    department_id: Optional[str] = None,
+    start_date: Optional[str] = Query(None, pattern=DATE_PATTERN),
+    end_date: Optional[str] = Query(None, pattern=DATE_PATTERN),
+    compress: bool = Query(False, alias="gzip"),
+    current_user: Dict = Depends(require_role([UserRole.ADMIN]))
+):
+    model, date_field = {
+        ExportCollection.GRADES: (Grade, "graded_at"),
+        ExportCollection.ATTENDANCE: (Attendance, "date")
+    }[collection]
+    
+    query: Dict[str, Any] = {}
+    if department_id:
+        course_ids = [c['id'] async for c in db.courses.find({"department_id": department_id}, {"_id": 0, "id": 1})]
+        if course_id:
+            course_ids = [c for c in course_ids if c == course_id]
+        query['course_id'] = {"$in": course_ids}
+    elif course_id:
+        query['course_id'] = course_id
+    if start_date or end_date:
+        query[date_field] = {}
+        if start_date:
+            query[date_field]['$gte'] = start_date
+        if end_date:
+            # Dates and ISO timestamps compare lexically; stop before the following day
+            next_day = (datetime.fromisoformat(end_date) + timedelta(days=1)).date().isoformat()
+            query[date_field]['$lt'] = next_day
+    
+    columns = list(model.model_fields)
+    projection = {"_id": 0, **{c: 1 for c in columns}}
+    cursor = db[collection.value].find(query, projection).batch_size(EXPORT_BATCH_SIZE)
+    
+    chunks = export_chunks(cursor, columns, format)
+    extension = format.value
+    media_type = "text/csv; charset=utf-8" if format == ExportFormat.CSV else "application/x-ndjson"
+    if compress:
+        chunks = gzip_chunks(chunks)
+        extension += ".gz"
+        media_type = "application/gzip"
+    filename = f"{collection.value}-{datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')}.{extension}"
+    return StreamingResponse(
+        chunks,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+# Archive Routes
+# Hot collections that roll over into per-year archives, with the field that dates each document
+ARCHIVED_COLLECTIONS = {"grades": "graded_at", "attendance": "date", "enrollments": "enrolled_at"}
+
+def academic_year_range(academic_year: str) -> Tuple[str, str]:
+    """Return [start, end) dates for an academic year such as '2023-2024'."""
+    start_year, end_year = (int(part) for part in academic_year.split('-'))
+    if end_year != start_year + 1:
+        raise HTTPException(status_code=400, detail="Academic year must span two consecutive years")
+    return (f"{start_year}-{ACADEMIC_YEAR_START_MONTH:02d}-01", f"{end_year}-{ACADEMIC_YEAR_START_MONTH:02d}-01")
+
+def current_academic_year() -> str:
+    today = datetime.now(timezone.utc)
+    start_year = today.year if today.month >= ACADEMIC_YEAR_START_MONTH else today.year - 1
+    return f"{start_year}-{start_year + 1}"
+
+def archive_collection_name(collection: str, academic_year: str) -> str:
+    return f"{collection}_archive_{academic_year.replace('-', '_')}"
+
+async def academic_year_source(collection: str, academic_year: str, query: Dict[str, Any]):
+    """Route a read for one academic year to its archive once that collection has rolled over."""
+    start, end = academic_year_range(academic_year)
+    archive = await db.archives.find_one({"academic_year": academic_year, "collections": collection})
+    if archive:
+        return db[archive_collection_name(collection, academic_year)], query
+    return db[collection], {**query, ARCHIVED_COLLECTIONS[collection]: {"$gte": start, "$lt": end}}
+
+async def remove_archived(collection: str, match: Dict[str, Any]) -> int:
+    """Delete archived documents from the hot collection, leaving tombstones for ?since= clients."""
+    deleted = 0
+    cursor = db[collection].find(match, {"_id": 0, "id": 1}).batch_size(ARCHIVE_DELETE_BATCH_SIZE)
+    batch: List[str] = []
+    async for doc in cursor:
+        batch.append(doc['id'])
+        if len(batch) == ARCHIVE_DELETE_BATCH_SIZE:
+            deleted += await remove_batch(collection, batch)
+            batch = []
+    if batch:
+        deleted += await remove_batch(collection, batch)
+    return deleted
+
+async def remove_batch(collection: str, ids: List[str]) -> int:
+    # Tombstones first: a re-run after a crash repeats them, which clients tolerate
+    await record_removals(collection, ids)
+    result = await db[collection].delete_many({"id": {"$in": ids}})
+    return result.deleted_count
+
+async def archive_academic_year(academic_year: str):
+    """Move a closed academic year out of the hot collections. Safe to re-run."""
+    start, end = academic_year_range(academic_year)
+    await db.archives.update_one(
+        {"academic_year": academic_year},
+        {"$set": {"status": "running", "started_at": datetime.now(timezone.utc).isoformat()},
+         "$setOnInsert": {"collections": [], "counts": {}}},
+        upsert=True
+    )
+    try:
+        for collection, date_field in ARCHIVED_COLLECTIONS.items():
+            name = archive_collection_name(collection, academic_year)
+            if not await db.list_collection_names(filter={"name": name}):
+                await db.create_collection(
+                    name,
+                    storageEngine={"wiredTiger": {"configString": f"block_compressor={ARCHIVE_COMPRESSOR}"}}
+                )
+            await db[name].create_index("id", unique=True)
+            await db[name].create_index("student_id")
+            await db[name].create_index("course_id")
+            
+            # Copy server-side, then drop from the hot collection
+            match = {date_field: {"$gte": start, "$lt": end}}
+            await db[collection].aggregate([
+                {"$match": match},
+                {"$project": {"_id": 0}},
+                {"$merge": {"into": name, "on": "id", "whenMatched": "replace", "whenNotMatched": "insert"}}
+            ]).to_list(None)
+            deleted = await remove_archived(collection, match)
+            await db.archives.update_one(
+                {"academic_year": academic_year},
+                {"$addToSet": {"collections": collection}, "$inc": {f"counts.{collection}": deleted}}
+            )
+            logger.info("Archived %d %s documents for %s", deleted, collection, academic_year)
+    except Exception:
+        await db.archives.update_one({"academic_year": academic_year}, {"$set": {"status": "failed"}})
+        logger.exception("Archiving %s failed", academic_year)
+        raise
+    
+    await db.archives.update_one(
+        {"academic_year": academic_year},
+        {"$set": {"status": "completed", "archived_at": datetime.now(timezone.utc).isoformat()}}
+    )
+    invalidate_grade_analytics()
+    timetable_cache.clear()
+
+@api_router.post("/archives/{academic_year}", status_code=202)
+async def start_archive(academic_year: str, current_user: Dict = Depends(require_role([UserRole.ADMIN]))):
+    if not re.match(ACADEMIC_YEAR_PATTERN, academic_year):
+        raise HTTPException(status_code=400, detail="Academic year must look like 2023-2024")
+    academic_year_range(academic_year)
+    if academic_year >= current_academic_year():
+        raise HTTPException(status_code=400, detail="Only closed academic years can be archived")
+    running = await db.archives.find_one({"academic_year": academic_year, "status": "running"})
+    if running:
+        raise HTTPException(status_code=409, detail="Archive already running")
+    start_background_job(archive_academic_year, academic_year)
+    return {"message": "Archive started", "academic_year": academic_year}
+
+@api_router.get("/archives")
+async def get_archives(current_user: Dict = Depends(require_role([UserRole.ADMIN]))):
+    return await db.archives.find({}, {"_id": 0}).sort("academic_year", -1).to_list(100)
+
+# Batch Routes
+# Routes that can't be batched: nested batches, and streaming responses we would have to buffer
+BATCH_EXCLUDED_PREFIXES = ("/api/batch", "/api/export/")
+
+async def dispatch_subrequest(request: Request, item: BatchItem) -> Dict[str, Any]:
+    url = urlsplit(item.path)
+    if item.method.upper() != "GET":
+        return {"id": item.id, "status": 405, "body": {"detail": "Only GET requests can be batched"}}
+    if not url.path.startswith("/api/") or url.path.startswith(BATCH_EXCLUDED_PREFIXES):
+        return {"id": item.id, "status": 400, "body": {"detail": "Path cannot be batched"}}
+    
+    scope = {
+        "type": "http",
+        "asgi": request.scope.get("asgi", {"version": "3.0"}),
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": request.url.scheme,
+        "server": request.scope.get("server"),
+        "client": request.scope.get("client"),
+        "root_path": request.scope.get("root_path", ""),
+        "path": url.path,
+        "raw_path": url.path.encode(),
+        "query_string": url.query.encode(),
+        "headers": [
+            (b"authorization", request.headers.get("authorization", "").encode()),
+            (b"accept", b"application/json")
+        ]
+    }
+    response: Dict[str, Any] = {"status": 500, "headers": {}, "body": bytearray()}
+    
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+    
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+            response["headers"] = {k.decode().lower(): v.decode() for k, v in message.get("headers", [])}
+        elif message["type"] == "http.response.body":
+            response["body"] += message.get("body", b"")
+    
+    try:
+        await request.app(scope, receive, send)
+    except Exception:
+        # The error middleware has already sent a 500; keep the rest of the batch alive
+        logger.exception("Batched request failed: %s", item.path)
+        return {"id": item.id, "status": 500, "body": {"detail": "Internal Server Error"}}
+    body: Any = bytes(response["body"])
+    if response["headers"].get("content-type", "").startswith("application/json"):
+        body = json.loads(body) if body else None
+    else:
+        body = body.decode("utf-8", errors="replace")
+    return {"id": item.id, "status": response["status"], "body": body}
+
+@api_router.post("/batch")
+async def batch(batch_request: BatchRequest, request: Request, current_user: Dict = Depends(get_current_user)):
+    # Sub-requests run as tasks that inherit this context, so they reuse the principal
+    batch_principal.set(current_user)
+    responses = await asyncio.gather(*(dispatch_subrequest(request, item) for item in batch_request.requests))
+    return {"responses": responses}
 
 # Dashboard Stats
 @api_router.get("/stats/dashboard")
@@ -765,19 +3333,273 @@ async def get_dashboard_stats(current_user: Dict = Depends(get_current_user)):
         )]
         exams = await db.exams.count_documents({"course_id": {"$in": course_ids}})
         
-        grades = await db.grades.find({"student_id": student['id']}, {"_id": 0}).to_list(1000)
-        average = sum(g['percentage'] for g in grades) / len(grades) if grades else 0
+        summary = academic_summary(student['id'], await db.academic_summaries.find_one({"_id": student['id']}))
         
         return {
             "enrolled_courses": enrollments,
             "upcoming_exams": exams,
-            "average_grade": round(average, 2)
+            "average_grade": summary['weighted_average'] or 0,
+            "credits_attempted": summary['credits_attempted'],
+            "credits_earned": summary['credits_earned']
         }
     
     return {}
 
+# Admission Control
+# Each worker admits at most ADMISSION_MAX_CONCURRENCY requests at once. The rest wait
+# in a priority queue for up to ADMISSION_QUEUE_BUDGET_SECONDS and are then shed with a
+# 503. Admitted requests run under a deadline that pymongo.timeout() turns into
+# maxTimeMS on every Mongo operation they issue.
+# (path prefix, priority, deadline in seconds); lower priorities are admitted first,
+# a None deadline leaves long-running streams and uploads unbounded
+ADMISSION_CLASSES: List[Tuple[str, int, Optional[float]]] = [
+    ("/api/auth/", 0, REQUEST_DEADLINE_SECONDS),
+    ("/api/stats/dashboard", 0, REQUEST_DEADLINE_SECONDS),
+    ("/api/export/", 2, None),
+    ("/api/import/", 2, None),
+    ("/api/report-jobs", 2, None),
+    ("/api/analytics/", 2, BULK_REQUEST_DEADLINE_SECONDS),
+    ("/api/attendance/rollups/", 2, BULK_REQUEST_DEADLINE_SECONDS),
+]
+ADMISSION_DEFAULT_CLASS = (1, REQUEST_DEADLINE_SECONDS)
+
+# Deadline of the request being served; set for batched sub-requests too, which run
+# under their parent's admission slot and deadline
+request_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar('request_deadline', default=None)
+
+def admission_class(path: str) -> Tuple[int, Optional[float]]:
+    for prefix, priority, deadline in ADMISSION_CLASSES:
+        if path.startswith(prefix):
+            return priority, deadline
+    return ADMISSION_DEFAULT_CLASS
+
+class AdmissionController:
+    def __init__(self, limit: int, max_queue: int):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.active = 0
+        self.queued = 0
+        self.waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self.order = itertools.count()
+        self.metrics = {"admitted": 0, "queued": 0, "shed": 0, "deadline_exceeded": 0}
+    
+    async def acquire(self, priority: int, budget: float) -> bool:
+        if self.active < self.limit and not self.queued:
+            self.active += 1
+            self.metrics['admitted'] += 1
+            return True
+        if self.queued >= self.max_queue:
+            self.metrics['shed'] += 1
+            return False
+        
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.order), waiter))
+        self.queued += 1
+        self.metrics['queued'] += 1
+        try:
+            await asyncio.wait([waiter], timeout=budget)
+        except asyncio.CancelledError:
+            # Client went away while queued; hand back a slot granted in the meantime
+            if waiter.done():
+                self.release()
+            else:
+                self.queued -= 1
+                waiter.cancel()
+            raise
+        if waiter.done():
+            self.metrics['admitted'] += 1
+            return True
+        self.queued -= 1
+        waiter.cancel()
+        self.metrics['shed'] += 1
+        return False
+    
+    def release(self):
+        # Pass the slot straight to the most urgent waiter; cancelled ones are skipped lazily
+        while self.waiters:
+            _, _, waiter = heapq.heappop(self.waiters)
+            if not waiter.cancelled():
+                self.queued -= 1
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+admission = AdmissionController(ADMISSION_MAX_CONCURRENCY, ADMISSION_MAX_QUEUE)
+
+def overloaded_response(detail: str) -> JSONResponse:
+    return JSONResponse({"detail": detail}, status_code=503, headers={"Retry-After": str(ADMISSION_RETRY_AFTER_SECONDS)})
+
+class AdmissionControlMiddleware:
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or request_deadline.get() is not None or scope["path"] in PROBE_PATHS:
+            await self.app(scope, receive, send)
+            return
+        
+        arrived = time.monotonic()
+        priority, deadline = admission_class(scope["path"])
+        if not await admission.acquire(priority, ADMISSION_QUEUE_BUDGET_SECONDS):
+            await overloaded_response("Server overloaded, retry later")(scope, receive, send)
+            return
+        
+        started = False
+        
+        async def send_tracked(message):
+            nonlocal started
+            started = started or message["type"] == "http.response.start"
+            await send(message)
+        
+        token = request_deadline.set(arrived + deadline if deadline is not None else math.inf)
+        try:
+            if deadline is None:
+                await self.app(scope, receive, send_tracked)
+            else:
+                with pymongo.timeout(max(arrived + deadline - time.monotonic(), 0.001)):
+                    await self.app(scope, receive, send_tracked)
+        except PyMongoError as e:
+            if not e.timeout or started:
+                raise
+            admission.metrics['deadline_exceeded'] += 1
+            await overloaded_response("Request deadline exceeded")(scope, receive, send)
+        finally:
+            request_deadline.reset(token)
+            admission.release()
+
+@api_router.get("/admission/metrics")
+async def get_admission_metrics(current_user: Dict = Depends(require_role([UserRole.ADMIN]))):
+    return {
+        "limit": admission.limit,
+        "active": admission.active,
+        "waiting": admission.queued,
+        **admission.metrics
+    }
+
+# Access Logging
+REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+class AccessLogMiddleware:
+    """Assigns each request an id and logs route, principal, status, duration and Mongo totals."""
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or request_log.get() is not None or scope["path"] in PROBE_PATHS:
+            await self.app(scope, receive, send)
+            return
+        
+        incoming = dict(scope["headers"]).get(b"x-request-id", b"").decode("latin-1")
+        request_id = incoming if REQUEST_ID_PATTERN.match(incoming) else uuid.uuid4().hex
+        entry = {"request_id": request_id, "user_id": None, "role": None, "mongo_calls": 0, "mongo_ms": 0.0}
+        status_code = 500
+        
+        async def send_logged(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                message["headers"] = [*message.get("headers", []), (b"x-request-id", request_id.encode())]
+            await send(message)
+        
+        token = request_log.set(entry)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_logged)
+        finally:
+            duration_ms = (time.perf_counter() - started) * 1000
+            request_log.reset(token)
+            if status_code >= 400 or duration_ms >= ACCESS_LOG_SLOW_MS or random.random() < ACCESS_LOG_SAMPLE_RATE:
+                route = scope.get("route")
+                access_logger.info("request", extra={"fields": {
+                    "request_id": request_id,
+                    "method": scope["method"],
+                    "route": getattr(route, "path", scope["path"]),
+                    "status": status_code,
+                    "duration_ms": round(duration_ms, 1),
+                    "user_id": entry['user_id'],
+                    "role": entry['role'],
+                    "mongo_calls": entry['mongo_calls'],
+                    "mongo_ms": round(entry['mongo_ms'], 1),
+                    "sampled": status_code < 400 and duration_ms < ACCESS_LOG_SLOW_MS
+                }})
+
+@api_router.get("/coalescing/metrics")
+async def get_coalescing_metrics(current_user: Dict = Depends(require_role([UserRole.ADMIN]))):
+    return single_flight.report()
+
+# Lifespan
+# Workers start serving immediately but report ready only once warm-up has opened the
+# connection pool, ensured indexes and built the serializers, retrying while Mongo is down.
+PROBE_PATHS = ("/healthz", "/readyz")
+readiness: Dict[str, Any] = {"ready": False, "ready_in_ms": None, "error": None}
+
+async def warm_connection_pool():
+    # Concurrent pings each check out a connection, so the pool opens this many at once
+    admin = get_client().admin
+    await asyncio.gather(*(admin.command('ping') for _ in range(max(MONGO_WARM_CONNECTIONS, 1))))
+
+def warm_caches():
+    # Pydantic builds validators and serializers lazily; build the list adapters up front
+    for model in (User, Department, Student, Teacher, Course, Enrollment, RosterEntry,
+                  Exam, Grade, Attendance, Notification, Schedule):
+        list_adapter(model)
+
+async def warm_up():
+    started = time.perf_counter()
+    delay = 0.5
+    while True:
+        try:
+            await warm_connection_pool()
+            await ensure_indexes()
+            await stamp_legacy_changes()
+            warm_caches()
+            break
+        except PyMongoError as e:
+            readiness['error'] = str(e)
+            logger.warning("Warm-up failed, retrying in %.1fs: %s", delay, e)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
+    readiness.update(ready=True, error=None, ready_in_ms=round((time.perf_counter() - started) * 1000, 1))
+    logger.info("Worker ready in %.0f ms", readiness['ready_in_ms'])
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Started here rather than at import so each lifespan pairs it with the stop() below
+    log_listener.start()
+    warm_task = asyncio.create_task(warm_up())
+    try:
+        yield
+    finally:
+        readiness['ready'] = False
+        warm_task.cancel()
+        await drain_background_jobs()
+        close_client()
+        shutdown_hash_pool()
+        shutdown_report_pool()
+        log_listener.stop()
+
+# Create the main app
+app = FastAPI(title="Campus Manager API", lifespan=lifespan)
+
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    if not readiness['ready']:
+        return JSONResponse({"status": "warming", "error": readiness['error']}, status_code=503)
+    try:
+        with pymongo.timeout(READINESS_PING_TIMEOUT_SECONDS):
+            await get_client().admin.command('ping')
+    except PyMongoError as e:
+        return JSONResponse({"status": "unavailable", "error": str(e)}, status_code=503)
+    return {"status": "ready", "ready_in_ms": readiness['ready_in_ms']}
+
 # Include router
-app.include_router(api_router)
+app.include_router(api_router, dependencies=[Depends(select_db_profile)])
+
+app.add_middleware(AdmissionControlMiddleware)
 
 app.add_middleware(
     CORSMiddleware,
@@ -787,12 +3609,77 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger(__name__)
+app.add_middleware(AccessLogMiddleware)
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", None)
+        }
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class RequestContextFilter(logging.Filter):
+    # Runs on the thread that logs, before the record is queued, so the request's contextvars are visible
+    def filter(self, record: logging.LogRecord) -> bool:
+        entry = request_log.get()
+        record.request_id = entry['request_id'] if entry else None
+        return True
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    # Keep the hot path to an enqueue: the listener thread does the message formatting
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.exc_info and not record.exc_text:
+            # Tracebacks can't cross the queue; render them while they still exist
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+log_queue: queue.SimpleQueue = queue.SimpleQueue()
+log_stream_handler = logging.StreamHandler()
+log_stream_handler.setFormatter(JsonLogFormatter())
+log_listener = logging.handlers.QueueListener(log_queue, log_stream_handler, respect_handler_level=True)
+queue_handler = DeferredQueueHandler(log_queue)
+queue_handler.addFilter(RequestContextFilter())
+logging.basicConfig(level=LOG_LEVEL, handlers=[queue_handler], force=True)
+# uvicorn installs its own synchronous stream handlers before importing the app; send
+# its server logs through the queue too. Its access log duplicates the "access" logger
+# below and is turned off with --no-access-log.
+for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+    logging.getLogger(name).handlers.clear()
+    logging.getLogger(name).propagate = True
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
+logger = logging.getLogger(__name__)
+access_logger = logging.getLogger("access")
+
+async def ensure_indexes():
+    await db.users.create_index("id", unique=True)
+    await db.students.create_index("id", unique=True)
+    await db.courses.create_index("id", unique=True)
+    await db.enrollments.create_index([("course_id", 1), ("status", 1), ("enrolled_at", 1)])
+    await db.enrollments.create_index([("student_id", 1), ("course_id", 1)])
+    await db.courses.create_index("department_id")
+    await db.grades.create_index([("course_id", 1), ("exam_id", 1)])
+    await db.attendance.create_index([("course_id", 1), ("date", 1)])
+    await db.grades.create_index("graded_at")
+    for collection in SYNCED_COLLECTIONS:
+        await db[collection].create_index("seq")
+    await db.tombstones.create_index([("collection", 1), ("seq", 1)])
+    await db.search_index.create_index([("terms", 1), ("roles", 1)])
+    await db.search_index.create_index("trigrams")
+    await db.attendance_daily.create_index([("course_id", 1), ("date", 1)])
+    await db.attendance_monthly.create_index([("student_id", 1), ("course_id", 1), ("month", 1)])
+    await db.users.create_index("email")
+    await db.students.create_index("student_number")
+    await db.used_refresh_tokens.create_index("jti", unique=True)
+    await db.used_refresh_tokens.create_index("expires_at", expireAfterSeconds=0)
+    if LOGIN_THROTTLE_BACKEND == 'mongo':
+        await db.login_throttle.create_index("expires_at", expireAfterSeconds=0)
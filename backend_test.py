@@ -1,11 +1,17 @@
 import requests
 import sys
+import os
 import json
+import logging
+import time
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 class CampusManagerTester:
-    def __init__(self, base_url="https://campus-manager-24.preview.emergentagent.com"):
+    def __init__(self, base_url="https://campus-manager-24.preview.emergentagent.com", session=None):
         self.base_url = base_url
+        # Anything with requests' get/post/patch/delete, e.g. a TestClient for in-process runs
+        self.session = session or requests
         self.api_url = f"{base_url}/api"
         self.tokens = {}
         self.users = {}
@@ -36,13 +42,13 @@ class CampusManagerTester:
 
         try:
             if method == 'GET':
-                response = requests.get(url, headers=headers)
+                response = self.session.get(url, headers=headers)
             elif method == 'POST':
-                response = requests.post(url, json=data, headers=headers)
+                response = self.session.post(url, json=data, headers=headers)
             elif method == 'PATCH':
-                response = requests.patch(url, json=data, headers=headers)
+                response = self.session.patch(url, json=data, headers=headers)
             elif method == 'DELETE':
-                response = requests.delete(url, headers=headers)
+                response = self.session.delete(url, headers=headers)
 
             success = response.status_code == expected_status
             return success, response.json() if response.content else {}, response.status_code
@@ -99,6 +105,120 @@ class CampusManagerTester:
                 if success and 'token' in response:
                     self.tokens[user_data['role']] = response['token']
 
+    def test_token_lifecycle(self):
+        """Test access/refresh tokens, refresh rotation and revocation on deactivation"""
+        print("\n🔍 Testing Token Refresh and Revocation...")
+
+        if 'admin' not in self.tokens:
+            self.log_test("Token lifecycle tests", False, "No admin token available")
+            return
+
+        user_data = {
+            "email": f"revoked_{datetime.now().strftime('%H%M%S')}@test.com",
+            "password": "RevokedPass123!",
+            "role": "student",
+            "first_name": "Revoked",
+            "last_name": "User"
+        }
+        success, user, status = self.make_request('POST', 'auth/register', user_data)
+        if not success:
+            self.log_test("Register token lifecycle user", False, f"Status: {status}, Response: {user}")
+            return
+        success, login, status = self.make_request('POST', 'auth/login',
+                                                   {"email": user_data['email'], "password": user_data['password']})
+        if not success:
+            self.log_test("Login token lifecycle user", False, f"Status: {status}, Response: {login}")
+            return
+
+        # Calendar feeds are fetched without a bearer token, so they must check revocation themselves
+        success, feed, status = self.make_request('GET', 'me/timetable/feed', token=login['token'])
+        feed_url = f"{self.base_url}{feed.get('url', '')}"
+        response = self.session.get(feed_url)
+        self.log_test("Fetch calendar feed", success and response.status_code == 200, f"Status: {response.status_code}")
+
+        rotated = None
+        if login.get('refresh_token'):
+            success, response, status = self.make_request('GET', 'auth/me', token=login['token'])
+            self.log_test("Get profile with access token", success and response.get('id') == user['id'],
+                         f"Status: {status}, Response: {response}")
+
+            success, response, status = self.make_request('GET', 'auth/me', token=login['refresh_token'], expected_status=401)
+            self.log_test("Reject refresh token as bearer", success, f"Status: {status}")
+
+            success, rotated, status = self.make_request('POST', 'auth/refresh', {"refresh_token": login['refresh_token']})
+            self.log_test("Refresh access token", success and bool(rotated.get('token')) and bool(rotated.get('refresh_token')),
+                         f"Status: {status}, Response: {rotated}")
+            if success:
+                success, response, status = self.make_request('POST', 'auth/refresh', {"refresh_token": rotated['refresh_token']})
+                self.log_test("Refresh with rotated token", success, f"Status: {status}, Response: {response}")
+            else:
+                rotated = None
+        else:
+            print("ℹ️  Stateless auth is disabled on this server, skipping refresh tests")
+
+        success, response, status = self.make_request('PATCH', f"users/{user['id']}/status?is_active=false",
+                                                      token=self.tokens['admin'])
+        self.log_test("Deactivate user", success, f"Status: {status}, Response: {response}")
+
+        response = self.session.get(feed_url)
+        self.log_test("Reject calendar feed after deactivation", response.status_code == 401, f"Status: {response.status_code}")
+
+        if rotated:
+            success, response, status = self.make_request('GET', 'auth/me', token=rotated['token'], expected_status=401)
+            self.log_test("Reject access token after deactivation", success, f"Status: {status}")
+
+            success, response, status = self.make_request('POST', 'auth/refresh',
+                                                          {"refresh_token": rotated['refresh_token']}, expected_status=401)
+            self.log_test("Reject refresh token after deactivation", success, f"Status: {status}")
+
+            # Replaying a refresh token that was already rotated revokes every token of that user
+            replay_data = {**user_data, "email": f"replayed_{datetime.now().strftime('%H%M%S')}@test.com"}
+            self.make_request('POST', 'auth/register', replay_data)
+            success, login, status = self.make_request('POST', 'auth/login',
+                                                       {"email": replay_data['email'], "password": replay_data['password']})
+            if not success:
+                self.log_test("Login refresh replay user", False, f"Status: {status}, Response: {login}")
+                return
+            success, rotated, status = self.make_request('POST', 'auth/refresh', {"refresh_token": login['refresh_token']})
+            self.log_test("Refresh before replay", success, f"Status: {status}, Response: {rotated}")
+            success, response, status = self.make_request('POST', 'auth/refresh',
+                                                          {"refresh_token": login['refresh_token']}, expected_status=401)
+            self.log_test("Reject replayed refresh token", success, f"Status: {status}")
+            success, response, status = self.make_request('POST', 'auth/refresh',
+                                                          {"refresh_token": rotated['refresh_token']}, expected_status=401)
+            self.log_test("Revoke rotated refresh token after replay", success, f"Status: {status}")
+            success, response, status = self.make_request('GET', 'auth/me', token=rotated['token'], expected_status=401)
+            self.log_test("Revoke access token after replay", success, f"Status: {status}")
+
+    def test_login_throttling(self):
+        """Test that repeated failed logins are rejected with 429 and Retry-After"""
+        print("\n🔍 Testing Login Throttling...")
+
+        user_data = {
+            "email": f"throttled_{datetime.now().strftime('%H%M%S')}@test.com",
+            "password": "ThrottledPass123!",
+            "role": "student",
+            "first_name": "Throttled",
+            "last_name": "User"
+        }
+        success, response, status = self.make_request('POST', 'auth/register', user_data)
+        if not success:
+            self.log_test("Register throttling user", False, f"Status: {status}, Response: {response}")
+            return
+
+        wrong = {"email": user_data['email'], "password": "WrongPass123!"}
+        statuses = []
+        for _ in range(10):
+            response = self.session.post(f"{self.api_url}/auth/login", json=wrong)
+            statuses.append(response.status_code)
+            if response.status_code == 429:
+                break
+        self.log_test("Throttle repeated failed logins", statuses[-1] == 429 and set(statuses[:-1]) <= {401},
+                     f"Statuses: {statuses}")
+        retry_after = response.headers.get('Retry-After', '')
+        self.log_test("Retry-After on throttled login", response.status_code == 429 and retry_after.isdigit()
+                     and int(retry_after) >= 1, f"Retry-After: {retry_after!r}")
+
     def test_departments(self):
         """Test department management (Admin only)"""
         print("\n🔍 Testing Department Management...")
@@ -127,6 +247,18 @@ class CampusManagerTester:
             self.log_test("Get departments", success and len(response) > 0, 
                          f"Status: {status}, Count: {len(response) if success else 0}")
 
+            # Incremental sync: a full pull returns a cursor; a pull from it only repeats
+            # recent changes that haven't settled yet, never anything new
+            success, response, status = self.make_request('GET', 'departments?since=0', token=admin_token)
+            self.log_test("Sync departments", success and len(response.get('items', [])) > 0,
+                         f"Status: {status}, Response: {response}")
+            if success:
+                seen = {d['id'] for d in response['items']}
+                success, response, status = self.make_request('GET', f"departments?since={response['seq']}", token=admin_token)
+                self.log_test("Sync departments since cursor",
+                             success and {d['id'] for d in response.get('items', [])} <= seen,
+                             f"Status: {status}, Response: {response}")
+
     def test_student_management(self):
         """Test student creation and management"""
         print("\n🔍 Testing Student Management...")
@@ -162,10 +294,20 @@ class CampusManagerTester:
                 # Test student status update
                 if self.students['test_student']:
                     student_id = self.students['test_student']['id']
+                    success, pending, status = self.make_request('GET', 'students?status=pending&since=0', token=self.tokens['admin'])
                     success, response, status = self.make_request('PATCH', f'students/{student_id}/status?status=approved', 
                                                                  token=self.tokens['admin'])
                     self.log_test("Update student status", success, f"Status: {status}, Response: {response}")
 
+                    # A filtered sync reports a student that left the filter as removed; since=0
+                    # is a full pull, so start from 1 when nothing has settled yet
+                    success, response, status = self.make_request('GET', f"students?status=pending&since={max(pending.get('seq', 0), 1)}",
+                                                                 token=self.tokens['admin'])
+                    self.log_test("Sync removes students leaving a filter",
+                                 success and student_id in response.get('removed', [])
+                                 and student_id not in {s['id'] for s in response.get('items', [])},
+                                 f"Status: {status}, Response: {response}")
+
     def test_teacher_management(self):
         """Test teacher creation and management"""
         print("\n🔍 Testing Teacher Management...")
@@ -227,6 +369,16 @@ class CampusManagerTester:
             self.log_test("Get courses list", success and len(response) > 0,
                          f"Status: {status}, Count: {len(response) if success else 0}")
 
+            # Get courses with a sparse fieldset
+            success, response, status = self.make_request('GET', 'courses?fields=id,name', token=self.tokens['admin'])
+            self.log_test("Get courses with fields", success and len(response) > 0 and set(response[0]) == {'id', 'name'},
+                         f"Status: {status}, Response: {response[:1] if success else response}")
+
+            # Search by a misspelled prefix of the course name
+            success, response, status = self.make_request('GET', 'search?q=programation&types=course', token=self.tokens['admin'])
+            self.log_test("Search courses", success and any(r['id'] == self.courses['prog101']['id'] for r in response),
+                         f"Status: {status}, Response: {response[:3] if success else response}")
+
     def test_enrollment_system(self):
         """Test course enrollment"""
         print("\n🔍 Testing Enrollment System...")
@@ -251,6 +403,30 @@ class CampusManagerTester:
             self.log_test("Get enrollments", success and len(response) > 0,
                          f"Status: {status}, Count: {len(response) if success else 0}")
 
+            # Get course roster
+            course_id = self.courses['prog101']['id']
+            success, response, status = self.make_request('GET', f'courses/{course_id}/roster', token=self.tokens['admin'])
+            self.log_test("Get course roster", success and len(response) > 0 and response[0].get('email') is not None,
+                         f"Status: {status}, Count: {len(response) if success else 0}")
+
+            # Teachers only see rosters of the courses they teach
+            if 'teacher' in self.tokens:
+                success, response, status = self.make_request('GET', f'courses/{course_id}/roster', token=self.tokens['teacher'])
+                self.log_test("Get own course roster as teacher", success, f"Status: {status}")
+                other = {"name": "Cours sans enseignant", "code": "FREE101", "department_id": self.departments['info']['id'],
+                         "credits": 1, "semester": 1}
+                success, response, status = self.make_request('POST', 'courses', other, self.tokens['admin'])
+                if success:
+                    success, response, status = self.make_request('GET', f"courses/{response['id']}/roster",
+                                                                  token=self.tokens['teacher'], expected_status=403)
+                    self.log_test("Reject other course roster for teacher", success, f"Status: {status}")
+
+            # Get the student's own timetable
+            if 'student' in self.tokens:
+                success, response, status = self.make_request('GET', 'me/timetable', token=self.tokens['student'])
+                self.log_test("Get my timetable", success and {'courses', 'sessions', 'exams'} <= set(response),
+                             f"Status: {status}, Response: {response}")
+
     def test_exam_system(self):
         """Test exam creation and management"""
         print("\n🔍 Testing Exam System...")
@@ -308,6 +484,30 @@ class CampusManagerTester:
             self.log_test("Get grades", success and len(response) > 0,
                          f"Status: {status}, Count: {len(response) if success else 0}")
 
+            # Get course grade analytics
+            course_id = self.courses['prog101']['id']
+            success, response, status = self.make_request('GET', f'analytics/courses/{course_id}/grades', token=self.tokens['teacher'])
+            self.log_test("Get course grade analytics", success and response.get('overall', {}).get('count', 0) > 0,
+                         f"Status: {status}, Response: {response}")
+
+            # Get the student's transcript from the precomputed academic summary
+            student_id = self.students['test_student']['id']
+            success, response, status = self.make_request('GET', f'students/{student_id}/transcript', token=self.tokens['teacher'])
+            self.log_test("Get student transcript", success and response.get('credits_attempted', 0) > 0,
+                         f"Status: {status}, Response: {response}")
+
+            # Submit a report card job for the course's department and check on it
+            if 'admin' in self.tokens:
+                job_data = {"department_id": self.courses['prog101']['department_id'], "semester": 1, "formats": ["html", "csv"]}
+                success, response, status = self.make_request('POST', 'report-jobs', job_data,
+                                                             self.tokens['admin'], expected_status=202)
+                self.log_test("Submit report card job", success and response.get('status') == 'queued',
+                             f"Status: {status}, Response: {response}")
+                if success:
+                    success, response, status = self.make_request('GET', f"report-jobs/{response['id']}", token=self.tokens['admin'])
+                    self.log_test("Get report card job", success and response.get('status') in ('queued', 'running', 'completed'),
+                                 f"Status: {status}, Response: {response}")
+
     def test_attendance_system(self):
         """Test attendance tracking"""
         print("\n🔍 Testing Attendance System...")
@@ -335,6 +535,19 @@ class CampusManagerTester:
             self.log_test("Get attendance records", success and len(response) > 0,
                          f"Status: {status}, Count: {len(response) if success else 0}")
 
+            # Get course attendance analytics
+            course_id = self.courses['prog101']['id']
+            success, response, status = self.make_request('GET', f'analytics/courses/{course_id}/attendance?include_matrix=true',
+                                                         token=self.tokens['teacher'])
+            self.log_test("Get course attendance analytics", success and len(response.get('students', [])) > 0,
+                         f"Status: {status}, Response: {response}")
+
+            # Read the precomputed daily rollup for the record just created
+            success, response, status = self.make_request('GET', f'attendance/rollups/courses/{course_id}?date=2024-08-15',
+                                                         token=self.tokens['teacher'])
+            self.log_test("Get course attendance rollup", success and response.get('total', 0) > 0,
+                         f"Status: {status}, Response: {response}")
+
     def test_notification_system(self):
         """Test notification system"""
         print("\n🔍 Testing Notification System...")
@@ -355,6 +568,41 @@ class CampusManagerTester:
                 self.log_test(f"Get {role} dashboard stats", success,
                              f"Status: {status}, Stats: {response if success else 'None'}")
 
+        # Admission control counters
+        if 'admin' in self.tokens:
+            success, response, status = self.make_request('GET', 'admission/metrics', token=self.tokens['admin'])
+            self.log_test("Get admission metrics", success and response.get('admitted', 0) > 0,
+                         f"Status: {status}, Response: {response}")
+
+            success, response, status = self.make_request('GET', 'coalescing/metrics', token=self.tokens['admin'])
+            self.log_test("Get coalescing metrics", success and 'collapse_ratio' in response,
+                         f"Status: {status}, Response: {response}")
+
+            # Identical concurrent reads share one execution
+            if 'prog101' in self.courses:
+                course_id = self.courses['prog101']['id']
+                before = response.get('routes', {}).get('get_course', {"calls": 0, "executions": 0})
+                with ThreadPoolExecutor(max_workers=20) as pool:
+                    results = list(pool.map(
+                        lambda _: self.make_request('GET', f"courses/{course_id}", token=self.tokens['admin'])[0], range(20)
+                    ))
+                success, response, status = self.make_request('GET', 'coalescing/metrics', token=self.tokens['admin'])
+                after = response.get('routes', {}).get('get_course', {"calls": 0, "executions": 0})
+                calls, executions = after['calls'] - before['calls'], after['executions'] - before['executions']
+                self.log_test("Coalesce concurrent course reads", all(results) and calls == 20 and executions < calls,
+                             f"Calls: {calls}, Executions: {executions}")
+
+        # Batch: one round trip for a page's worth of reads
+        if 'admin' in self.tokens:
+            batch = {"requests": [
+                {"id": "departments", "path": "/api/departments"},
+                {"id": "courses", "path": "/api/courses?fields=id,name"},
+                {"id": "stats", "path": "/api/stats/dashboard"}
+            ]}
+            success, response, status = self.make_request('POST', 'batch', batch, self.tokens['admin'])
+            self.log_test("Batch page load", success and all(r['status'] == 200 for r in response.get('responses', [])),
+                         f"Status: {status}, Response: {response}")
+
     def run_all_tests(self):
         """Run all test suites"""
         print("🚀 Starting Campus Manager API Tests...")
@@ -362,6 +610,8 @@ class CampusManagerTester:
         
         # Run tests in order (dependencies matter)
         self.test_user_registration_and_login()
+        self.test_token_lifecycle()
+        self.test_login_throttling()
         self.test_departments()
         self.test_student_management()
         self.test_teacher_management()
@@ -383,9 +633,30 @@ class CampusManagerTester:
         
         return self.tests_passed == self.tests_run
 
+def run_in_process():
+    """Run the suite against the app itself on the in-memory storage engine."""
+    os.environ['STORAGE_ENGINE'] = 'memory'
+    os.environ.setdefault('AUTH_STATELESS', 'true')
+    os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+    os.environ.setdefault('DB_NAME', 'campus_manager_test')
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend'))
+    from fastapi.testclient import TestClient
+    from server import app
+
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    with TestClient(app) as client:
+        started = time.perf_counter()
+        tester = CampusManagerTester("http://testserver", session=client)
+        success = tester.run_all_tests()
+        print(f"⏱️  In-process run took {time.perf_counter() - started:.2f}s")
+    return success
+
 def main():
-    tester = CampusManagerTester()
-    success = tester.run_all_tests()
+    if "--in-process" in sys.argv:
+        success = run_in_process()
+    else:
+        tester = CampusManagerTester()
+        success = tester.run_all_tests()
     return 0 if success else 1
 
 if __name__ == "__main__":